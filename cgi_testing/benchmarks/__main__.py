@@ -0,0 +1,65 @@
+import sys
+import argparse
+import warnings
+
+from cgi_testing.benchmarks import runner
+from cgi_testing.benchmarks.suite import BENCHMARKS
+
+
+def Main(argv=None):
+
+	parser = argparse.ArgumentParser(prog='python -m cgi_testing.benchmarks')
+	parser.add_argument('--sizes', default='100,1000,10000', help='comma separated inventory sizes (VM count)')
+	parser.add_argument('--only', action='append', help='run only the named benchmark, or "import" for cold import times (repeatable)')
+	parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative regression of RPC counts and memory')
+	parser.add_argument('--latency-threshold', type=float, default=1.0, help='allowed relative regression of latency percentiles')
+	parser.add_argument('--baseline', default=runner.BASELINE, help='baseline JSON file')
+	parser.add_argument('--update-baseline', action='store_true', help='write the results as the new baseline')
+	parser.add_argument('--rpc-latency', type=float, default=0.0, help='simulated seconds per SOAP round trip')
+	parser.add_argument('--task-time', type=float, default=0.0, help='simulated seconds per vCenter task')
+	parser.add_argument('--max-seconds', type=float, default=10.0, help='time cap per benchmark and size')
+	args = parser.parse_args(argv)
+
+	# The file sink uses a self-signed certificate, as UploadFileToDatastore does
+	# not verify vCenter certificates either.
+	warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+
+	benchmarks = [benchmark for benchmark in BENCHMARKS if not args.only or benchmark.name in args.only]
+	bench_runner = runner.Runner(
+		sizes=[int(size) for size in args.sizes.split(',')],
+		rpc_latency=args.rpc_latency,
+		task_time=args.task_time,
+		max_seconds=args.max_seconds
+	)
+
+	def ReportImport(key, result):
+		print(f'{key:<48} cold import {result["import_time"] * 1000:9.3f} ms  modules {result["modules_loaded"]:5d}')
+
+	def Report(key, result):
+		print(
+			f'{key:<32} p50 {result["p50"] * 1000:9.3f} ms  p90 {result["p90"] * 1000:9.3f} ms  '
+			f'p99 {result["p99"] * 1000:9.3f} ms  rpc {result["rpc_calls"]:9.1f}  '
+			f'peak {result["peak_memory_kb"]:10.1f} KiB'
+		)
+
+	results = bench_runner.Run(benchmarks, report=Report) if benchmarks else {}
+	if not args.only or 'import' in args.only:
+		results.update(runner.MeasureImports(report=ReportImport))
+
+	if args.update_baseline:
+		baseline = runner.LoadBaseline(args.baseline)
+		baseline.update(results)
+		runner.SaveBaseline(baseline, args.baseline)
+		print(f'Baseline written to {args.baseline}')
+		return 0
+
+	regressions = runner.Compare(results, runner.LoadBaseline(args.baseline), args.threshold, args.latency_threshold)
+	regressions += runner.CheckImportBudgets(results)
+	for regression in regressions:
+		print(f'REGRESSION {regression}')
+
+	return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+	sys.exit(Main())
@@ -0,0 +1,316 @@
+import gc
+import os
+import ssl
+import sys
+import json
+import math
+import time
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+import http.server
+
+from cgi_testing.classes.simulator import Simulator
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Cold import budget in seconds per module, as reported by `python -X importtime`.
+IMPORT_BUDGETS = {
+	'cgi_testing.classes.vsphere': 0.025
+}
+
+
+class FileSink:
+
+	# Local HTTPS endpoint that accepts the datastore PUTs issued by
+	# UploadFileToDatastore and discards the body. Without `certfile` (a PEM
+	# holding certificate and key) a throwaway self-signed certificate is
+	# generated for the lifetime of the sink, so no private key is shipped.
+
+	def __init__(self, certfile=None):
+
+		self.certfile = certfile
+		self.tempdir = None
+		self.requests = 0
+		self.bytes_received = 0
+		self.server = None
+		self.thread = None
+
+	def __enter__(self):
+
+		sink = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+
+			protocol_version = 'HTTP/1.1'
+
+			def do_PUT(self):
+
+				remaining = int(self.headers.get('Content-Length', 0))
+				while remaining:
+					chunk = self.rfile.read(min(remaining, 1024 * 1024))
+					if not chunk:
+						break
+					remaining -= len(chunk)
+					sink.bytes_received += len(chunk)
+				sink.requests += 1
+
+				self.send_response(201)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+
+			def log_message(self, *args):
+
+				pass
+
+		context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+		if self.certfile is not None:
+			context.load_cert_chain(self.certfile)
+		else:
+			self.tempdir = tempfile.TemporaryDirectory(prefix='cgi-testing-sink-')
+			context.load_cert_chain(*SelfSignedCertificate(self.tempdir.name))
+
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.server.shutdown()
+		self.server.server_close()
+		if self.tempdir is not None:
+			self.tempdir.cleanup()
+			self.tempdir = None
+
+	@property
+	def port(self):
+
+		return self.server.server_address[1]
+
+
+def SelfSignedCertificate(directory, common_name='localhost'):
+
+	# One-day certificate and unencrypted key for `common_name`, written to
+	# `directory` by the openssl command line. Returns (certfile, keyfile).
+	certfile = os.path.join(directory, 'cert.pem')
+	keyfile = os.path.join(directory, 'key.pem')
+	subprocess.run(
+		[
+			'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+			'-subj', f'/CN={common_name}', '-keyout', keyfile, '-out', certfile
+		],
+		check=True,
+		capture_output=True
+	)
+
+	return certfile, keyfile
+
+
+class Benchmark:
+
+	def __init__(self, name, setup, iterations=20, available=None):
+
+		# setup(context) returns the operation to time; it is called once per
+		# inventory size with a context holding si, simulator, size and names.
+		self.name = name
+		self.setup = setup
+		self.iterations = iterations
+		self.available = available or (lambda: True)
+
+
+class Context:
+
+	def __init__(self, simulator, size, file_sink=None):
+
+		self.simulator = simulator
+		self.si = simulator.Connect()
+		self.size = size
+		self.file_sink = file_sink
+		self.names = [f'vm-{index:05d}' for index in range(size)]
+		self.counter = 0
+
+	def NextName(self):
+
+		# Walks the inventory in a fixed, scattered order so lookups do not
+		# always hit the first VMs of the container view.
+		self.counter += 1
+		return self.names[(self.counter * 7919) % self.size]
+
+
+def Percentile(values, percent):
+
+	if not values:
+		return 0.0
+
+	ordered = sorted(values)
+	rank = (len(ordered) - 1) * percent / 100
+	lower = math.floor(rank)
+	upper = math.ceil(rank)
+
+	return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+class Runner:
+
+	def __init__(self, sizes=(100, 1000, 10000), rpc_latency=0.0, task_time=0.0, max_seconds=10.0):
+
+		self.sizes = sizes
+		self.rpc_latency = rpc_latency
+		self.task_time = task_time
+		self.max_seconds = max_seconds
+
+	def Run(self, benchmarks, report=None):
+
+		results = {}
+		with FileSink() as file_sink:
+			for size in self.sizes:
+				simulator = Simulator(
+					rpc_latency=self.rpc_latency,
+					task_run_time=self.task_time
+				).Generate(vms=size, powered_on_ratio=1)
+				context = Context(simulator, size, file_sink)
+
+				for benchmark in benchmarks:
+					if not benchmark.available():
+						continue
+					key = f'{benchmark.name}[{size}]'
+					results[key] = self.Measure(benchmark.setup(context), simulator, benchmark.iterations)
+					if report:
+						report(key, results[key])
+
+		return results
+
+	def Measure(self, operation, simulator, iterations):
+
+		operation()
+
+		latencies = []
+		simulator.ResetCounters()
+		deadline = time.perf_counter() + self.max_seconds
+		for _ in range(iterations):
+			start = time.perf_counter()
+			operation()
+			latencies.append(time.perf_counter() - start)
+			if time.perf_counter() > deadline:
+				break
+		rpc_calls = simulator.rpc_calls / len(latencies)
+
+		gc.collect()
+		tracemalloc.start()
+		try:
+			operation()
+			peak_memory = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+
+		return {
+			'iterations': len(latencies),
+			'p50': Percentile(latencies, 50),
+			'p90': Percentile(latencies, 90),
+			'p99': Percentile(latencies, 99),
+			'rpc_calls': rpc_calls,
+			'peak_memory_kb': peak_memory / 1024
+		}
+
+
+def MeasureImportTime(module, repeats=5):
+
+	# Best of `repeats` cold imports, each in a fresh interpreter. A first run
+	# writes the bytecode cache so that compilation is not counted.
+	env = dict(os.environ)
+	env.pop('PYTHONDONTWRITEBYTECODE', None)
+	env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+	command = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+
+	subprocess.run(command, env=env, cwd=ROOT, capture_output=True, check=True)
+
+	samples = []
+	modules = 0
+	for _ in range(repeats):
+		completed = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+		lines = [line.split('|') for line in completed.stderr.splitlines() if line.startswith('import time:')]
+		modules = len(lines) - 1
+		for _, cumulative, name in lines:
+			if name.strip() == module:
+				samples.append(int(cumulative) / 1e6)
+
+	return {
+		'iterations': len(samples),
+		'import_time': min(samples),
+		'modules_loaded': modules
+	}
+
+
+def MeasureImports(budgets=IMPORT_BUDGETS, report=None):
+
+	results = {}
+	for module in budgets:
+		key = f'import[{module}]'
+		results[key] = MeasureImportTime(module)
+		if report:
+			report(key, results[key])
+
+	return results
+
+
+def CheckImportBudgets(results, budgets=IMPORT_BUDGETS):
+
+	violations = []
+	for module, budget in sorted(budgets.items()):
+		result = results.get(f'import[{module}]')
+		if result is not None and result['import_time'] > budget:
+			violations.append(f'import[{module}] import_time: {result["import_time"]:.4g} > budget {budget:.4g}')
+
+	return violations
+
+
+# Metric name -> (absolute slack below which a difference is noise, whether the
+# metric is a wall-clock latency judged against the looser latency threshold).
+COMPARED_METRICS = {
+	'p50': (0.001, True),
+	'p90': (0.002, True),
+	'import_time': (0.005, True),
+	'rpc_calls': (0.0, False),
+	'peak_memory_kb': (64.0, False)
+}
+
+
+def Compare(results, baseline, threshold, latency_threshold=None):
+
+	latency_threshold = threshold if latency_threshold is None else latency_threshold
+
+	regressions = []
+	for key, result in sorted(results.items()):
+		expected = baseline.get(key)
+		if expected is None:
+			continue
+		for metric, (slack, is_latency) in COMPARED_METRICS.items():
+			if metric not in expected:
+				continue
+			limit = expected[metric] * (1 + (latency_threshold if is_latency else threshold)) + slack
+			if result[metric] > limit:
+				regressions.append(f'{key} {metric}: {result[metric]:.4g} > {limit:.4g} (baseline {expected[metric]:.4g})')
+
+	return regressions
+
+
+def LoadBaseline(path=BASELINE):
+
+	if not os.path.exists(path):
+		return {}
+
+	with open(path) as baseline_file:
+		return json.load(baseline_file)
+
+
+def SaveBaseline(results, path=BASELINE):
+
+	with open(path, 'w') as baseline_file:
+		json.dump(results, baseline_file, indent=2, sort_keys=True)
+		baseline_file.write('\n')
@@ -0,0 +1,71 @@
+from pyVmomi import vim
+
+from cgi_testing.classes.vsphere import Vsphere
+from cgi_testing.benchmarks.runner import Benchmark
+
+
+UPLOAD_PAYLOAD = b'\0' * (1024 * 1024)
+
+
+def GetObject(context):
+
+	return lambda: Vsphere.GetObject(context.si, vim.VirtualMachine, context.NextName())
+
+
+def GetVMs(context):
+
+	return lambda: Vsphere.GetVMs(context.si)
+
+
+def GetVmMetasByName(context):
+
+	return lambda: Vsphere.GetVmMetasByName(context.si, [context.NextName() for _ in range(10)])
+
+
+def ListFleetHardDisks(context):
+
+	return lambda: Vsphere.ListFleetHardDisks(context.si)
+
+
+def UploadFileToDatastore(context):
+
+	return lambda: Vsphere.UploadFileToDatastore(
+		context.si,
+		'127.0.0.1',
+		'datastore-0000',
+		UPLOAD_PAYLOAD,
+		'iso',
+		'payload.bin',
+		port=context.file_sink.port
+	)
+
+
+def PowerCycle(context):
+
+	def Operation():
+		vm_name = context.NextName()
+		Vsphere.PowerOffVM(context.si, vm_name)
+		Vsphere.PowerOnVM(context.si, vm_name)
+
+	return Operation
+
+
+def SnapshotCycle(context):
+
+	def Operation():
+		vm_name = context.NextName()
+		Vsphere.SnapshotVM(context.si, vm_name, 'benchmark', 'benchmark')
+		Vsphere.DeleteVMSnapshot(context.si, vm_name, 'benchmark')
+
+	return Operation
+
+
+BENCHMARKS = [
+	Benchmark('GetObject', GetObject),
+	Benchmark('GetVMs', GetVMs, iterations=5),
+	Benchmark('GetVmMetasByName', GetVmMetasByName, iterations=5),
+	Benchmark('ListFleetHardDisks', ListFleetHardDisks, iterations=3),
+	Benchmark('UploadFileToDatastore', UploadFileToDatastore),
+	Benchmark('PowerCycle', PowerCycle, iterations=10),
+	Benchmark('SnapshotCycle', SnapshotCycle, iterations=10)
+]
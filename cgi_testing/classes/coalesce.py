@@ -0,0 +1,106 @@
+import time
+import threading
+
+
+class Flight:
+
+	__slots__ = ('done', 'result', 'error')
+
+	def __init__(self):
+
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+	def Wait(self):
+
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+
+		return self.result
+
+
+class SingleFlight:
+
+	# Concurrent calls with the same key share one execution: the first caller
+	# runs `fetch`, the others wait for its result (or its exception). Nothing is
+	# cached, a call arriving after the flight landed starts a new one.
+
+	def __init__(self):
+
+		self.lock = threading.Lock()
+		self.flights = {}
+		self.shared = 0
+
+	def Do(self, key, fetch):
+
+		with self.lock:
+			flight = self.flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self.flights[key] = Flight()
+			else:
+				self.shared += 1
+
+		if not leader:
+			return flight.Wait()
+
+		try:
+			flight.result = fetch()
+		except Exception as e:
+			flight.error = e
+		finally:
+			with self.lock:
+				del self.flights[key]
+			flight.done.set()
+
+		return flight.Wait()
+
+
+class NameBatcher:
+
+	# Merges single-key lookups arriving within `window` seconds of each other
+	# into one call of `fetch_many(keys)`, which returns {key: object}. Keys are
+	# used as given (names lowercased by the caller, MoRef ids, ...). Lookups are
+	# grouped by `group`, e.g. session and object type; the first caller of a
+	# group waits out the window and then fetches for everyone.
+
+	def __init__(self, window=0.005, max_names=1000, sleep=time.sleep):
+
+		self.window = window
+		self.max_names = max_names
+		self.sleep = sleep
+		self.lock = threading.Lock()
+		self.batches = {}
+		self.fetches = 0
+
+	def Get(self, group, name, fetch_many):
+
+		with self.lock:
+			batch = self.batches.get(group)
+			leader = batch is None
+			if leader:
+				batch = self.batches[group] = (set(), Flight())
+			names, flight = batch
+			names.add(name)
+			if len(names) >= self.max_names:
+				del self.batches[group]
+
+		if not leader:
+			return flight.Wait().get(name)
+
+		self.sleep(self.window)
+		with self.lock:
+			if self.batches.get(group) is batch:
+				del self.batches[group]
+			self.fetches += 1
+
+		try:
+			flight.result = fetch_many(names)
+		except Exception as e:
+			flight.error = e
+		finally:
+			flight.done.set()
+
+		return flight.Wait().get(name)
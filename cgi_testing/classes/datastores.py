@@ -0,0 +1,196 @@
+import time
+import fnmatch
+import threading
+import concurrent.futures
+
+from pyVmomi import vim
+
+from cgi_testing.classes import vsphere
+from cgi_testing.classes.retry import Retry
+from cgi_testing.classes.records import DatastoreFileRecord
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class DatastoreIndex:
+
+	# In-memory index of the files on every datastore, built with one
+	# SearchDatastoreSubFolders_Task per datastore, run in parallel. Refresh()
+	# only searches again the datastores whose free or uncommitted space changed
+	# since their last search, which any file added or removed shows up in.
+
+	# Extents and change tracking files that belong to a .vmdk descriptor.
+	DISK_EXTENTS = ('-flat.vmdk', '-delta.vmdk', '-sesparse.vmdk', '-ctk.vmdk', '-rdm.vmdk', '-rdmp.vmdk')
+
+	def __init__(self, si, match_pattern=('*',), max_workers=8, miss_interval=5.0, clock=time.monotonic):
+
+		self.si = si
+		self.match_pattern = list(match_pattern)
+		self.max_workers = max_workers
+		self.miss_interval = miss_interval
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.files = {}
+		self.tokens = {}
+		self.errors = {}
+		# {datastore name: time of the last search forced by a miss}
+		self.missed = {}
+
+	def __len__(self):
+
+		with self.lock:
+			return sum(len(files) for files in self.files.values())
+
+	def Refresh(self, force=False, datastores=None):
+
+		# Returns the names of the datastores searched. A datastore whose search
+		# fails keeps its previous files and is searched again next time.
+		props = Vsphere.GetObjectProperties(
+			self.si,
+			vim.Datastore,
+			['name', 'browser', 'summary.freeSpace', 'summary.uncommitted', 'summary.accessible']
+		)
+		current = {}
+		for datastore, values in props.items():
+			token = (values.get('summary.freeSpace'), values.get('summary.uncommitted'))
+			current[values['name']] = (values.get('browser'), token, values.get('summary.accessible', True))
+
+		with self.lock:
+			if datastores is None:
+				for name in set(self.files) - set(current):
+					del self.files[name]
+					self.tokens.pop(name, None)
+			stale = [
+				name
+				for name, (browser, token, accessible) in current.items()
+				if browser is not None and accessible is not False
+				and (datastores is None or name in datastores)
+				and (force or self.tokens.get(name) != token)
+			]
+
+		if not stale:
+			return []
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(stale))) as executor:
+			results = dict(zip(stale, executor.map(lambda name: self._Search(name, current[name][0]), stale)))
+
+		with self.lock:
+			for name, result in results.items():
+				if isinstance(result, Exception):
+					self.errors[name] = result
+					continue
+				self.errors.pop(name, None)
+				self.files[name] = result
+				self.tokens[name] = current[name][1]
+
+		return stale
+
+	def Exists(self, datastore, path, refresh=True):
+
+		# On a miss the datastore is searched again, since files uploaded by
+		# other tools only show up in the index after a refresh; at most once per
+		# `miss_interval` seconds, so repeated checks for a missing file do not
+		# search the datastore each time.
+		path = path.strip('/')
+		with self.lock:
+			if path in self.files.get(datastore, {}):
+				return True
+			now = self.clock()
+			last = self.missed.get(datastore)
+			if not refresh or (last is not None and now - last < self.miss_interval):
+				return False
+			self.missed[datastore] = now
+
+		self.Refresh(force=True, datastores=[datastore])
+
+		with self.lock:
+			return path in self.files.get(datastore, {})
+
+	def Find(self, name):
+
+		# Every copy of a file name, e.g. which datastores already hold an ISO.
+		name = name.lower()
+
+		with self.lock:
+			return [
+				record
+				for datastore in sorted(self.files)
+				for record in self.files[datastore].values()
+				if record.name.lower() == name
+			]
+
+	def Search(self, pattern, datastore=None):
+
+		# Shell-style match against the path relative to the datastore root.
+		with self.lock:
+			return [
+				record
+				for name in sorted(self.files)
+				if datastore is None or name == datastore
+				for path, record in sorted(self.files[name].items())
+				if fnmatch.fnmatch(path, pattern)
+			]
+
+	def OrphanedVMDKs(self):
+
+		# Disk descriptors that no VM disk, or parent in its snapshot chain,
+		# points to. Only this fetches every VM's devices. The index is brought
+		# up to date first and the devices are read after it, so a disk created
+		# in between is never counted as an orphan.
+		self.Refresh()
+		disk_files = self._DiskFiles()
+
+		return [
+			record
+			for record in self.Search('*.vmdk')
+			if not record.name.endswith(DatastoreIndex.DISK_EXTENTS) and record.path not in disk_files
+		]
+
+	def Put(self, datastore, path, size=None, modified=None):
+
+		folder, _, name = path.strip('/').rpartition('/')
+		with self.lock:
+			self.files.setdefault(datastore, {})[path.strip('/')] = DatastoreFileRecord(datastore, folder, name, size, modified)
+
+	def Discard(self, datastore, path):
+
+		with self.lock:
+			self.files.get(datastore, {}).pop(path.strip('/'), None)
+
+	def _Search(self, name, browser):
+
+		search_spec = vim.host.DatastoreBrowser.SearchSpec(
+			matchPattern=self.match_pattern,
+			details=vim.host.DatastoreBrowser.FileInfo.Details(fileType=True, fileSize=True, modification=True)
+		)
+		try:
+			task = Retry.Call(
+				lambda: browser.SearchDatastoreSubFolders_Task(datastorePath=f'[{name}]', searchSpec=search_spec),
+				idempotent=True,
+				policy=Vsphere.RETRY_POLICY
+			)
+			vsphere.WaitForTask(task)
+		except Exception as e:
+			return e
+
+		files = {}
+		for result in task.info.result or []:
+			folder = result.folderPath.split(']', 1)[-1].strip().strip('/')
+			for file in result.file or []:
+				path = f'{folder}/{file.path}' if folder else file.path
+				files[path] = DatastoreFileRecord(name, folder, file.path, file.fileSize, file.modification)
+
+		return files
+
+	def _DiskFiles(self):
+
+		disk_files = set()
+		for _, props in Vsphere.IterObjectProperties(self.si, vim.VirtualMachine, ['config.hardware.device']):
+			for device in props.get('config.hardware.device') or []:
+				if not isinstance(device, vim.vm.device.VirtualDisk):
+					continue
+				backing = device.backing
+				while backing is not None:
+					disk_files.add(getattr(backing, 'fileName', None))
+					backing = getattr(backing, 'parent', None)
+
+		return disk_files
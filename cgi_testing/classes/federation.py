@@ -0,0 +1,226 @@
+import time
+import threading
+import collections
+import concurrent.futures
+
+from cgi_testing.classes.coalesce import SingleFlight
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class Federation:
+
+	# Sessions to many vCenters behind one client. Inventory queries fan out in
+	# parallel and are merged; methods that act on a single VM are routed with a
+	# global VM name -> vCenter index instead of asking every vCenter in turn.
+
+	# Vsphere methods taking (si, vm_name, ...) that are routed to one vCenter.
+	ROUTED_METHODS = (
+		'AttachISOToVirtualMachine',
+		'PowerOnVM',
+		'PowerOffVM',
+		'RebootVM',
+		'DeleteVm',
+		'SnapshotVM',
+		'RestoreVMFromSnapshot',
+		'DeleteVMSnapshot',
+		'ListVMSnapshots',
+		'GetVmMeta',
+		'ResizeVM',
+		'RenameVM',
+		'SetVMCustomAttributes',
+		'GetVMCustomAttributes',
+		'ListVMHardDisks',
+		'AddDiskToVM',
+		'AddDisksToVM',
+		'RemoveDiskFromVM',
+		'ExtendVMHardDisk',
+		'AttachPortgroupToVM',
+		'AttachCDRomToVM'
+	)
+
+	def __init__(self, sessions=None, max_workers=16, index_ttl=600, miss_ttl=30, clock=time.monotonic):
+
+		# sessions: {vCenter name: service instance}
+		self.sessions = dict(sessions or {})
+		self.errors = {}
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vsphere-federation')
+		self.index_ttl = index_ttl
+		self.miss_ttl = miss_ttl
+		self.clock = clock
+
+		self.lock = threading.Lock()
+		self.refreshes = SingleFlight()
+		self.index = {}
+		self.duplicates = {}
+		self.index_time = None
+		# {vCenter name: {lowercase VM name: VM name}} as last listed; the
+		# lowercase names only route, listings report the names as they are.
+		self.names = {}
+		# {lowercase VM name: time of the refresh that did not find it}
+		self.misses = {}
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.Disconnect()
+
+	def Connect(self, endpoints):
+
+		# endpoints: {vCenter name: (host, user, pwd)}. Endpoints that fail to
+		# connect are left out and reported in self.errors.
+		futures = {
+			name: self.executor.submit(Vsphere.Connect, host, user, pwd)
+			for name, (host, user, pwd) in endpoints.items()
+		}
+		for name, future in futures.items():
+			si = future.result()
+			if si:
+				self.sessions[name] = si
+				self.errors.pop(name, None)
+			else:
+				self.errors[name] = 'connection failed'
+
+		return self
+
+	def Disconnect(self):
+
+		sessions, self.sessions = self.sessions, {}
+		for future in [self.executor.submit(Vsphere.Disconnect, si) for si in sessions.values()]:
+			future.result()
+		self.executor.shutdown(wait=True)
+
+	def FanOut(self, method, *args, **kwargs):
+
+		# Runs a Vsphere method name or callable taking (si, ...) on every vCenter
+		# in parallel. Returns {vCenter name: result}; a vCenter that raised maps
+		# to the exception, so one bad endpoint does not hide the others.
+		if isinstance(method, str):
+			method = getattr(Vsphere, method)
+
+		futures = {name: self.executor.submit(method, si, *args, **kwargs) for name, si in self.sessions.items()}
+
+		results = {}
+		for name, future in futures.items():
+			try:
+				results[name] = future.result()
+			except Exception as e:
+				results[name] = e
+
+		return results
+
+	def GetVMs(self):
+
+		# Merged VM names, which also rebuilds the routing index on the way.
+		self.RefreshIndex()
+
+		with self.lock:
+			return sorted(self.names[endpoint][vm_name] for vm_name, endpoint in self.index.items())
+
+	def GetVmMetasByName(self, vm_names):
+
+		# Groups the names per vCenter, fetches each group in parallel with one
+		# bulk call and returns the records in the requested order.
+		groups = collections.defaultdict(list)
+		for vm_name in vm_names:
+			endpoint = self.Locate(vm_name)
+			if endpoint is None:
+				return False
+			groups[endpoint].append(vm_name)
+
+		futures = {
+			endpoint: self.executor.submit(Vsphere.GetVmMetasByName, self.sessions[endpoint], names)
+			for endpoint, names in groups.items()
+		}
+		by_name = {}
+		for endpoint, future in futures.items():
+			metas = future.result()
+			if metas is False:
+				return False
+			by_name.update(zip(groups[endpoint], metas))
+
+		return [by_name[vm_name] for vm_name in vm_names]
+
+	def RefreshIndex(self):
+
+		# A vCenter that fails to list its VMs keeps the ones it listed last
+		# time, so an outage does not make its VMs unroutable.
+		results = self.FanOut(lambda si: list(Vsphere.IterVMs(si)))
+
+		with self.lock:
+			for endpoint, names in results.items():
+				if isinstance(names, Exception):
+					self.errors[endpoint] = repr(names)
+				else:
+					self.errors.pop(endpoint, None)
+					self.names[endpoint] = {vm_name.lower(): vm_name for vm_name in names}
+
+			index = {}
+			locations = collections.defaultdict(list)
+			for endpoint, names in sorted(self.names.items()):
+				if endpoint not in self.sessions:
+					continue
+				for vm_name in names:
+					locations[vm_name].append(endpoint)
+					index.setdefault(vm_name, endpoint)
+
+			self.index = index
+			self.duplicates = {vm_name: endpoints for vm_name, endpoints in locations.items() if len(endpoints) > 1}
+			self.index_time = self.clock()
+			self.misses = {vm_name: missed for vm_name, missed in self.misses.items() if vm_name not in index}
+
+	def Locate(self, vm_name, refresh=True):
+
+		# vCenter holding `vm_name`. A miss or an expired index triggers one
+		# refresh, so VMs created or moved since the last refresh are found; a
+		# name that refresh did not find either is not looked for again for
+		# `miss_ttl` seconds.
+		key = vm_name.lower()
+		with self.lock:
+			expired = self.index_time is None or self.clock() - self.index_time > self.index_ttl
+			endpoint = None if expired else self.index.get(key)
+			missed = self.misses.get(key)
+			if endpoint is None and not expired and missed is not None and self.clock() - missed < self.miss_ttl:
+				return None
+
+		if endpoint is None and refresh:
+			self.refreshes.Do('index', self.RefreshIndex)
+			with self.lock:
+				endpoint = self.index.get(key)
+				if endpoint is None:
+					self.misses[key] = self.clock()
+
+		return endpoint
+
+	def Call(self, method_name, vm_name, *args, **kwargs):
+
+		endpoint = self.Locate(vm_name)
+		if endpoint is None:
+			return False
+
+		result = getattr(Vsphere, method_name)(self.sessions[endpoint], vm_name, *args, **kwargs)
+
+		if result is not False:
+			with self.lock:
+				if method_name == 'DeleteVm':
+					self.index.pop(vm_name.lower(), None)
+					self.names.get(endpoint, {}).pop(vm_name.lower(), None)
+				elif method_name == 'RenameVM':
+					new_vm_name = kwargs.get('new_vm_name', args[0] if args else None)
+					self.index.pop(vm_name.lower(), None)
+					self.names.get(endpoint, {}).pop(vm_name.lower(), None)
+					self.index[new_vm_name.lower()] = endpoint
+					# As RenameVM names it.
+					self.names.setdefault(endpoint, {})[new_vm_name.lower()] = new_vm_name.upper()
+					self.misses.pop(new_vm_name.lower(), None)
+
+		return result
+
+	def __getattr__(self, name):
+
+		if name in Federation.ROUTED_METHODS:
+			return lambda vm_name, *args, **kwargs: self.Call(name, vm_name, *args, **kwargs)
+
+		raise AttributeError(name)
@@ -0,0 +1,418 @@
+import json
+import math
+import time
+import logging
+import inspect
+import datetime
+import functools
+import threading
+
+from cgi_testing.classes import vsphere
+
+
+class CallRecord:
+
+	__slots__ = (
+		'method',
+		'wall_time',
+		'rpc_calls',
+		'bytes_sent',
+		'bytes_received',
+		'tasks',
+		'task_queue_time',
+		'task_run_time',
+		'error'
+	)
+
+	def __init__(self, method):
+
+		self.method = method
+		self.wall_time = 0.0
+		self.rpc_calls = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.tasks = 0
+		self.task_queue_time = 0.0
+		self.task_run_time = 0.0
+		self.error = None
+
+	def ToDict(self):
+
+		return {name: getattr(self, name) for name in self.__slots__}
+
+
+class MethodStats:
+
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+	__slots__ = (
+		'count',
+		'errors',
+		'wall_time',
+		'rpc_calls',
+		'bytes_sent',
+		'bytes_received',
+		'tasks',
+		'task_queue_time',
+		'task_run_time',
+		'buckets'
+	)
+
+	def __init__(self):
+
+		self.count = 0
+		self.errors = 0
+		self.wall_time = 0.0
+		self.rpc_calls = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.tasks = 0
+		self.task_queue_time = 0.0
+		self.task_run_time = 0.0
+		self.buckets = [0] * len(MethodStats.BUCKETS)
+
+	def Add(self, record):
+
+		self.count += 1
+		self.errors += record.error is not None
+		self.wall_time += record.wall_time
+		self.rpc_calls += record.rpc_calls
+		self.bytes_sent += record.bytes_sent
+		self.bytes_received += record.bytes_received
+		self.tasks += record.tasks
+		self.task_queue_time += record.task_queue_time
+		self.task_run_time += record.task_run_time
+
+		for index, upper_bound in enumerate(MethodStats.BUCKETS):
+			if record.wall_time <= upper_bound:
+				self.buckets[index] += 1
+				break
+
+
+class MemorySink:
+
+	def __init__(self):
+
+		self.lock = threading.Lock()
+		self.stats = {}
+
+	def Record(self, record):
+
+		with self.lock:
+			if record.method not in self.stats:
+				self.stats[record.method] = MethodStats()
+			self.stats[record.method].Add(record)
+
+	def Snapshot(self):
+
+		with self.lock:
+			return {
+				method: {name: getattr(stats, name) for name in MethodStats.__slots__ if name != 'buckets'}
+				for method, stats in self.stats.items()
+			}
+
+	def Reset(self):
+
+		with self.lock:
+			self.stats = {}
+
+
+class PrometheusSink(MemorySink):
+
+	PREFIX = 'vsphere'
+
+	COUNTERS = (
+		('calls_total', 'count', 'Number of Vsphere method calls.'),
+		('call_errors_total', 'errors', 'Number of Vsphere method calls that raised.'),
+		('soap_calls_total', 'rpc_calls', 'Number of SOAP round trips issued by Vsphere methods.'),
+		('soap_bytes_sent_total', 'bytes_sent', 'SOAP request bytes sent by Vsphere methods.'),
+		('soap_bytes_received_total', 'bytes_received', 'SOAP response bytes received by Vsphere methods.'),
+		('tasks_total', 'tasks', 'Number of vCenter tasks waited for.'),
+		('task_queue_seconds_total', 'task_queue_time', 'Time vCenter tasks spent queued.'),
+		('task_run_seconds_total', 'task_run_time', 'Time vCenter tasks spent running.')
+	)
+
+	def Exposition(self):
+
+		with self.lock:
+			stats = sorted(self.stats.items())
+
+			name = f'{PrometheusSink.PREFIX}_call_duration_seconds'
+			lines = [
+				f'# HELP {name} Wall time of Vsphere method calls.',
+				f'# TYPE {name} histogram'
+			]
+			for method, method_stats in stats:
+				cumulative = 0
+				for upper_bound, bucket in zip(MethodStats.BUCKETS, method_stats.buckets):
+					cumulative += bucket
+					le = '+Inf' if upper_bound == math.inf else repr(float(upper_bound))
+					lines.append(f'{name}_bucket{{method="{method}",le="{le}"}} {cumulative}')
+				lines.append(f'{name}_sum{{method="{method}"}} {method_stats.wall_time}')
+				lines.append(f'{name}_count{{method="{method}"}} {method_stats.count}')
+
+			for suffix, attribute, description in PrometheusSink.COUNTERS:
+				name = f'{PrometheusSink.PREFIX}_{suffix}'
+				lines.append(f'# HELP {name} {description}')
+				lines.append(f'# TYPE {name} counter')
+				for method, method_stats in stats:
+					lines.append(f'{name}{{method="{method}"}} {getattr(method_stats, attribute)}')
+
+		return '\n'.join(lines) + '\n'
+
+
+class JsonLogSink:
+
+	def __init__(self, logger=None, level=logging.INFO):
+
+		self.logger = logger or logging.getLogger('cgi_testing.vsphere')
+		self.level = level
+
+	def Record(self, record):
+
+		if self.logger.isEnabledFor(self.level):
+			self.logger.log(self.level, json.dumps(record.ToDict(), default=str))
+
+
+class _CountingResponse:
+
+	def __init__(self, response, frame):
+
+		self._response = response
+		self._frame = frame
+
+	def read(self, *args):
+
+		data = self._response.read(*args)
+		if self._frame is not None:
+			self._frame.bytes_received += len(data)
+		return data
+
+	def __getattr__(self, name):
+
+		return getattr(self._response, name)
+
+
+class _CountingConnection:
+
+	def __init__(self, connection):
+
+		self._connection = connection
+
+	def request(self, method, url, body=None, *args, **kwargs):
+
+		frame = Instrumentation._CurrentFrame()
+		if frame is not None and body is not None:
+			frame.bytes_sent += len(body)
+		return self._connection.request(method, url, body, *args, **kwargs)
+
+	def getresponse(self):
+
+		return _CountingResponse(self._connection.getresponse(), Instrumentation._CurrentFrame())
+
+	def __getattr__(self, name):
+
+		return getattr(self._connection, name)
+
+
+class Instrumentation:
+
+	# Per-method wall time, SOAP round trips, bytes on the wire and task queue/run
+	# time. Nothing is patched until Enable() is called, so a disabled layer costs
+	# nothing on the hot path.
+
+	_sink = None
+	_originals = {}
+	_local = threading.local()
+
+	def Enable(sink):
+
+		Instrumentation._sink = sink
+		if Instrumentation._originals:
+			return
+
+		for name, function in list(vars(vsphere.Vsphere).items()):
+			if name.startswith('_') or not callable(function):
+				continue
+			Instrumentation._originals[name] = function
+			if inspect.isgeneratorfunction(function):
+				setattr(vsphere.Vsphere, name, Instrumentation._WrapGenerator(name, function))
+			else:
+				setattr(vsphere.Vsphere, name, Instrumentation._WrapMethod(name, function))
+
+		Instrumentation._originals['WaitForTask'] = vsphere.WaitForTask
+		vsphere.WaitForTask = Instrumentation._WrapWaitForTask(vsphere.WaitForTask)
+
+	def Disable():
+
+		Instrumentation._sink = None
+		originals = Instrumentation._originals
+		Instrumentation._originals = {}
+
+		if 'WaitForTask' in originals:
+			vsphere.WaitForTask = originals.pop('WaitForTask')
+		for name, function in originals.items():
+			setattr(vsphere.Vsphere, name, function)
+
+	def IsEnabled():
+
+		return Instrumentation._sink is not None
+
+	def InstrumentStub(si):
+
+		# Wraps the SOAP stub behind a service instance in place, so every managed
+		# object created from it is counted.
+		stub = getattr(si, '_stub', None)
+		stub = getattr(stub, 'soapStub', stub)
+		if stub is None or vars(stub).get('_instrumented'):
+			return si
+
+		invoke_method = stub.InvokeMethod
+
+		def InvokeMethod(*args, **kwargs):
+			frame = Instrumentation._CurrentFrame()
+			if frame is not None:
+				frame.rpc_calls += 1
+			return invoke_method(*args, **kwargs)
+
+		stub.InvokeMethod = InvokeMethod
+
+		if hasattr(stub, 'GetConnection') and hasattr(stub, 'ReturnConnection'):
+			get_connection = stub.GetConnection
+			return_connection = stub.ReturnConnection
+			stub.GetConnection = lambda: _CountingConnection(get_connection())
+			stub.ReturnConnection = lambda conn: return_connection(getattr(conn, '_connection', conn))
+
+		stub._instrumented = True
+
+		return si
+
+	def _CurrentFrame():
+
+		stack = getattr(Instrumentation._local, 'stack', None)
+		if not stack or getattr(Instrumentation._local, 'suspended', False):
+			return None
+		return stack[-1]
+
+	def _WrapMethod(name, function):
+
+		@functools.wraps(function)
+		def Wrapper(*args, **kwargs):
+
+			sink = Instrumentation._sink
+			if sink is None:
+				return function(*args, **kwargs)
+
+			if args:
+				Instrumentation.InstrumentStub(args[0])
+
+			record = CallRecord(name)
+			Instrumentation._Push(record)
+			start = time.perf_counter()
+			try:
+				result = function(*args, **kwargs)
+				if name == 'Connect' and result:
+					Instrumentation.InstrumentStub(result)
+				return result
+			except Exception as e:
+				record.error = type(e).__name__
+				raise
+			finally:
+				record.wall_time = time.perf_counter() - start
+				Instrumentation._Pop(record)
+				sink.Record(record)
+
+		return Wrapper
+
+	def _WrapGenerator(name, function):
+
+		# Only the time spent inside the generator is charged to it; what the
+		# consumer does between items stays with the consumer's own frame.
+		@functools.wraps(function)
+		def Wrapper(*args, **kwargs):
+
+			sink = Instrumentation._sink
+			generator = function(*args, **kwargs)
+			if sink is None:
+				return (yield from generator)
+
+			if args:
+				Instrumentation.InstrumentStub(args[0])
+
+			record = CallRecord(name)
+			try:
+				while True:
+					step = CallRecord(name)
+					Instrumentation._Push(step)
+					start = time.perf_counter()
+					try:
+						item = next(generator)
+					except StopIteration as stop:
+						return stop.value
+					finally:
+						step.wall_time = time.perf_counter() - start
+						Instrumentation._Pop(step)
+						Instrumentation._Add(record, step)
+						record.wall_time += step.wall_time
+					yield item
+			except Exception as e:
+				record.error = type(e).__name__
+				raise
+			finally:
+				generator.close()
+				sink.Record(record)
+
+		return Wrapper
+
+	def _Push(record):
+
+		stack = getattr(Instrumentation._local, 'stack', None)
+		if stack is None:
+			stack = Instrumentation._local.stack = []
+		stack.append(record)
+
+	def _Pop(record):
+
+		stack = Instrumentation._local.stack
+		stack.pop()
+		if stack:
+			Instrumentation._Add(stack[-1], record)
+
+	def _Add(target, record):
+
+		target.rpc_calls += record.rpc_calls
+		target.bytes_sent += record.bytes_sent
+		target.bytes_received += record.bytes_received
+		target.tasks += record.tasks
+		target.task_queue_time += record.task_queue_time
+		target.task_run_time += record.task_run_time
+
+	def _WrapWaitForTask(wait_for_task):
+
+		@functools.wraps(wait_for_task)
+		def Wrapper(task, *args, **kwargs):
+
+			try:
+				return wait_for_task(task, *args, **kwargs)
+			finally:
+				frame = Instrumentation._CurrentFrame()
+				if frame is not None:
+					Instrumentation._RecordTaskTimes(frame, task)
+
+		return Wrapper
+
+	def _RecordTaskTimes(frame, task):
+
+		# Reading task.info is bookkeeping, not part of the measured workload.
+		Instrumentation._local.suspended = True
+		try:
+			info = task.info
+			frame.tasks += 1
+			if isinstance(info.startTime, datetime.datetime) and isinstance(info.queueTime, datetime.datetime):
+				frame.task_queue_time += (info.startTime - info.queueTime).total_seconds()
+			if isinstance(info.completeTime, datetime.datetime) and isinstance(info.startTime, datetime.datetime):
+				frame.task_run_time += (info.completeTime - info.startTime).total_seconds()
+		except Exception:
+			pass
+		finally:
+			Instrumentation._local.suspended = False
@@ -0,0 +1,159 @@
+import weakref
+import sqlite3
+import threading
+import contextlib
+
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class InventoryCache:
+
+	# Name -> MoRef index of one vCenter, persisted in a SQLite file so a new
+	# worker can answer lookups as soon as it starts instead of scanning the
+	# inventory first. The file stores the key of the vCenter's latest event as
+	# a version token: Reconcile() compares it with the live one and only
+	# rescans when the inventory may have changed since the file was written.
+	# Only sessions attached to the cache (Attach() or Reconcile()) are served
+	# from it or fill it, so a session to another vCenter in the same process
+	# never gets this vCenter's MoRefs.
+
+	TYPES = (
+		vim.VirtualMachine,
+		vim.ClusterComputeResource,
+		vim.HostSystem,
+		vim.Datastore,
+		vim.dvs.DistributedVirtualPortgroup
+	)
+
+	def __init__(self, path, vcenter, types=None):
+
+		self.path = path
+		self.vcenter = vcenter
+		self.types = {vimtype._wsdlName: vimtype for vimtype in types or InventoryCache.TYPES}
+
+		self.lock = threading.Lock()
+		self.names = {}
+		self.version = None
+		self.stubs = weakref.WeakSet()
+
+		with self._Connect() as connection, connection:
+			connection.execute(
+				'CREATE TABLE IF NOT EXISTS inventory ('
+				'vcenter TEXT, type TEXT, moid TEXT, name TEXT, PRIMARY KEY (vcenter, type, moid)'
+				') WITHOUT ROWID'
+			)
+			connection.execute('CREATE TABLE IF NOT EXISTS versions (vcenter TEXT PRIMARY KEY, version TEXT)')
+
+	def Load(self):
+
+		# Reads the snapshot from disk, no vCenter call. Returns False when the
+		# file holds nothing for this vCenter yet.
+		with self._Connect() as connection, connection:
+			row = connection.execute('SELECT version FROM versions WHERE vcenter = ?', (self.vcenter,)).fetchone()
+			rows = connection.execute('SELECT type, moid, name FROM inventory WHERE vcenter = ?', (self.vcenter,)).fetchall()
+
+		with self.lock:
+			self.names = {(type_name, name.lower()): moid for type_name, moid, name in rows}
+			self.version = row[0] if row else None
+
+		return row is not None
+
+	def Save(self):
+
+		with self.lock:
+			rows = [(self.vcenter, type_name, moid, name) for (type_name, name), moid in self.names.items()]
+			version = self.version
+
+		with self._Connect() as connection, connection:
+			connection.execute('DELETE FROM inventory WHERE vcenter = ?', (self.vcenter,))
+			connection.executemany('INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?)', rows)
+			connection.execute('INSERT OR REPLACE INTO versions VALUES (?, ?)', (self.vcenter, version))
+
+	def Attach(self, si):
+
+		# `si` is a session to this cache's vCenter, e.g. a new login after the
+		# previous session expired.
+		with self.lock:
+			self.stubs.add(si._stub)
+
+		return self
+
+	def Serves(self, si):
+
+		with self.lock:
+			return si._stub in self.stubs
+
+	def Reconcile(self, si):
+
+		# One call when nothing changed; otherwise a names-only bulk rescan of
+		# every indexed type. The token is read before the scan so a change made
+		# during it shows up as a new version next time. Returns True if rescanned.
+		self.Attach(si)
+		version = Vsphere.GetLatestEventKey(si)
+		if version is not None and version == self.version:
+			return False
+
+		names = {}
+		for type_name, vimtype in self.types.items():
+			for ref, props in Vsphere.IterObjectProperties(si, vimtype, ['name']):
+				names[(type_name, props['name'].lower())] = ref._moId
+
+		with self.lock:
+			self.names = names
+			self.version = version
+		self.Save()
+
+		return True
+
+	def MoId(self, vimtype, name):
+
+		with self.lock:
+			return self.names.get((vimtype._wsdlName, name.lower()))
+
+	def Get(self, si, vimtype, name, verify=True):
+
+		# MoRef for `name` bound to `si`, or None. With `verify`, the cached
+		# object's name is read back (one call) and an entry for an object that
+		# was deleted or renamed since is dropped rather than returned.
+		if not self.Serves(si):
+			return None
+
+		moid = self.MoId(vimtype, name)
+		if moid is None:
+			return None
+
+		ref = vimtype(moid, si._stub)
+		if not verify:
+			return ref
+
+		try:
+			current_name = ref.name
+		except vmodl.fault.ManagedObjectNotFound:
+			current_name = None
+
+		if current_name is None or current_name.lower() != name.lower():
+			self.Discard(vimtype, name)
+			return None
+
+		return ref
+
+	def Put(self, si, vimtype, name, ref):
+
+		if vimtype._wsdlName in self.types and self.Serves(si):
+			with self.lock:
+				self.names[(vimtype._wsdlName, name.lower())] = ref._moId
+
+	def Discard(self, vimtype, name):
+
+		with self.lock:
+			self.names.pop((vimtype._wsdlName, name.lower()), None)
+
+	def __len__(self):
+
+		return len(self.names)
+
+	def _Connect(self):
+
+		return contextlib.closing(sqlite3.connect(self.path, timeout=30))
@@ -0,0 +1,333 @@
+import json
+import time
+import sqlite3
+import datetime
+import threading
+import contextlib
+import collections
+import concurrent.futures
+
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes import vsphere
+from cgi_testing.classes.coalesce import Flight
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class JournalEntry:
+
+	__slots__ = ('seq', 'workflow', 'vm_name', 'step', 'state', 'task', 'detail', 'time')
+
+	def __init__(self, seq, workflow, vm_name, step, state, task, detail, time):
+
+		self.seq = seq
+		self.workflow = workflow
+		self.vm_name = vm_name
+		self.step = step
+		self.state = state
+		self.task = task
+		self.detail = detail
+		self.time = time
+
+
+class Journal:
+
+	# Append-only log of workflow steps in a SQLite file. Appends from every
+	# thread are queued and written by one writer thread, which commits whatever
+	# queued up while the previous commit was running in a single transaction
+	# (group commit): many workers pay for one fsync, and Append() still only
+	# returns once its entry is on disk.
+
+	INTENT = 'intent'
+	SUBMITTED = 'submitted'
+	DONE = 'done'
+	FAILED = 'failed'
+
+	def __init__(self, path, clock=time.time):
+
+		self.path = path
+		self.clock = clock
+		self.lock = threading.Condition()
+		self.pending = []
+		self.committed = Flight()
+		self.closed = False
+		self.commits = 0
+
+		with self._Connect() as connection, connection:
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute(
+				'CREATE TABLE IF NOT EXISTS journal ('
+				'seq INTEGER PRIMARY KEY AUTOINCREMENT, workflow TEXT, vm TEXT, step INTEGER, '
+				'state TEXT, task TEXT, detail TEXT, time REAL'
+				')'
+			)
+			connection.execute('CREATE INDEX IF NOT EXISTS journal_workflow ON journal (workflow, vm, step)')
+
+		self.writer = threading.Thread(target=self._Write, name='vsphere-journal', daemon=True)
+		self.writer.start()
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.Close()
+
+	def Append(self, workflow, vm_name, step, state, task=None, detail=None, wait=True):
+
+		entry = (workflow, vm_name, step, state, task, json.dumps(detail) if detail is not None else None, self.clock())
+		with self.lock:
+			if self.closed:
+				raise RuntimeError(f'Journal {self.path} is closed')
+			self.pending.append(entry)
+			committed = self.committed
+			self.lock.notify_all()
+
+		if wait:
+			committed.Wait()
+
+	def Flush(self):
+
+		with self.lock:
+			committed = self.committed if self.pending else None
+		if committed is not None:
+			committed.Wait()
+
+	def Close(self):
+
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+			self.lock.notify_all()
+		self.writer.join()
+
+	def Entries(self, workflow):
+
+		with self._Connect() as connection, connection:
+			rows = connection.execute(
+				'SELECT seq, workflow, vm, step, state, task, detail, time FROM journal WHERE workflow = ? ORDER BY seq',
+				(workflow,)
+			).fetchall()
+
+		return [
+			JournalEntry(seq, name, vm_name, step, state, task, json.loads(detail) if detail is not None else None, when)
+			for seq, name, vm_name, step, state, task, detail, when in rows
+		]
+
+	def Progress(self, workflow):
+
+		# {vm name: {step: [entries of the latest attempt]}}; an attempt starts
+		# with an INTENT entry.
+		progress = collections.defaultdict(dict)
+		for entry in self.Entries(workflow):
+			attempts = progress[entry.vm_name]
+			if entry.state == Journal.INTENT or entry.step not in attempts:
+				attempts[entry.step] = []
+			attempts[entry.step].append(entry)
+
+		return dict(progress)
+
+	def _Write(self):
+
+		with self._Connect() as connection:
+			while True:
+				with self.lock:
+					while not self.pending and not self.closed:
+						self.lock.wait()
+					if not self.pending:
+						return
+					entries, self.pending = self.pending, []
+					committed, self.committed = self.committed, Flight()
+
+				try:
+					with connection:
+						connection.executemany(
+							'INSERT INTO journal (workflow, vm, step, state, task, detail, time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+							entries
+						)
+					self.commits += 1
+				except Exception as e:
+					committed.error = e
+				committed.done.set()
+
+	def _Connect(self):
+
+		return contextlib.closing(sqlite3.connect(self.path, timeout=30))
+
+
+class Step:
+
+	__slots__ = ('method', 'args', 'kwargs', 'resume')
+
+	def __init__(self, method, *args, resume=None, **kwargs):
+
+		# `method` names a Vsphere method called as method(si, vm_name, *args,
+		# **kwargs). `resume(si, vm_name, intent, *args, **kwargs)` tells whether
+		# an interrupted attempt took effect, finishing what it left undone; it
+		# defaults to Workflow.RESUMERS[method].
+		self.method = method
+		self.args = args
+		self.kwargs = kwargs
+		self.resume = resume
+
+
+class Workflow:
+
+	# Runs the same chain of steps on many VMs, journaling each step's intent,
+	# the MoRef of every task it submits and its outcome. Run() again with the
+	# same journal and name after a crash and every VM continues from its first
+	# incomplete step: a step whose task is still running is waited for, not
+	# submitted again, and an interrupted step is verified before it is rerun.
+
+	DONE = 'done'
+	FAILED = 'failed'
+
+	def __init__(self, si, journal, name, steps, max_workers=16, scheduler=None):
+
+		self.si = si
+		self.journal = journal
+		self.name = name
+		self.steps = list(steps)
+		self.max_workers = max_workers
+		self.scheduler = scheduler
+
+	def Run(self, vm_names):
+
+		# Returns {vm name: DONE or FAILED}. A VM stops at its first failed step.
+		progress = self.journal.Progress(self.name)
+
+		def Run(si, vm_name):
+			return self._RunVM(vm_name, progress.get(vm_name, {}))
+
+		if self.scheduler is not None:
+			return self.scheduler.Map(Run, list(vm_names))
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='vsphere-workflow') as executor:
+			return dict(zip(vm_names, executor.map(lambda vm_name: Run(self.si, vm_name), vm_names)))
+
+	def _RunVM(self, vm_name, attempts):
+
+		for index, step in enumerate(self.steps):
+			entries = attempts.get(index)
+			if entries and entries[-1].state == Journal.DONE:
+				continue
+			interrupted = bool(entries) and entries[-1].state != Journal.FAILED
+			if interrupted and self._Resume(vm_name, step, entries):
+				self.journal.Append(self.name, vm_name, index, Journal.DONE, detail={'resumed': True})
+				continue
+			if not self._RunStep(vm_name, index, step, entries[0] if interrupted else None):
+				return Workflow.FAILED
+
+		return Workflow.DONE
+
+	def _RunStep(self, vm_name, index, step, interrupted=None):
+
+		# A rerun keeps what the interrupted attempt captured before it changed
+		# anything, e.g. the power state ResizeVM has to restore.
+		capture = Workflow.CAPTURES.get(step.method)
+		error = None
+		if interrupted is not None:
+			detail = interrupted.detail
+		else:
+			try:
+				detail = capture(self.si, vm_name) if capture is not None else None
+			except Exception as e:
+				detail = None
+				error = repr(e)
+		self.journal.Append(self.name, vm_name, index, Journal.INTENT, detail=detail)
+
+		def Submitted(task):
+			self.journal.Append(self.name, vm_name, index, Journal.SUBMITTED, task=task._moId)
+
+		# A failed capture changed nothing yet; this VM fails, the others carry on.
+		succeeded = False
+		if error is None:
+			try:
+				with Vsphere.ObserveTasks(Submitted):
+					succeeded = getattr(Vsphere, step.method)(self.si, vm_name, *step.args, **step.kwargs)
+					if succeeded and interrupted is not None and detail is not None:
+						succeeded = self._Resume(vm_name, step, [interrupted])
+			except Exception as e:
+				succeeded = False
+				error = repr(e)
+
+		state = Journal.DONE if succeeded else Journal.FAILED
+		self.journal.Append(self.name, vm_name, index, state, detail={'error': error} if error else None)
+
+		return bool(succeeded)
+
+	def _Resume(self, vm_name, step, entries):
+
+		# The previous run stopped inside this step. Waits for its last task if
+		# vCenter still runs it, then decides whether the step took effect.
+		intent = entries[0]
+		submitted = [entry for entry in entries if entry.state == Journal.SUBMITTED]
+		task_state = None
+		if submitted:
+			task = vim.Task(submitted[-1].task, self.si._stub)
+			try:
+				if task.info.state in (vim.TaskInfo.State.queued, vim.TaskInfo.State.running):
+					vsphere.WaitForTask(task)
+				task_state = task.info.state
+			except vmodl.fault.ManagedObjectNotFound:
+				# vCenter forgets finished tasks after a while.
+				task_state = None
+			except vmodl.MethodFault as e:
+				task_state = vim.TaskInfo.State.error
+
+		resume = step.resume or Workflow.RESUMERS.get(step.method)
+		if resume is not None:
+			try:
+				return bool(resume(self.si, vm_name, intent, *step.args, **step.kwargs))
+			except Exception as e:
+				return False
+
+		return task_state == vim.TaskInfo.State.success
+
+	def _HasSnapshot(si, vm_name, snapshot_name):
+
+		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
+
+		return bool(vm) and Vsphere._FindSnapshot(vm, snapshot_name) is not None
+
+	def _Resized(si, vm_name, intent, new_cpu_count=None, new_ram_gb=None):
+
+		# ResizeVM may have powered the VM off and stopped before powering it
+		# back on; that last part is done here.
+		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
+		hardware = vm.config.hardware
+		if new_cpu_count is not None and hardware.numCPU != int(new_cpu_count):
+			return False
+		if new_ram_gb is not None and hardware.memoryMB != int(new_ram_gb) * 1024:
+			return False
+
+		if (intent.detail or {}).get('power_state') == vim.VirtualMachinePowerState.poweredOn:
+			return Vsphere.PowerOnVM(si, vm_name)
+
+		return True
+
+	def _Rebooted(si, vm_name, intent):
+
+		boot_time = Vsphere.GetObject(si, vim.VirtualMachine, vm_name).runtime.bootTime
+
+		return boot_time is not None and boot_time >= datetime.datetime.fromtimestamp(intent.time, tz=datetime.timezone.utc)
+
+	def _PowerState(si, vm_name):
+
+		# None for a missing VM, whose ResizeVM then fails on its own.
+		meta = Vsphere.GetVmMeta(si, vm_name)
+
+		return {'power_state': meta['PowerState']} if meta else None
+
+	CAPTURES = {
+		'ResizeVM': lambda si, vm_name: Workflow._PowerState(si, vm_name)
+	}
+
+	RESUMERS = {
+		'SnapshotVM': lambda si, vm_name, intent, snapshot_name, *args, **kwargs: Workflow._HasSnapshot(si, vm_name, snapshot_name),
+		'DeleteVMSnapshot': lambda si, vm_name, intent, snapshot_name: not Workflow._HasSnapshot(si, vm_name, snapshot_name),
+		'ResizeVM': lambda si, vm_name, intent, *args, **kwargs: Workflow._Resized(si, vm_name, intent, *args, **kwargs),
+		'RebootVM': lambda si, vm_name, intent: Workflow._Rebooted(si, vm_name, intent)
+	}
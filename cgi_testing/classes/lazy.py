@@ -0,0 +1,62 @@
+import importlib
+
+
+class LazyImport:
+
+	# Stand-in for a module, or an attribute of one, that is only imported on
+	# first use. Given the importing module's globals(), the stand-in replaces
+	# itself there with the real object once resolved, so later lookups cost
+	# nothing. Attribute writes go to the real object, which keeps
+	# unittest.mock.patch('package.module.requests.put') working.
+
+	__slots__ = ('_module_name', '_attribute', '_namespace', '_target')
+
+	def __init__(self, module_name, attribute=None, namespace=None):
+
+		object.__setattr__(self, '_module_name', module_name)
+		object.__setattr__(self, '_attribute', attribute)
+		object.__setattr__(self, '_namespace', namespace)
+		object.__setattr__(self, '_target', None)
+
+	def Resolve(self):
+
+		target = object.__getattribute__(self, '_target')
+		if target is not None:
+			return target
+
+		module_name = object.__getattribute__(self, '_module_name')
+		attribute = object.__getattribute__(self, '_attribute')
+		target = importlib.import_module(module_name)
+		if attribute:
+			target = getattr(target, attribute)
+		object.__setattr__(self, '_target', target)
+
+		namespace = object.__getattribute__(self, '_namespace')
+		binding = attribute or module_name.rpartition('.')[2]
+		if namespace is not None and namespace.get(binding) is self:
+			namespace[binding] = target
+
+		return target
+
+	def __getattr__(self, name):
+
+		return getattr(LazyImport.Resolve(self), name)
+
+	def __setattr__(self, name, value):
+
+		setattr(LazyImport.Resolve(self), name, value)
+
+	def __delattr__(self, name):
+
+		delattr(LazyImport.Resolve(self), name)
+
+	def __call__(self, *args, **kwargs):
+
+		return LazyImport.Resolve(self)(*args, **kwargs)
+
+	def __repr__(self):
+
+		module_name = object.__getattribute__(self, '_module_name')
+		attribute = object.__getattribute__(self, '_attribute')
+
+		return f'<lazy {module_name}{"." + attribute if attribute else ""}>'
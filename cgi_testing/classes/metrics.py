@@ -0,0 +1,198 @@
+import math
+import array
+import bisect
+import datetime
+import threading
+
+from pyVmomi import vim
+
+from cgi_testing.classes.lazy import LazyImport
+from cgi_testing.classes.vsphere import Vsphere
+
+# Optional, only needed for PerfResult.ToNumpy().
+numpy = LazyImport('numpy', namespace=globals())
+
+
+class PerfResult:
+
+	# Samples of several counters for many entities, stored as one flat
+	# array('d') in entity, counter, sample order. Missing samples are NaN.
+	# The array supports the buffer protocol, so numpy.frombuffer() wraps it
+	# without a copy.
+
+	def __init__(self, entities, names, counters, units, timestamps):
+
+		self.entities = entities
+		self.names = names
+		self.counters = counters
+		self.units = units
+		self.timestamps = array.array('q', timestamps)
+		self.values = array.array('d', [math.nan]) * (len(entities) * len(counters) * len(timestamps))
+
+	@property
+	def shape(self):
+
+		return len(self.entities), len(self.counters), len(self.timestamps)
+
+	def Series(self, entity, counter):
+
+		# `entity` is an index into `entities` or the key Latest() uses for it:
+		# its name when names are known, its moid otherwise.
+		entity_index = self._EntityIndex(entity) if isinstance(entity, str) else entity
+		samples = len(self.timestamps)
+		start = (entity_index * len(self.counters) + self._CounterIndex(counter)) * samples
+
+		return self.values[start:start + samples]
+
+	def Latest(self, counter):
+
+		# {entity name (or moid): newest sample that is not NaN}.
+		latest = {}
+		for index, entity in enumerate(self.entities):
+			values = [value for value in self.Series(index, counter) if not math.isnan(value)]
+			latest[self.names[index] if self.names else entity._moId] = values[-1] if values else None
+
+		return latest
+
+	def ToNumpy(self):
+
+		return numpy.frombuffer(self.values, dtype=numpy.float64).reshape(self.shape)
+
+	def _EntityIndex(self, entity):
+
+		keys = self.names if self.names else [ref._moId for ref in self.entities]
+		try:
+			return keys.index(entity)
+		except ValueError as e:
+			raise ValueError(f'Entity "{entity}" was not queried') from e
+
+	def _CounterIndex(self, counter):
+
+		for index, name in enumerate(self.counters):
+			if counter in (name, name.rpartition('.')[0]):
+				return index
+
+		raise ValueError(f'Counter "{counter}" was not queried')
+
+
+class PerformanceMetrics:
+
+	# Batched reads from the PerformanceManager. Counter names such as
+	# 'cpu.usage.average' are resolved to ids once per instance, and one
+	# QueryPerf call covers up to `batch_size` entities. Historical intervals
+	# are capped by vCenter at `max_query_metrics` entity/counter pairs per
+	# call (vpxd.stats.maxQueryMetrics, 64 by default), realtime ones are not.
+
+	REALTIME_INTERVAL = 20
+
+	def __init__(self, si, batch_size=1000, max_query_metrics=64):
+
+		self.si = si
+		self.batch_size = batch_size
+		self.max_query_metrics = max_query_metrics
+		self.lock = threading.Lock()
+		self.counter_ids = None
+		self.counter_units = None
+
+	def CounterId(self, counter, rollup='average'):
+
+		# Accepts 'group.name.rollup', or 'group.name' with `rollup`.
+		with self.lock:
+			if self.counter_ids is None:
+				self._LoadCounters()
+
+		name = counter if counter.count('.') == 2 else f'{counter}.{rollup}'
+		if name not in self.counter_ids:
+			raise ValueError(f'Unknown performance counter "{counter}"')
+
+		return self.counter_ids[name]
+
+	def QueryVMs(self, counters, **kwargs):
+
+		return self.Query(vim.VirtualMachine, counters, **kwargs)
+
+	def QueryHosts(self, counters, **kwargs):
+
+		return self.Query(vim.HostSystem, counters, **kwargs)
+
+	def Query(self, entities, counters, interval=REALTIME_INTERVAL, start=None, end=None, max_samples=None, rollup='average'):
+
+		# `entities` is a list of managed objects or a managed object type, in
+		# which case every object of that type is queried. Without `start` the
+		# newest `max_samples` samples (default 1) are returned.
+		names = None
+		if isinstance(entities, type):
+			pairs = list(Vsphere.IterObjectProperties(self.si, entities, ['name']))
+			entities = [entity for entity, _ in pairs]
+			names = [props.get('name') for _, props in pairs]
+
+		counter_ids = [self.CounterId(counter, rollup) for counter in counters]
+		metric_ids = [vim.PerformanceManager.MetricId(counterId=counter_id, instance='') for counter_id in counter_ids]
+		if start is None and max_samples is None:
+			max_samples = 1
+
+		batch_size = self.batch_size
+		if interval != PerformanceMetrics.REALTIME_INTERVAL:
+			batch_size = max(1, min(batch_size, self.max_query_metrics // max(1, len(metric_ids))))
+
+		rows = {}
+		timestamps = set()
+		perf_manager = self.si.content.perfManager
+		for offset in range(0, len(entities), batch_size):
+			specs = [
+				vim.PerformanceManager.QuerySpec(
+					entity=entity,
+					metricId=metric_ids,
+					intervalId=interval,
+					startTime=start,
+					endTime=end,
+					maxSample=max_samples,
+					format=vim.PerformanceManager.Format.csv
+				)
+				for entity in entities[offset:offset + batch_size]
+			]
+			for entity_metric in perf_manager.QueryPerf(querySpec=specs) or []:
+				times = PerformanceMetrics._ParseSampleInfo(entity_metric.sampleInfoCSV)
+				timestamps.update(times)
+				rows[entity_metric.entity] = (times, entity_metric.value or [])
+
+		result = PerfResult(
+			entities,
+			names,
+			[counter if counter.count('.') == 2 else f'{counter}.{rollup}' for counter in counters],
+			[self.counter_units[counter_id] for counter_id in counter_ids],
+			sorted(timestamps)
+		)
+		positions = {counter_id: index for index, counter_id in enumerate(counter_ids)}
+		samples = len(result.timestamps)
+		for entity_index, entity in enumerate(entities):
+			if entity not in rows:
+				continue
+			times, series = rows[entity]
+			columns = [bisect.bisect_left(result.timestamps, when) for when in times]
+			for metric_series in series:
+				base = (entity_index * len(counter_ids) + positions[metric_series.id.counterId]) * samples
+				for column, value in zip(columns, metric_series.value.split(',') if metric_series.value else []):
+					# vCenter reports a sample it has no data for as -1.
+					if value != '-1':
+						result.values[base + column] = float(value)
+
+		return result
+
+	def _LoadCounters(self):
+
+		perf_counters = Vsphere.GetObjectProperties(self.si, vim.PerformanceManager, ['perfCounter'], [self.si.content.perfManager])
+		self.counter_ids = {}
+		self.counter_units = {}
+		for props in perf_counters.values():
+			for counter in props.get('perfCounter') or []:
+				name = f'{counter.groupInfo.key}.{counter.nameInfo.key}.{counter.rollupType}'
+				self.counter_ids[name] = counter.key
+				self.counter_units[counter.key] = counter.unitInfo.key
+
+	def _ParseSampleInfo(sample_info):
+
+		# 'interval,timestamp,interval,timestamp,...' -> epoch seconds.
+		fields = sample_info.split(',') if sample_info else []
+
+		return [int(datetime.datetime.fromisoformat(timestamp).timestamp()) for timestamp in fields[1::2]]
@@ -0,0 +1,237 @@
+import math
+import time
+import concurrent.futures
+
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class Readiness:
+
+	# Conditions a guest must meet before it counts as back in service.
+
+	PROPERTIES = (
+		'name',
+		'runtime.powerState',
+		'runtime.bootTime',
+		'guest.toolsRunningStatus',
+		'guestHeartbeatStatus',
+		'guest.ipAddress'
+	)
+
+	def __init__(self, tools_running=True, heartbeat=True, ip_address=True):
+
+		self.tools_running = tools_running
+		self.heartbeat = heartbeat
+		self.ip_address = ip_address
+
+	def IsReady(self, props):
+
+		if props.get('runtime.powerState') != vim.VirtualMachinePowerState.poweredOn:
+			return False
+		if self.tools_running and props.get('guest.toolsRunningStatus') != 'guestToolsRunning':
+			return False
+		if self.heartbeat and props.get('guestHeartbeatStatus') != 'green':
+			return False
+		if self.ip_address and not props.get('guest.ipAddress'):
+			return False
+
+		return True
+
+
+class GuestWatcher:
+
+	# Follows the readiness properties of many VMs through a single property
+	# collector update stream instead of polling each VM. The collector is a
+	# private one, so other watchers in the same session do not see its filter.
+
+	def __init__(self, si, vms, readiness=None, poll_interval=1.0):
+
+		self.readiness = readiness or Readiness()
+		self.poll_interval = poll_interval
+		self.states = {vm: {} for vm in vms}
+		self.version = ''
+
+		self.collector = si.content.propertyCollector.CreatePropertyCollector()
+		self.collector.CreateFilter(
+			vmodl.query.PropertyCollector.FilterSpec(
+				objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm) for vm in vms],
+				propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=list(Readiness.PROPERTIES))]
+			),
+			True
+		)
+		self.Update(0)
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.Close()
+
+	def Close(self):
+
+		if self.collector is not None:
+			self.collector.DestroyPropertyCollector()
+			self.collector = None
+
+	def Update(self, max_wait=None):
+
+		# Applies the next batch of changes, waiting up to `max_wait` seconds for
+		# one. Returns the VMs that changed.
+		options = vmodl.query.PropertyCollector.WaitOptions(
+			maxWaitSeconds=math.ceil(self.poll_interval if max_wait is None else max(0, max_wait))
+		)
+		update = self.collector.WaitForUpdatesEx(self.version, options)
+		if update is None:
+			return []
+
+		self.version = update.version
+		changed = []
+		for filter_update in update.filterSet or []:
+			for object_update in filter_update.objectSet or []:
+				state = self.states.setdefault(object_update.obj, {})
+				for change in object_update.changeSet or []:
+					state[change.name] = change.val if change.op in ('add', 'assign') else None
+				changed.append(object_update.obj)
+
+		return changed
+
+	def IsReady(self, vm):
+
+		return self.readiness.IsReady(self.states[vm])
+
+	def Name(self, vm):
+
+		return self.states[vm].get('name')
+
+	def Wait(self, vms=None, timeout=600, clock=time.monotonic):
+
+		# Blocks until every VM in `vms` is ready or `timeout` passes. Returns
+		# {vm name: ready}.
+		vms = list(self.states) if vms is None else vms
+		deadline = clock() + timeout
+		while not all(self.IsReady(vm) for vm in vms):
+			remaining = deadline - clock()
+			if remaining <= 0:
+				break
+			self.Update(min(self.poll_interval, remaining))
+
+		return {self.Name(vm): self.IsReady(vm) for vm in vms}
+
+
+class RollingRestart:
+
+	# Restarts VMs while keeping at most `max_unavailable` of them out of
+	# service. The next VM starts as soon as a restarted one passes readiness,
+	# and the rollout stops starting new VMs after `max_failures` failures.
+	# A guest counts as back only after it was seen going down or its bootTime
+	# moved, so readiness left over from before the reboot is not mistaken
+	# for the restarted guest.
+
+	READY = 'ready'
+	FAILED = 'failed'
+	TIMEOUT = 'timeout'
+	SKIPPED = 'skipped'
+
+	def __init__(
+			self,
+			si,
+			readiness=None,
+			max_unavailable=1,
+			max_failures=0,
+			timeout=600,
+			poll_interval=1.0,
+			clock=time.monotonic
+	):
+
+		self.si = si
+		self.readiness = readiness or Readiness()
+		self.max_unavailable = max_unavailable
+		self.max_failures = max_failures
+		self.timeout = timeout
+		self.poll_interval = poll_interval
+		self.clock = clock
+
+	def Run(self, vm_names):
+
+		# Returns {vm name: READY | FAILED | TIMEOUT | SKIPPED}, in rollout order.
+		wanted = set(vm_names)
+		refs = {
+			props['name']: vm
+			for vm, props in Vsphere.IterObjectProperties(self.si, vim.VirtualMachine, ['name'])
+			if props['name'] in wanted
+		}
+		names = {vm: vm_name for vm_name, vm in refs.items()}
+		results = {vm_name: RollingRestart.FAILED for vm_name in vm_names if vm_name not in refs}
+		pending = [refs[vm_name] for vm_name in vm_names if vm_name in refs]
+		restarting = {}
+		failures = len(results)
+
+		executor = concurrent.futures.ThreadPoolExecutor(
+			max_workers=max(1, self.max_unavailable),
+			thread_name_prefix='vsphere-restart'
+		)
+		with executor, GuestWatcher(self.si, pending, self.readiness, self.poll_interval) as watcher:
+			while pending or restarting:
+				while pending and len(restarting) < self.max_unavailable and failures <= self.max_failures:
+					vm = pending.pop(0)
+					state = watcher.states[vm]
+					restarting[vm] = {
+						'boot_time': state.get('runtime.bootTime'),
+						'was_ready': watcher.IsReady(vm),
+						'went_down': False,
+						'deadline': self.clock() + self.timeout,
+						'future': executor.submit(RollingRestart._Restart, vm, state.get('runtime.powerState'))
+					}
+				if not restarting:
+					break
+
+				for vm, restart in list(restarting.items()):
+					result = self._Check(watcher, vm, restart)
+					if result is not None:
+						del restarting[vm]
+						results[names[vm]] = result
+						failures += result != RollingRestart.READY
+
+				if restarting:
+					watcher.Update(min(self.poll_interval, max(0, min(r['deadline'] for r in restarting.values()) - self.clock())))
+
+			for vm in pending:
+				results[names[vm]] = RollingRestart.SKIPPED
+
+		return {vm_name: results[vm_name] for vm_name in vm_names}
+
+	def _Check(self, watcher, vm, restart):
+
+		future = restart['future']
+		if future.done() and (future.exception() is not None or future.result() is False):
+			return RollingRestart.FAILED
+
+		state = watcher.states[vm]
+		if not watcher.IsReady(vm):
+			# A guest that was not ready before the restart only counts as
+			# restarted once its bootTime moves.
+			if restart['was_ready']:
+				restart['went_down'] = True
+		elif future.done() and (restart['went_down'] or state.get('runtime.bootTime') != restart['boot_time']):
+			return RollingRestart.READY
+
+		if self.clock() >= restart['deadline']:
+			return RollingRestart.TIMEOUT
+
+		return None
+
+	def _Restart(vm, power_state):
+
+		if power_state != vim.VirtualMachinePowerState.poweredOn:
+			return Vsphere._ChangeVMPowerState(vm, vim.VirtualMachinePowerState.poweredOn, vm.PowerOn)
+
+		# A guest reboot needs VMware Tools; without them the VM is reset instead.
+		try:
+			vm.RebootGuest()
+			return True
+		except vmodl.MethodFault:
+			return Vsphere._ExecuteTask(vm.ResetVM_Task)
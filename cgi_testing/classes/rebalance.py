@@ -0,0 +1,277 @@
+import threading
+import collections
+import concurrent.futures
+
+from pyVmomi import vim
+
+from cgi_testing.classes.retry import Retry
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class HostLoad:
+
+	__slots__ = ('ref', 'name', 'cluster', 'cpu_capacity', 'memory_capacity', 'cpu', 'memory', 'vms')
+
+	def __init__(self, ref, name, cluster, cpu_capacity, memory_capacity):
+
+		self.ref = ref
+		self.name = name
+		self.cluster = cluster
+		self.cpu_capacity = cpu_capacity
+		self.memory_capacity = memory_capacity
+		self.cpu = 0
+		self.memory = 0
+		self.vms = []
+
+	def Utilization(self, cpu=0, memory=0):
+
+		# The busier of the two resources, as a fraction of capacity.
+		return max(
+			(self.cpu + cpu) / (self.cpu_capacity or 1),
+			(self.memory + memory) / (self.memory_capacity or 1)
+		)
+
+
+class Migration:
+
+	__slots__ = ('vm_name', 'vm', 'source', 'target', 'cpu', 'memory')
+
+	def __init__(self, vm_name, vm, source, target, cpu, memory):
+
+		self.vm_name = vm_name
+		self.vm = vm
+		self.source = source
+		self.target = target
+		self.cpu = cpu
+		self.memory = memory
+
+	def ToDict(self):
+
+		return {
+			'VM': self.vm_name,
+			'Source': self.source.name,
+			'Target': self.target.name,
+			'CPU': self.cpu,
+			'Memory': self.memory
+		}
+
+
+class RebalancePlan:
+
+	def __init__(self, hosts, migrations, unresolved, before):
+
+		self.hosts = hosts
+		self.migrations = migrations
+		# Hosts still above the target once every planned migration is done.
+		self.unresolved = unresolved
+		self.before = before
+
+	def After(self):
+
+		return {host.name: host.Utilization() for host in self.hosts}
+
+	def ToDict(self):
+
+		return {
+			'Migrations': [migration.ToDict() for migration in self.migrations],
+			'Before': dict(self.before),
+			'After': self.After(),
+			'Unresolved': [host.name for host in self.unresolved]
+		}
+
+
+class Rebalancer:
+
+	# Plans vMotions that bring every host of a cluster under
+	# `target_utilization` (CPU and memory demand over capacity) and runs them.
+	# Host and VM usage come from two bulk property calls. The planner is
+	# greedy: the hottest host first gives up the smallest VM that gets it under
+	# the target, or else its largest one, to the coolest host that stays under
+	# the target with it. Each step costs O(VMs on the host x hosts).
+
+	HOST_PROPERTIES = (
+		'name',
+		'parent',
+		'summary.hardware.cpuMhz',
+		'summary.hardware.numCpuCores',
+		'summary.hardware.memorySize',
+		'runtime.connectionState',
+		'runtime.inMaintenanceMode'
+	)
+	VM_PROPERTIES = (
+		'name',
+		'runtime.host',
+		'runtime.powerState',
+		'summary.quickStats.overallCpuUsage',
+		'summary.quickStats.hostMemoryUsage'
+	)
+
+	def __init__(self, si, target_utilization=0.8, max_per_host=2, max_total=16, max_migrations=None):
+
+		# With no migration slot, Execute() could never start one.
+		if max_per_host < 1 or max_total < 1:
+			raise ValueError('max_per_host and max_total must be at least 1')
+
+		self.si = si
+		self.target_utilization = target_utilization
+		self.max_per_host = max_per_host
+		self.max_total = max_total
+		self.max_migrations = max_migrations
+
+	def Plan(self, cluster_names=None):
+
+		hosts = self._Hosts(cluster_names)
+		before = {host.name: host.Utilization() for host in hosts.values()}
+		by_cluster = collections.defaultdict(list)
+		for host in hosts.values():
+			by_cluster[host.cluster].append(host)
+
+		migrations = []
+		unresolved = []
+		for cluster_hosts in by_cluster.values():
+			for host in sorted(cluster_hosts, key=lambda host: host.Utilization(), reverse=True):
+				if host.Utilization() <= self.target_utilization:
+					break
+				if not self._Relieve(host, cluster_hosts, migrations):
+					unresolved.append(host)
+
+		return RebalancePlan(list(hosts.values()), migrations, unresolved, before)
+
+	def Run(self, cluster_names=None, dry_run=False):
+
+		# With `dry_run` only the plan is made. Returns (plan, {vm name: bool}).
+		plan = self.Plan(cluster_names)
+		if dry_run:
+			return plan, {}
+
+		return plan, self.Execute(plan.migrations)
+
+	def Execute(self, migrations):
+
+		# Starts a migration only while its source and target host each have
+		# fewer than `max_per_host` migrations running, and fewer than
+		# `max_total` run overall. Waiting migrations do not hold a worker, so
+		# one busy host never blocks migrations between idle ones.
+		condition = threading.Condition()
+		running = collections.Counter()
+		pending = list(migrations)
+		results = {}
+
+		def Migrate(migration):
+			try:
+				results[migration.vm_name] = Rebalancer._Migrate(migration)
+			except Exception as e:
+				results[migration.vm_name] = False
+			finally:
+				with condition:
+					running[migration.source.name] -= 1
+					running[migration.target.name] -= 1
+					running['total'] -= 1
+					condition.notify_all()
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_total, thread_name_prefix='vsphere-rebalance') as executor:
+			with condition:
+				while pending:
+					for migration in list(pending):
+						if running['total'] >= self.max_total:
+							break
+						if running[migration.source.name] >= self.max_per_host or running[migration.target.name] >= self.max_per_host:
+							continue
+						running[migration.source.name] += 1
+						running[migration.target.name] += 1
+						running['total'] += 1
+						pending.remove(migration)
+						executor.submit(Migrate, migration)
+					if pending:
+						condition.wait()
+
+		return results
+
+	def _Hosts(self, cluster_names):
+
+		hosts = {}
+		cluster_filter = None
+		if cluster_names is not None:
+			wanted = {name.lower() for name in cluster_names}
+			cluster_filter = {
+				cluster
+				for cluster, props in Vsphere.GetObjectProperties(self.si, vim.ClusterComputeResource, ['name']).items()
+				if props.get('name', '').lower() in wanted
+			}
+
+		for ref, props in Vsphere.IterObjectProperties(self.si, vim.HostSystem, Rebalancer.HOST_PROPERTIES):
+			if cluster_filter is not None and props.get('parent') not in cluster_filter:
+				continue
+			# Disconnected hosts and hosts in maintenance mode take no VMs.
+			if props.get('runtime.connectionState') != 'connected' or props.get('runtime.inMaintenanceMode'):
+				continue
+			hosts[ref] = HostLoad(
+				ref,
+				props['name'],
+				props.get('parent'),
+				(props.get('summary.hardware.cpuMhz') or 0) * (props.get('summary.hardware.numCpuCores') or 0),
+				(props.get('summary.hardware.memorySize') or 0) // 1024 ** 2
+			)
+
+		for vm, props in Vsphere.IterObjectProperties(self.si, vim.VirtualMachine, Rebalancer.VM_PROPERTIES):
+			host = hosts.get(props.get('runtime.host'))
+			if host is None or props.get('runtime.powerState') != 'poweredOn':
+				continue
+			cpu = props.get('summary.quickStats.overallCpuUsage') or 0
+			memory = props.get('summary.quickStats.hostMemoryUsage') or 0
+			host.cpu += cpu
+			host.memory += memory
+			host.vms.append((props['name'], vm, cpu, memory))
+
+		return hosts
+
+	def _Relieve(self, host, cluster_hosts, migrations):
+
+		# Moves VMs off `host` until it is under the target. False when no VM can
+		# go anywhere without pushing the receiving host over the target.
+		while host.Utilization() > self.target_utilization:
+			if self.max_migrations is not None and len(migrations) >= self.max_migrations:
+				return False
+
+			excess_cpu = host.cpu - self.target_utilization * host.cpu_capacity
+			excess_memory = host.memory - self.target_utilization * host.memory_capacity
+			candidates = sorted(
+				(vm for vm in host.vms if vm[2] or vm[3]),
+				key=lambda vm: vm[2] / (host.cpu_capacity or 1) + vm[3] / (host.memory_capacity or 1)
+			)
+			# Smallest VMs that are enough on their own, then the rest largest first.
+			order = [vm for vm in candidates if vm[2] >= excess_cpu and vm[3] >= excess_memory]
+			order += [vm for vm in reversed(candidates) if vm[2] < excess_cpu or vm[3] < excess_memory]
+
+			for vm_name, vm, cpu, memory in order:
+				targets = [
+					other
+					for other in cluster_hosts
+					if other is not host and other.Utilization(cpu, memory) <= self.target_utilization
+				]
+				if targets:
+					break
+			else:
+				return False
+
+			target = min(targets, key=lambda other: other.Utilization(cpu, memory))
+			host.vms.remove((vm_name, vm, cpu, memory))
+			host.cpu -= cpu
+			host.memory -= memory
+			target.vms.append((vm_name, vm, cpu, memory))
+			target.cpu += cpu
+			target.memory += memory
+			migrations.append(Migration(vm_name, vm, host, target, cpu, memory))
+
+		return True
+
+	def _Migrate(migration):
+
+		# A resend is safe once the VM is found on the target host.
+		with Retry.Idempotent(lambda: migration.vm.runtime.host == migration.target.ref):
+			return Vsphere._ExecuteTask(
+				migration.vm.MigrateVM_Task,
+				pool=None,
+				host=migration.target.ref,
+				priority=vim.VirtualMachine.MovePriority.defaultPriority
+			)
@@ -0,0 +1,339 @@
+import re
+
+from pyVmomi import vim
+
+from cgi_testing.classes.retry import Retry
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class DesiredVM:
+
+	# Desired state of one VM. Every field left as None is not managed.
+	#   disks:      {'Hard disk 2': size_gb}, smaller disks are extended; a missing
+	#               label is added only if it is the label vCenter gives the next disk
+	#   nics:       {adapter number: portgroup name}
+	#   isos:       {drive number: '[datastore] path/file.iso' or '' to eject}
+	#   attributes: {custom attribute name: value}
+
+	__slots__ = ('name', 'cpu', 'ram_gb', 'disks', 'nics', 'isos', 'attributes')
+
+	def __init__(self, name, cpu=None, ram_gb=None, disks=None, nics=None, isos=None, attributes=None):
+
+		self.name = name
+		self.cpu = cpu
+		self.ram_gb = ram_gb
+		self.disks = disks
+		self.nics = nics
+		self.isos = isos
+		self.attributes = attributes
+
+
+class Change:
+
+	__slots__ = ('kind', 'target', 'before', 'after', 'device')
+
+	def __init__(self, kind, target, before, after, device=None):
+
+		self.kind = kind
+		self.target = target
+		self.before = before
+		self.after = after
+		self.device = device
+
+	def ToDict(self):
+
+		return {'kind': self.kind, 'target': self.target, 'before': self.before, 'after': self.after}
+
+	def __str__(self):
+
+		return f'{self.kind} {self.target}: {self.before!r} -> {self.after!r}'
+
+
+class VMPlan:
+
+	__slots__ = ('name', 'vm', 'powered_on', 'changes', 'errors')
+
+	def __init__(self, name, vm, powered_on):
+
+		self.name = name
+		self.vm = vm
+		self.powered_on = powered_on
+		self.changes = []
+		self.errors = []
+
+	def ReconfigureChanges(self):
+
+		return [change for change in self.changes if change.kind != 'attribute']
+
+	def NeedsPowerOff(self):
+
+		# Same rule as ResizeVM: hot removal of CPU or memory is not supported.
+		return self.powered_on and any(
+			change.kind in ('cpu', 'ram_gb') and change.after < change.before
+			for change in self.changes
+		)
+
+	def ToDict(self):
+
+		return {
+			'name': self.name,
+			'changes': [change.ToDict() for change in self.changes],
+			'errors': list(self.errors),
+			'power_off': self.NeedsPowerOff()
+		}
+
+
+class Plan:
+
+	def __init__(self, vms):
+
+		self.vms = vms
+
+	def Changed(self):
+
+		return [vm_plan for vm_plan in self.vms if vm_plan.changes]
+
+	def ToDict(self):
+
+		return {vm_plan.name: vm_plan.ToDict() for vm_plan in self.vms if vm_plan.changes or vm_plan.errors}
+
+	def Format(self):
+
+		lines = []
+		for vm_plan in self.vms:
+			if not vm_plan.changes and not vm_plan.errors:
+				continue
+			lines.append(vm_plan.name + (' (power off required)' if vm_plan.NeedsPowerOff() else ''))
+			lines.extend(f'  {change}' for change in vm_plan.changes)
+			lines.extend(f'  error: {error}' for error in vm_plan.errors)
+
+		unchanged = sum(not vm_plan.changes and not vm_plan.errors for vm_plan in self.vms)
+		lines.append(f'{len(self.Changed())} to change, {unchanged} unchanged')
+
+		return '\n'.join(lines)
+
+
+class Reconciler:
+
+	# Diffs desired VM state against properties fetched in bulk and only touches
+	# VMs that differ: one ReconfigVM_Task carrying every hardware and device
+	# change, plus one setCustomValue per changed attribute (vSphere has no batch
+	# call for custom values).
+
+	VM_PROPERTIES = (
+		'name',
+		'runtime.powerState',
+		'config.hardware.numCPU',
+		'config.hardware.memoryMB',
+		'config.hardware.device',
+		'customValue'
+	)
+
+	def __init__(self, si):
+
+		self.si = si
+
+	def Plan(self, desired_vms):
+
+		desired = {desired_vm.name.lower(): desired_vm for desired_vm in desired_vms}
+		current = {
+			props['name'].lower(): (vm, props)
+			for vm, props in Vsphere.GetObjectProperties(self.si, vim.VirtualMachine, Reconciler.VM_PROPERTIES).items()
+			if props.get('name', '').lower() in desired
+		}
+
+		field_names = {}
+		if any(desired_vm.attributes for desired_vm in desired.values()):
+			field_names = {field.key: field.name for field in self.si.content.customFieldsManager.field}
+
+		portgroups = {}
+		if any(desired_vm.nics for desired_vm in desired.values()):
+			portgroups = {
+				props['name']: props['key']
+				for props in Vsphere.GetObjectProperties(self.si, vim.dvs.DistributedVirtualPortgroup, ['name', 'key']).values()
+			}
+
+		vm_plans = []
+		for name, desired_vm in desired.items():
+			if name not in current:
+				vm_plan = VMPlan(desired_vm.name, None, False)
+				vm_plan.errors.append('VM not found')
+			else:
+				vm, props = current[name]
+				vm_plan = VMPlan(props['name'], vm, props.get('runtime.powerState') == vim.VirtualMachinePowerState.poweredOn)
+				Reconciler._Diff(vm_plan, desired_vm, props, field_names, portgroups)
+			vm_plans.append(vm_plan)
+
+		return Plan(vm_plans)
+
+	def Apply(self, plan, dry_run=False, scheduler=None):
+
+		# Returns {vm name: bool}. With a Scheduler the VMs are reconfigured
+		# concurrently under its host and datastore caps.
+		if not isinstance(plan, Plan):
+			plan = self.Plan(plan)
+
+		vm_plans = {vm_plan.name: vm_plan for vm_plan in plan.Changed()}
+		if dry_run:
+			return {name: True for name in vm_plans}
+
+		if scheduler is not None:
+			return scheduler.Map(lambda si, vm_name: self._ApplyVM(vm_plans[vm_name]), list(vm_plans))
+
+		return {name: self._ApplyVM(vm_plan) for name, vm_plan in vm_plans.items()}
+
+	def _Diff(vm_plan, desired_vm, props, field_names, portgroups):
+
+		changes = vm_plan.changes
+		devices = props.get('config.hardware.device') or []
+
+		if desired_vm.cpu is not None and int(desired_vm.cpu) != props['config.hardware.numCPU']:
+			changes.append(Change('cpu', 'numCPU', props['config.hardware.numCPU'], int(desired_vm.cpu)))
+
+		if desired_vm.ram_gb is not None and int(desired_vm.ram_gb) * 1024 != props['config.hardware.memoryMB']:
+			changes.append(Change('ram_gb', 'memory', props['config.hardware.memoryMB'] / 1024, int(desired_vm.ram_gb)))
+
+		by_label = {device.deviceInfo.label: device for device in devices if device.deviceInfo}
+		disk_count = sum(isinstance(device, vim.vm.device.VirtualDisk) for device in devices)
+
+		# vCenter labels a new disk "Hard disk <disk count + 1>", so any other
+		# missing label would be added again on every run.
+		for label, size_gb in sorted((desired_vm.disks or {}).items(), key=lambda item: Reconciler._DiskOrder(item[0])):
+			disk = by_label.get(label)
+			if disk is None and label != f'Hard disk {disk_count + 1}':
+				vm_plan.errors.append(f'{label} cannot be added, the next new disk is Hard disk {disk_count + 1}')
+			elif disk is None:
+				changes.append(Change('disk_add', label, None, size_gb))
+				disk_count += 1
+			elif not isinstance(disk, vim.vm.device.VirtualDisk):
+				vm_plan.errors.append(f'{label} is not a virtual disk')
+			elif disk.capacityInKB < size_gb * 1024 * 1024:
+				changes.append(Change('disk_extend', label, disk.capacityInKB / (1024 * 1024), size_gb, disk))
+			elif disk.capacityInKB > size_gb * 1024 * 1024:
+				vm_plan.errors.append(f'{label} cannot shrink from {disk.capacityInKB / (1024 * 1024)} GB to {size_gb} GB')
+
+		for number, portgroup_name in sorted((desired_vm.nics or {}).items()):
+			label = f'Network adapter {number}'
+			nic = by_label.get(label)
+			if not isinstance(nic, vim.vm.device.VirtualEthernetCard):
+				vm_plan.errors.append(f'{label} not found')
+			elif portgroup_name not in portgroups:
+				vm_plan.errors.append(f'Portgroup {portgroup_name} not found')
+			elif getattr(getattr(nic.backing, 'port', None), 'portgroupKey', None) != portgroups[portgroup_name]:
+				current = next((name for name, key in portgroups.items() if key == getattr(getattr(nic.backing, 'port', None), 'portgroupKey', None)), None)
+				changes.append(Change('nic', label, current, portgroup_name, nic))
+
+		for number, iso_path in sorted((desired_vm.isos or {}).items()):
+			label = f'CD/DVD drive {number}'
+			cdrom = by_label.get(label)
+			if not isinstance(cdrom, vim.vm.device.VirtualCdrom):
+				vm_plan.errors.append(f'{label} not found')
+				continue
+			current = cdrom.backing.fileName if isinstance(cdrom.backing, vim.vm.device.VirtualCdrom.IsoBackingInfo) else ''
+			if current != (iso_path or ''):
+				changes.append(Change('iso', label, current, iso_path or '', cdrom))
+
+		current_attributes = {field_names.get(value.key, value.key): value.value for value in props.get('customValue') or []}
+		for name, value in sorted((desired_vm.attributes or {}).items()):
+			if value is not None and current_attributes.get(name) != value:
+				changes.append(Change('attribute', name, current_attributes.get(name), value))
+
+	def _DiskOrder(label):
+
+		# Numeric order, so that "Hard disk 10" comes after "Hard disk 9".
+		match = re.fullmatch(r'Hard disk (\d+)', label)
+
+		return (0, int(match.group(1)), label) if match else (1, 0, label)
+
+	def _ApplyVM(self, vm_plan):
+
+		# A failure is this VM's False result and never stops the rest of the
+		# fleet; a VM powered off for its changes is powered back on regardless.
+		vm = vm_plan.vm
+		power_off = bool(vm_plan.ReconfigureChanges()) and vm_plan.NeedsPowerOff()
+		if power_off and not Reconciler._Attempt(vm_plan, Vsphere._ExecuteTask, vm.PowerOffVM_Task):
+			return False
+
+		succeeded = Reconciler._Attempt(vm_plan, self._Reconfigure, vm_plan)
+		if power_off:
+			succeeded = Reconciler._Attempt(vm_plan, Vsphere._ExecuteTask, vm.PowerOnVM_Task) and succeeded
+
+		return succeeded
+
+	def _Attempt(vm_plan, function, *args):
+
+		try:
+			return bool(function(*args))
+		except Exception as e:
+			vm_plan.errors.append(repr(e))
+			return False
+
+	def _Reconfigure(self, vm_plan):
+
+		vm = vm_plan.vm
+		reconfigure_changes = vm_plan.ReconfigureChanges()
+
+		if reconfigure_changes:
+			spec = self._ConfigSpec(vm, reconfigure_changes)
+			if any(change.kind == 'disk_add' for change in reconfigure_changes):
+				result = Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=spec)
+			else:
+				with Retry.Idempotent():
+					result = Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=spec)
+
+			if not result:
+				return False
+
+		for change in vm_plan.changes:
+			if change.kind == 'attribute':
+				Retry.Call(
+					lambda: vm.SetCustomValue(key=change.target, value=change.after),
+					idempotent=True,
+					policy=Vsphere.RETRY_POLICY
+				)
+
+		return True
+
+	def _ConfigSpec(self, vm, changes):
+
+		spec = vim.vm.ConfigSpec()
+		device_changes = []
+		new_disks = []
+
+		for change in changes:
+			if change.kind == 'cpu':
+				spec.numCPUs = change.after
+			elif change.kind == 'ram_gb':
+				spec.memoryMB = change.after * 1024
+			elif change.kind == 'disk_add':
+				new_disks.append(change.after)
+			elif change.kind == 'disk_extend':
+				change.device.capacityInKB = change.after * 1024 * 1024
+				device_changes.append(
+					vim.vm.device.VirtualDeviceSpec(
+						operation=vim.vm.device.VirtualDeviceSpec.Operation.edit,
+						device=change.device
+					)
+				)
+			elif change.kind == 'nic':
+				port = Vsphere.GetPortByPortgroup(self.si, change.after)
+				if port is None:
+					raise ValueError(f'No free port left in portgroup "{change.after}"')
+				device_changes.append(Vsphere.GetVirtualNicSpec(change.device, port))
+			elif change.kind == 'iso':
+				device_changes.append(Vsphere.GetVirtualCDSpec(change.device, change.after or None))
+
+		if new_disks:
+			slots, controller_specs = Vsphere._AllocateDiskSlots(vm, len(new_disks))
+			if not slots:
+				raise ValueError(f'No free SCSI unit left for {len(new_disks)} new disks on VM "{vm.name}"')
+			device_changes.extend(controller_specs)
+			for index, (size_gb, (controller_key, unit_number)) in enumerate(zip(new_disks, slots)):
+				device_changes.append(
+					Vsphere._CreateDiskSpec(vm, size_gb, controller_key=controller_key, unit_number=unit_number, key=-(index + 1))
+				)
+
+		if device_changes:
+			spec.deviceChange = device_changes
+
+		return spec
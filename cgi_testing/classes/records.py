@@ -0,0 +1,281 @@
+import sys
+import array
+
+
+class Record:
+
+	# Slotted result record, the row type of the columnar form. FIELDS maps each
+	# attribute to the key of the plain dicts the Vsphere methods return, which
+	# ToDict() builds and record['Key'] reads.
+
+	__slots__ = ()
+
+	FIELDS = ()
+	# Attributes stored as typed arrays in the columnar form.
+	ARRAY_COLUMNS = {}
+
+	def __init__(self, *values, **kwargs):
+
+		attributes = [attribute for attribute, _ in type(self).FIELDS]
+		for attribute, value in zip(attributes, values):
+			setattr(self, attribute, value)
+		for attribute in attributes[len(values):]:
+			setattr(self, attribute, kwargs.pop(attribute, None))
+		if kwargs:
+			raise TypeError(f'Unexpected fields for {type(self).__name__}: {", ".join(kwargs)}')
+
+	def ToDict(self):
+
+		return {key: getattr(self, attribute) for attribute, key in type(self).FIELDS}
+
+	def keys(self):
+
+		return list(self.ToDict())
+
+	def get(self, key, default=None):
+
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __getitem__(self, key):
+
+		for attribute, field_key in type(self).FIELDS:
+			if field_key == key:
+				return getattr(self, attribute)
+
+		raise KeyError(key)
+
+	def __eq__(self, other):
+
+		if isinstance(other, dict):
+			return self.ToDict() == other
+		if type(other) is type(self):
+			return all(getattr(self, attribute) == getattr(other, attribute) for attribute, _ in type(self).FIELDS)
+
+		return NotImplemented
+
+	def __hash__(self):
+
+		return hash((type(self),) + tuple(getattr(self, attribute) for attribute, _ in type(self).FIELDS))
+
+	def __repr__(self):
+
+		values = ', '.join(f'{attribute}={getattr(self, attribute)!r}' for attribute, _ in type(self).FIELDS)
+
+		return f'{type(self).__name__}({values})'
+
+
+class DiskRecord(Record):
+
+	__slots__ = ('vm_name', 'label', 'capacity_gb', 'unit_number', 'controller_key')
+
+	FIELDS = (
+		('vm_name', 'VM'),
+		('label', 'Label'),
+		('capacity_gb', 'CapacityGB'),
+		('unit_number', 'UnitNumber'),
+		('controller_key', 'BusNumber')
+	)
+	ARRAY_COLUMNS = {'capacity_gb': 'd', 'unit_number': 'q', 'controller_key': 'q'}
+
+	def ToDict(self):
+
+		record = Record.ToDict(self)
+		if self.vm_name is None:
+			del record['VM']
+
+		return record
+
+
+class SnapshotRecord(Record):
+
+	__slots__ = ('vm_name', 'name', 'create_time')
+
+	FIELDS = (
+		('vm_name', 'VM'),
+		('name', 'Name'),
+		('create_time', 'Date')
+	)
+
+	def __getitem__(self, key):
+
+		if key == 'Date':
+			return self.create_time.strftime('%Y-%m-%d %H:%M:%S') if self.create_time else None
+
+		return Record.__getitem__(self, key)
+
+	def ToDict(self):
+
+		record = {key: self[key] for _, key in SnapshotRecord.FIELDS}
+		if self.vm_name is None:
+			del record['VM']
+
+		return record
+
+
+class ClusterCapacityRecord(Record):
+
+	__slots__ = (
+		'name',
+		'total_cpu_mhz',
+		'total_memory_mb',
+		'cpu_in_use_mhz',
+		'memory_in_use_mb',
+		'cpu_reserved_mhz',
+		'memory_reserved_mb'
+	)
+
+	FIELDS = (
+		('name', 'Name'),
+		('total_cpu_mhz', 'TotalClusterCPU'),
+		('total_memory_mb', 'TotalClusterMemory'),
+		('cpu_in_use_mhz', 'CPUInUse'),
+		('memory_in_use_mb', 'MemoryInUse'),
+		('cpu_reserved_mhz', 'CPUReserved'),
+		('memory_reserved_mb', 'MemoryReserved')
+	)
+	ARRAY_COLUMNS = {name: 'q' for name in __slots__[1:]}
+
+
+class VmMetaRecord(Record):
+
+	__slots__ = (
+		'name',
+		'instance_uuid',
+		'power_state',
+		'num_cpu',
+		'memory_mb',
+		'guest_os',
+		'ip_address',
+		'host',
+		'annotation'
+	)
+
+	FIELDS = (
+		('name', 'Name'),
+		('instance_uuid', 'InstanceUuid'),
+		('power_state', 'PowerState'),
+		('num_cpu', 'NumCPU'),
+		('memory_mb', 'MemoryMB'),
+		('guest_os', 'GuestOS'),
+		('ip_address', 'IPAddress'),
+		('host', 'Host'),
+		('annotation', 'Annotation')
+	)
+	ARRAY_COLUMNS = {'num_cpu': 'q', 'memory_mb': 'q'}
+
+	# Property paths fetched to build a record, in FIELDS order.
+	PROPERTIES = (
+		'name',
+		'config.instanceUuid',
+		'runtime.powerState',
+		'config.hardware.numCPU',
+		'config.hardware.memoryMB',
+		'config.guestFullName',
+		'guest.ipAddress',
+		'runtime.host',
+		'config.annotation'
+	)
+
+	def FromProperties(props, host_names=None):
+
+		host = props.get('runtime.host')
+		if host is not None:
+			host = (host_names or {}).get(host, host._moId)
+
+		values = [props.get(path) for path in VmMetaRecord.PROPERTIES]
+		values[VmMetaRecord.PROPERTIES.index('runtime.host')] = host
+
+		return VmMetaRecord(*values)
+
+
+class DatastoreFileRecord(Record):
+
+	__slots__ = ('datastore', 'folder', 'name', 'size', 'modified')
+
+	FIELDS = (
+		('datastore', 'Datastore'),
+		('folder', 'Folder'),
+		('name', 'Name'),
+		('size', 'Size'),
+		('modified', 'Modified')
+	)
+	ARRAY_COLUMNS = {'size': 'q'}
+
+	@property
+	def path(self):
+
+		# '[datastore] folder/name', the form device backings and AttachCDRomToVM use.
+		relative = f'{self.folder}/{self.name}' if self.folder else self.name
+
+		return f'[{self.datastore}] {relative}'
+
+
+class Rows(list):
+
+	# Row form of the listing methods: the plain dicts they have always
+	# returned, so results stay JSON serializable and isinstance(row, dict).
+
+	def append(self, record):
+
+		list.append(self, record.ToDict())
+
+
+class Columns:
+
+	# Column-oriented store for fleet reports: one list (or typed array for
+	# numeric columns) per field instead of one object per row, with repeated
+	# strings such as labels and power states interned.
+
+	def __init__(self, record_type, records=()):
+
+		self.record_type = record_type
+		self.columns = {
+			attribute: array.array(record_type.ARRAY_COLUMNS[attribute]) if attribute in record_type.ARRAY_COLUMNS else []
+			for attribute, _ in record_type.FIELDS
+		}
+		self.length = 0
+		for record in records:
+			self.Append(record)
+
+	def Append(self, record):
+
+		for attribute, column in self.columns.items():
+			value = getattr(record, attribute)
+			if isinstance(value, str):
+				value = sys.intern(value)
+			try:
+				column.append(value)
+			except TypeError:
+				# A None (or non-numeric) value demotes the typed column to a list.
+				column = self.columns[attribute] = list(column)
+				column.append(value)
+		self.length += 1
+
+	def append(self, record):
+
+		# Lets the listing methods fill either a list or a Columns.
+		self.Append(record)
+
+	def Column(self, attribute):
+
+		return self.columns[attribute]
+
+	def __len__(self):
+
+		return self.length
+
+	def __getitem__(self, index):
+
+		return self.record_type(*(column[index] for column in self.columns.values()))
+
+	def __iter__(self):
+
+		for index in range(self.length):
+			yield self[index]
+
+	def ToDicts(self):
+
+		return [record.ToDict() for record in self]
@@ -0,0 +1,206 @@
+import sys
+import time
+import random
+import threading
+import contextlib
+import contextvars
+
+from cgi_testing.classes.lazy import LazyImport
+
+vim = LazyImport('pyVmomi', 'vim', globals())
+vmodl = LazyImport('pyVmomi', 'vmodl', globals())
+
+
+class RetryBudget:
+
+	# Token bucket shared by every retried call: each first attempt deposits `ratio`
+	# tokens and each retry spends one, so during an outage retries stay a bounded
+	# fraction of the traffic instead of multiplying it.
+
+	def __init__(self, ratio=0.2, min_retries=10, max_tokens=100):
+
+		self.ratio = ratio
+		self.max_tokens = max_tokens
+		self.tokens = float(min_retries)
+		self.lock = threading.Lock()
+
+	def RecordRequest(self):
+
+		with self.lock:
+			self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+	def TryRetry(self):
+
+		with self.lock:
+			if self.tokens < 1:
+				return False
+			self.tokens -= 1
+			return True
+
+
+class RetryPolicy:
+
+	def __init__(
+			self,
+			max_attempts=4,
+			base_delay=0.25,
+			max_delay=8.0,
+			budget=None,
+			sleep=time.sleep,
+			jitter=random.random
+	):
+
+		self.max_attempts = max_attempts
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.budget = budget if budget is not None else RetryBudget()
+		self.sleep = sleep
+		self.jitter = jitter
+
+	def Delay(self, attempt):
+
+		# Full jitter keeps callers that failed together from retrying together.
+		return self.jitter() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+
+class Retry:
+
+	# The server refused the request, nothing was applied: safe to send it again.
+	TRANSIENT = 'transient'
+	# The connection failed mid-call, the request may or may not have been applied.
+	AMBIGUOUS = 'ambiguous'
+	PERMANENT = 'permanent'
+
+	TRANSIENT_FAULTS = (
+		'vim.fault.TaskInProgress',
+		'vim.fault.ConcurrentAccess',
+		'vim.fault.Timedout',
+		'vmodl.fault.HostCommunication'
+	)
+	# Matched by exact type: the generic InvalidState is vCenter refusing a call
+	# while another operation holds the object, but its subclasses (power, host,
+	# datastore and VM state, pending questions, ...) do not clear on a retry.
+	TRANSIENT_EXACT_FAULTS = (
+		'vim.fault.InvalidState',
+	)
+	PERMANENT_FAULTS = (
+		'vim.fault.InvalidPowerState',
+	)
+	TRANSIENT_HTTP_STATUSES = (502, 503, 504)
+
+	DEFAULT_POLICY = RetryPolicy()
+
+	_idempotency = contextvars.ContextVar('retry_idempotency', default=None)
+
+	def Classify(error):
+
+		if Retry._IsFault(error, Retry.PERMANENT_FAULTS):
+			return Retry.PERMANENT
+
+		if Retry._IsFault(error, Retry.TRANSIENT_FAULTS) or Retry._IsFault(error, Retry.TRANSIENT_EXACT_FAULTS, exact=True):
+			return Retry.TRANSIENT
+
+		# pyVmomi raises http.client.HTTPException('503 Service Unavailable') for
+		# non-SOAP error responses, requests carries the response on the error.
+		response = getattr(error, 'response', None)
+		status = getattr(response, 'status_code', None)
+		http_client = sys.modules.get('http.client')
+		if status is None and http_client is not None and isinstance(error, http_client.HTTPException):
+			status = str(error).split(' ', 1)[0]
+		if str(status) in map(str, Retry.TRANSIENT_HTTP_STATUSES):
+			return Retry.TRANSIENT
+
+		if isinstance(error, (ConnectionError, TimeoutError)):
+			return Retry.AMBIGUOUS
+		if isinstance(error, OSError) and type(error).__module__.startswith(('requests', 'urllib3')):
+			return Retry.AMBIGUOUS
+
+		return Retry.PERMANENT
+
+	def _IsFault(error, fault_names, exact=False):
+
+		# Faults are named rather than imported so that loading this module does
+		# not load pyVmomi; an error that is not a vmodl fault never needs it.
+		if not type(error).__module__.startswith('pyVmomi'):
+			return False
+
+		if exact:
+			return any(type(error) is Retry._FaultType(fault_name) for fault_name in fault_names)
+
+		return any(isinstance(error, Retry._FaultType(fault_name)) for fault_name in fault_names)
+
+	def _FaultType(fault_name):
+
+		namespace, _, path = fault_name.partition('.')
+		fault_type = vim if namespace == 'vim' else vmodl
+		for attribute in path.split('.'):
+			fault_type = getattr(fault_type, attribute)
+
+		return fault_type
+
+	@contextlib.contextmanager
+	def Idempotent(is_done=None):
+
+		# Marks the operations run inside the block as safe to send again after an
+		# ambiguous failure. When `is_done` is given it is checked first, and a
+		# request that already took effect is not resubmitted.
+		token = Retry._idempotency.set(is_done or (lambda: False))
+		try:
+			yield
+		finally:
+			Retry._idempotency.reset(token)
+
+	def Call(operation, idempotent=False, is_done=None, policy=None):
+
+		if idempotent and is_done is None:
+			is_done = lambda: False
+
+		return Retry._Run(lambda attempt: operation(), is_done, policy)
+
+	def RunTask(submit, wait, policy=None):
+
+		# A task that failed is submitted again, but a connection lost while waiting
+		# re-attaches to the task that is already running instead of starting another.
+		task = None
+
+		def Attempt(attempt):
+			nonlocal task
+			if task is None:
+				task = submit()
+			try:
+				return wait(task)
+			except vmodl.MethodFault:
+				task = None
+				raise
+
+		def Recovered(error):
+			return task is not None and Retry.Classify(error) == Retry.AMBIGUOUS
+
+		return Retry._Run(Attempt, None, policy, Recovered)
+
+	def _Run(attempt_method, is_done, policy, recovered=None):
+
+		policy = policy or Retry.DEFAULT_POLICY
+		if is_done is None:
+			is_done = Retry._idempotency.get()
+
+		policy.budget.RecordRequest()
+
+		attempt = 0
+		while True:
+			try:
+				return attempt_method(attempt)
+
+			except Exception as e:
+				kind = Retry.TRANSIENT if recovered and recovered(e) else Retry.Classify(e)
+
+				if kind == Retry.PERMANENT or (kind == Retry.AMBIGUOUS and is_done is None):
+					raise
+				if attempt + 1 >= policy.max_attempts or not policy.budget.TryRetry():
+					raise
+
+				policy.sleep(policy.Delay(attempt))
+				attempt += 1
+
+				if kind == Retry.AMBIGUOUS and is_done():
+					return True
@@ -0,0 +1,243 @@
+import time
+import threading
+import collections
+import concurrent.futures
+
+from pyVmomi import vim
+
+from cgi_testing.classes.coalesce import SingleFlight
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class Operation:
+
+	__slots__ = (
+		'method',
+		'vm_name',
+		'args',
+		'kwargs',
+		'host',
+		'datastores',
+		'future',
+		'submitted'
+	)
+
+	def __init__(self, method, vm_name, args, kwargs, host, datastores, submitted):
+
+		self.method = method
+		self.vm_name = vm_name
+		self.args = args
+		self.kwargs = kwargs
+		self.host = host
+		self.datastores = datastores
+		self.future = concurrent.futures.Future()
+		self.submitted = submitted
+
+
+class Scheduler:
+
+	# Admission control for bulk VM operations. Each operation is placed on the
+	# host and datastores of its VM, taken from a cached bulk inventory, and only
+	# starts once the host, every datastore and the vCenter are under their caps.
+	# Queues are kept per host and served round robin, so one busy host neither
+	# starves the others nor blocks operations queued behind it.
+
+	def __init__(
+			self,
+			si,
+			max_per_host=2,
+			max_per_datastore=4,
+			max_total=16,
+			inventory_ttl=300,
+			clock=time.monotonic
+	):
+
+		self.si = si
+		self.max_per_host = max_per_host
+		self.max_per_datastore = max_per_datastore
+		self.max_total = max_total
+		self.inventory_ttl = inventory_ttl
+		self.clock = clock
+
+		self.lock = threading.Lock()
+		# Notified whenever an operation finishes, for Shutdown to drain queues.
+		self.idle = threading.Condition(self.lock)
+		self.closed = False
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_total, thread_name_prefix='vsphere-scheduler')
+		self.queues = collections.OrderedDict()
+		self.running = 0
+		self.running_by_host = collections.Counter()
+		self.running_by_datastore = collections.Counter()
+
+		self.inventory = {}
+		self.inventory_time = None
+		self.inventory_lock = threading.Lock()
+		self.refreshes = SingleFlight()
+
+		self.dispatched = 0
+		self.completed = 0
+		self.failed = 0
+		self.wait_time_total = 0.0
+		self.wait_time_max = 0.0
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.Shutdown()
+
+	def Submit(self, method, vm_name, *args, **kwargs):
+
+		# `method` is a Vsphere method name or any callable taking (si, vm_name, ...).
+		if isinstance(method, str):
+			method = getattr(Vsphere, method)
+
+		host, datastores = self._Placement(vm_name)
+		operation = Operation(method, vm_name, args, kwargs, host, datastores, self.clock())
+
+		with self.lock:
+			if self.closed:
+				raise RuntimeError('cannot schedule new operations after shutdown')
+			self.queues.setdefault(host, collections.deque()).append(operation)
+			self._Dispatch()
+
+		return operation.future
+
+	def Map(self, method, vm_names, *args, **kwargs):
+
+		futures = {vm_name: self.Submit(method, vm_name, *args, **kwargs) for vm_name in vm_names}
+
+		return {vm_name: future.result() for vm_name, future in futures.items()}
+
+	def Metrics(self):
+
+		with self.lock:
+			return {
+				'queue_depth': sum(len(queue) for queue in self.queues.values()),
+				'queue_depth_by_host': {host: len(queue) for host, queue in self.queues.items() if queue},
+				'running': self.running,
+				'running_by_host': {host: count for host, count in self.running_by_host.items() if count},
+				'running_by_datastore': {datastore: count for datastore, count in self.running_by_datastore.items() if count},
+				'completed': self.completed,
+				'failed': self.failed,
+				'wait_time_total': self.wait_time_total,
+				'wait_time_max': self.wait_time_max,
+				'wait_time_avg': self.wait_time_total / (self.dispatched or 1)
+			}
+
+	def RefreshInventory(self):
+
+		properties = Vsphere.GetObjectProperties(self.si, vim.VirtualMachine, ['name', 'runtime.host', 'datastore'])
+
+		inventory = {}
+		for props in properties.values():
+			host = props.get('runtime.host')
+			inventory[props['name'].lower()] = (
+				host._moId if host is not None else None,
+				tuple(datastore._moId for datastore in props.get('datastore') or [])
+			)
+
+		with self.inventory_lock:
+			self.inventory = inventory
+			self.inventory_time = self.clock()
+
+	def Shutdown(self, wait=True):
+
+		# With `wait`, operations still queued behind the caps run first;
+		# without, they are cancelled. Either way every future resolves.
+		with self.lock:
+			self.closed = True
+			if wait:
+				while self.queues:
+					self.idle.wait()
+				cancelled = []
+			else:
+				cancelled = [operation for queue in self.queues.values() for operation in queue]
+				self.queues.clear()
+				self.failed += len(cancelled)
+
+		for operation in cancelled:
+			operation.future.cancel()
+
+		self.executor.shutdown(wait=wait)
+
+	def _Placement(self, vm_name):
+
+		with self.inventory_lock:
+			stale = self.inventory_time is None or self.clock() - self.inventory_time > self.inventory_ttl
+
+		# Submits racing past a stale inventory share one refresh.
+		if stale:
+			self.refreshes.Do('inventory', self.RefreshInventory)
+
+		# A VM missing from the inventory is only held to the vCenter cap; the
+		# operation itself reports that it does not exist.
+		with self.inventory_lock:
+			return self.inventory.get(vm_name.lower(), (None, ()))
+
+	def _Admissible(self, operation):
+
+		if operation.host is not None and self.running_by_host[operation.host] >= self.max_per_host:
+			return False
+
+		return all(self.running_by_datastore[datastore] < self.max_per_datastore for datastore in operation.datastores)
+
+	def _Dispatch(self):
+
+		# Called with the lock held, whenever an operation is queued or finishes.
+		while self.running < self.max_total:
+			operation = None
+			for host in list(self.queues):
+				# Every operation queued for a host at its cap would be refused.
+				if host is not None and self.running_by_host[host] >= self.max_per_host:
+					continue
+				queue = self.queues[host]
+				for candidate in queue:
+					if self._Admissible(candidate):
+						operation = candidate
+						queue.remove(candidate)
+						break
+				if operation is not None:
+					self.queues.move_to_end(host)
+					if not queue:
+						del self.queues[host]
+					break
+
+			if operation is None:
+				return
+
+			wait_time = self.clock() - operation.submitted
+			self.wait_time_total += wait_time
+			self.wait_time_max = max(self.wait_time_max, wait_time)
+
+			self.dispatched += 1
+			self.running += 1
+			self.running_by_host[operation.host] += 1
+			for datastore in operation.datastores:
+				self.running_by_datastore[datastore] += 1
+
+			self.executor.submit(self._Run, operation)
+
+	def _Run(self, operation):
+
+		try:
+			if operation.future.set_running_or_notify_cancel():
+				try:
+					operation.future.set_result(operation.method(self.si, operation.vm_name, *operation.args, **operation.kwargs))
+				except Exception as e:
+					operation.future.set_exception(e)
+
+		finally:
+			with self.lock:
+				self.running -= 1
+				self.running_by_host[operation.host] -= 1
+				for datastore in operation.datastores:
+					self.running_by_datastore[datastore] -= 1
+				if operation.future.cancelled() or operation.future.exception() is not None:
+					self.failed += 1
+				else:
+					self.completed += 1
+				self._Dispatch()
+				self.idle.notify_all()
@@ -0,0 +1,1774 @@
+import copy
+import heapq
+import functools
+import random
+import fnmatch
+import datetime
+import itertools
+import threading
+import collections
+
+import time
+
+from pyVmomi import vim, vmodl, VmomiSupport
+from pyVmomi.StubAdapterAccessorImpl import StubAdapterAccessorMixin
+
+
+# In-process stand-in for a vCenter. Simulator.Connect() returns a real pyVmomi
+# ServiceInstance whose stub answers SOAP calls from an in-memory inventory, so
+# Vsphere runs unchanged against it. Every call goes through InvokeMethod, where
+# the configured per-RPC latency is applied and the call is counted; tasks move
+# through queued/running/success on the simulated clock.
+
+def _Recorded(method):
+
+	# Logs the calls that build the inventory, so Clone() can replay them.
+	@functools.wraps(method)
+	def Recorded(self, *args, **kwargs):
+		self.build_log.append((method.__name__, args, kwargs))
+		return method(self, *args, **kwargs)
+
+	return Recorded
+
+
+class _SimObject:
+
+	__slots__ = ('ref', 'props', 'lazy', 'dynamic', 'data')
+
+	def __init__(self, ref, props=None, lazy=None, dynamic=None):
+
+		self.ref = ref
+		self.props = props or {}
+		self.lazy = lazy or {}
+		self.dynamic = dynamic or {}
+		self.data = {}
+
+	def Get(self, name):
+
+		if name in self.props:
+			return self.props[name]
+		if name in self.lazy:
+			self.props[name] = self.lazy.pop(name)()
+			return self.props[name]
+		if name in self.dynamic:
+			return self.dynamic[name]()
+		return None
+
+	def Names(self):
+
+		return list(self.props) + list(self.lazy) + list(self.dynamic)
+
+
+class SimulatorStub(StubAdapterAccessorMixin):
+
+	def __init__(self, simulator):
+
+		self.simulator = simulator
+		self.version = VmomiSupport.newestVersions.Get('vim')
+		self.cookie = 'vmware_soap_session="simulator"; Path=/; HttpOnly; Secure;'
+
+	def InvokeMethod(self, mo, info, args):
+
+		return self.simulator._Invoke(mo, info, args)
+
+	def DropConnections(self):
+
+		pass
+
+
+class Simulator:
+
+	TOOLS_RUNNING = 'guestToolsRunning'
+	TOOLS_NOT_RUNNING = 'guestToolsNotRunning'
+
+	# (key, group, name, rollup, unit, stats type), keys as on a default vCenter.
+	PERF_COUNTERS = (
+		(2, 'cpu', 'usage', 'average', 'percent', 'rate'),
+		(6, 'cpu', 'usagemhz', 'average', 'megaHertz', 'rate'),
+		(24, 'mem', 'usage', 'average', 'percent', 'absolute'),
+		(98, 'mem', 'consumed', 'average', 'kiloBytes', 'absolute'),
+		(125, 'disk', 'usage', 'average', 'kiloBytesPerSecond', 'rate'),
+		(143, 'net', 'usage', 'average', 'kiloBytesPerSecond', 'rate')
+	)
+	REALTIME_INTERVAL = 20
+	HISTORICAL_INTERVALS = (300, 1800, 7200, 86400)
+
+	def __init__(self, rpc_latency=0.0, task_queue_time=0.0, task_run_time=0.0, guest_boot_time=0.0, seed=0):
+
+		self.rpc_latency = rpc_latency
+		self.task_queue_time = task_queue_time
+		self.task_run_time = task_run_time
+		self.guest_boot_time = guest_boot_time
+		self.random = random.Random(seed)
+
+		self.lock = threading.RLock()
+		self.changed = threading.Condition(self.lock)
+		self.stub = SimulatorStub(self)
+
+		self.rpc_calls = 0
+		self.rpc_calls_by_method = collections.Counter()
+		self.build_log = []
+		# False once ExpireSession() was called, until the next Connect().
+		self.authenticated = True
+
+		self.objects = {}
+		self.children = collections.defaultdict(list)
+		self.by_type = collections.defaultdict(dict)
+		self.faults = collections.defaultdict(list)
+		self.ids = collections.defaultdict(itertools.count)
+
+		self.version = 0
+		self.change_log = collections.deque(maxlen=100000)
+		self.filters = {}
+		self.retrievals = {}
+		self.cancelled_waits = 0
+
+		self.events = []
+		self.event_sequence = itertools.count()
+		# Key of the newest inventory event (entity added, removed or renamed),
+		# read through EventManager.latestEvent.
+		self.latest_event_key = 0
+		self.event_thread = None
+
+		self.handlers = {
+			('ServiceInstance', 'RetrieveServiceContent'): self._RetrieveServiceContent,
+			('ServiceInstance', 'CurrentTime'): lambda obj, args: self._Now(),
+			('SessionManager', 'Logout'): lambda obj, args: None,
+			('ViewManager', 'CreateContainerView'): self._CreateContainerView,
+			('View', 'DestroyView'): self._DestroyObject,
+			('PropertyCollector', 'RetrieveProperties'): self._RetrieveProperties,
+			('PropertyCollector', 'RetrievePropertiesEx'): self._RetrievePropertiesEx,
+			('PropertyCollector', 'ContinueRetrievePropertiesEx'): self._ContinueRetrievePropertiesEx,
+			('PropertyCollector', 'CancelRetrievePropertiesEx'): self._CancelRetrievePropertiesEx,
+			('PropertyCollector', 'CreateFilter'): self._CreateFilter,
+			('PropertyCollector', 'CreatePropertyCollector'): self._CreatePropertyCollector,
+			('PropertyCollector', 'DestroyPropertyCollector'): self._DestroyPropertyCollector,
+			('PropertyCollector', 'WaitForUpdates'): lambda obj, args: self._WaitForUpdates(obj, args[0], None),
+			('PropertyCollector', 'WaitForUpdatesEx'): self._WaitForUpdatesEx,
+			('PropertyCollector', 'CheckForUpdates'): lambda obj, args: self._WaitForUpdates(obj, args[0], 0),
+			('PropertyCollector', 'CancelWaitForUpdates'): self._CancelWaitForUpdates,
+			('PropertyFilter', 'DestroyPropertyFilter'): self._DestroyFilter,
+			('ExtensibleManagedObject', 'setCustomValue'): self._SetCustomValue,
+			('PerformanceManager', 'QueryPerf'): self._QueryPerf,
+			('HostDatastoreBrowser', 'SearchDatastoreSubFolders_Task'): self._SearchDatastoreSubFolders,
+			('VirtualMachine', 'PowerOnVM_Task'): self._PowerOnVM,
+			('VirtualMachine', 'PowerOffVM_Task'): self._PowerOffVM,
+			('VirtualMachine', 'ResetVM_Task'): self._ResetVM,
+			('VirtualMachine', 'RebootGuest'): self._RebootGuest,
+			('VirtualMachine', 'ShutdownGuest'): self._ShutdownGuest,
+			('VirtualMachine', 'ReconfigVM_Task'): self._ReconfigVM,
+			('VirtualMachine', 'CreateSnapshot_Task'): self._CreateSnapshot,
+			('VirtualMachine', 'MigrateVM_Task'): self._MigrateVM,
+			('VirtualMachine', 'RelocateVM_Task'): self._RelocateVM,
+			('VirtualMachineSnapshot', 'RevertToSnapshot_Task'): self._RevertToSnapshot,
+			('VirtualMachineSnapshot', 'RemoveSnapshot_Task'): self._RemoveSnapshot,
+			('ManagedEntity', 'Destroy_Task'): self._DestroyEntity,
+			('ManagedEntity', 'Rename_Task'): self._RenameEntity,
+			('DistributedVirtualSwitch', 'FetchDVPorts'): self._FetchDVPorts,
+			('DistributedVirtualSwitch', 'AddDVPortgroup_Task'): self._AddDVPortgroup
+		}
+
+		with self.lock:
+			self._CreateServiceInstance()
+
+	# Public API
+
+	def Connect(self):
+
+		with self.lock:
+			self.authenticated = True
+
+		return vim.ServiceInstance('ServiceInstance', self.stub)
+
+	def Clone(self):
+
+		# Independent simulator with the same settings and inventory, rebuilt by
+		# replaying the Add* calls, so one generated inventory can back many
+		# tests. Changes made through SOAP calls are not carried over.
+		clone = Simulator(self.rpc_latency, self.task_queue_time, self.task_run_time, self.guest_boot_time)
+		clone.random.setstate(self.random.getstate())
+		for method_name, args, kwargs in self.build_log:
+			getattr(clone, method_name)(*clone._Rebind(args), **clone._Rebind(kwargs))
+
+		return clone
+
+	def Generate(
+			self,
+			vms=100,
+			clusters=None,
+			hosts_per_cluster=4,
+			datastores=None,
+			portgroups=None,
+			powered_on_ratio=0.8,
+			prefix='vm'
+	):
+
+		clusters = clusters or max(1, vms // 500)
+		datastores = datastores or max(2, vms // 200)
+		portgroups = portgroups or max(2, vms // 250)
+
+		ports_per_portgroup = -(-vms // portgroups) + 8
+
+		datacenter = self.AddDatacenter('dc-01')
+		dvs = self.AddDVS('dvs-01', datacenter)
+		portgroup_refs = [
+			self.AddPortgroup(f'pg-{index:04d}', dvs, vlan_id=100 + index, num_ports=ports_per_portgroup)
+			for index in range(portgroups)
+		]
+		datastore_refs = [self.AddDatastore(f'datastore-{index:04d}', datacenter) for index in range(datastores)]
+
+		host_refs = []
+		for cluster_index in range(clusters):
+			cluster = self.AddCluster(f'cluster-{cluster_index:03d}', datacenter)
+			for host_index in range(hosts_per_cluster):
+				host_refs.append(self.AddHost(f'esx-{cluster_index:03d}-{host_index:02d}.local', cluster, datastore_refs))
+
+		for index in range(vms):
+			power_state = 'poweredOn' if self.random.random() < powered_on_ratio else 'poweredOff'
+			self.AddVM(
+				f'{prefix}-{index:05d}',
+				host=host_refs[index % len(host_refs)],
+				datastore=datastore_refs[index % len(datastore_refs)],
+				portgroup=portgroup_refs[index % len(portgroup_refs)],
+				power_state=power_state,
+				cpu_usage_mhz=self.random.randint(50, 4000),
+				memory_usage_mb=self.random.randint(256, 4096)
+			)
+
+		return self
+
+	@_Recorded
+	def AddDatacenter(self, name):
+
+		with self.lock:
+			datacenter = self._Add(vim.Datacenter, 'datacenter', {'name': name, 'parent': self.root_folder})
+			props = self.objects[datacenter._moId].props
+			for folder_name in ('host', 'vm', 'datastore', 'network'):
+				props[f'{folder_name}Folder'] = self._Add(vim.Folder, 'group', {'name': folder_name, 'parent': datacenter})
+
+			# Datastores live one folder below the datastore root, the layout
+			# UploadFileToDatastore navigates with datastore.parent.parent.parent.
+			self.objects[datacenter._moId].data['datastore_parent'] = self._Add(
+				vim.Folder,
+				'group',
+				{'name': 'datastores', 'parent': props['datastoreFolder']}
+			)
+
+		return datacenter
+
+	@_Recorded
+	def AddCluster(self, name, datacenter):
+
+		with self.lock:
+			cluster = self._Add(
+				vim.ClusterComputeResource,
+				'domain-c',
+				{'name': name, 'parent': self._Props(datacenter)['hostFolder']}
+			)
+			obj = self.objects[cluster._moId]
+			obj.props['resourcePool'] = self._Add(vim.ResourcePool, 'resgroup', {'name': 'Resources', 'parent': cluster})
+			obj.dynamic['host'] = lambda: self._Children(cluster, vim.HostSystem)
+			obj.dynamic['datastore'] = lambda: self._ClusterDatastores(cluster)
+			obj.dynamic['summary'] = lambda: self._ClusterSummary(cluster)
+
+		return cluster
+
+	@_Recorded
+	def AddHost(self, name, cluster, datastores=(), cpu_mhz=2400, cpu_cores=32, memory_gb=512):
+
+		with self.lock:
+			host = self._Add(vim.HostSystem, 'host', {
+				'name': name,
+				'parent': cluster,
+				'datastore': list(datastores),
+				'runtime': vim.host.RuntimeInfo(connectionState='connected', powerState='poweredOn', inMaintenanceMode=False)
+			})
+			obj = self.objects[host._moId]
+			obj.data.update(cpu_mhz=cpu_mhz, cpu_cores=cpu_cores, memory_bytes=memory_gb * 1024 ** 3, vms=[])
+			obj.dynamic['vm'] = lambda: list(obj.data['vms'])
+			obj.dynamic['summary'] = lambda: self._HostSummary(host)
+
+			for datastore in datastores:
+				self.objects[datastore._moId].data['hosts'].append(host)
+
+		return host
+
+	@_Recorded
+	def AddDatastore(self, name, datacenter, capacity_gb=4096, free_gb=2048):
+
+		with self.lock:
+			datastore = self._Add(vim.Datastore, 'datastore', {
+				'name': name,
+				'parent': self.objects[datacenter._moId].data['datastore_parent']
+			})
+			obj = self.objects[datastore._moId]
+			obj.data.update(capacity=capacity_gb * 1024 ** 3, free=free_gb * 1024 ** 3, hosts=[], vms=[], files={})
+			obj.props['browser'] = self._Add(vim.host.DatastoreBrowser, 'datastoreBrowser', {'datastore': datastore})
+			obj.dynamic['info'] = lambda: vim.host.VmfsDatastoreInfo(
+				name=name,
+				url=f'ds:///vmfs/volumes/{datastore._moId}/',
+				freeSpace=obj.data['free'],
+				maxFileSize=62 * 1024 ** 4,
+				timestamp=self._Now()
+			)
+			obj.dynamic['summary'] = lambda: vim.Datastore.Summary(
+				datastore=datastore,
+				name=obj.Get('name'),
+				url=f'ds:///vmfs/volumes/{datastore._moId}/',
+				capacity=obj.data['capacity'],
+				freeSpace=obj.data['free'],
+				uncommitted=self._Uncommitted(obj, name),
+				type='VMFS',
+				accessible=True
+			)
+			obj.dynamic['host'] = lambda: [vim.Datastore.HostMount(key=host) for host in obj.data['hosts']]
+			obj.dynamic['vm'] = lambda: list(obj.data['vms'])
+
+		return datastore
+
+	@_Recorded
+	def AddDVS(self, name, datacenter):
+
+		with self.lock:
+			dvs = self._Add(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', {
+				'name': name,
+				'parent': self._Props(datacenter)['networkFolder'],
+				'uuid': f'50 00 00 00 00 00 00 00-00 00 00 00 00 00 {next(self.ids["uuid"]) % 256:02x} 00'
+			})
+			obj = self.objects[dvs._moId]
+			obj.data['ports'] = {}
+			obj.data['portgroup_ports'] = {}
+			obj.data['claim_hints'] = {}
+			obj.dynamic['portgroup'] = lambda: self._Children(dvs, vim.dvs.DistributedVirtualPortgroup, parent_key='dvs')
+
+		return dvs
+
+	@_Recorded
+	def AddDatastoreFile(self, datastore, path, size_bytes=0, modified=None):
+
+		# A file that belongs to no VM, such as an ISO or a leftover VMDK. `path`
+		# is relative to the datastore root.
+		with self.lock:
+			obj = self.objects[datastore._moId]
+			obj.data['files'][path] = (size_bytes, modified or self._Now())
+			obj.data['free'] -= size_bytes
+			self._Changed(datastore._moId, 'summary')
+
+	@_Recorded
+	def AddPortgroup(self, name, dvs, vlan_id=0, num_ports=64):
+
+		with self.lock:
+			dvs_obj = self.objects[dvs._moId]
+			portgroup = self._Add(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', {
+				'name': name,
+				'parent': dvs_obj.Get('parent'),
+				'dvs': dvs
+			})
+			key = portgroup._moId
+			props = self.objects[key].props
+			props['key'] = key
+			props['config'] = vim.dvs.DistributedVirtualPortgroup.ConfigInfo(
+				key=key,
+				name=name,
+				numPorts=num_ports,
+				distributedVirtualSwitch=dvs,
+				type=vim.dvs.DistributedVirtualPortgroup.PortgroupType.earlyBinding,
+				defaultPortConfig=vim.dvs.VmwareDistributedVirtualSwitch.VmwarePortConfigPolicy(
+					vlan=vim.dvs.VmwareDistributedVirtualSwitch.VlanIdSpec(vlanId=vlan_id)
+				)
+			)
+			port_keys = dvs_obj.data['portgroup_ports'][key] = []
+			for _ in range(num_ports):
+				port_key = str(next(self.ids['port']))
+				dvs_obj.data['ports'][port_key] = {'portgroup': key, 'vm': None}
+				port_keys.append(port_key)
+
+		return portgroup
+
+	@_Recorded
+	def AddVM(
+			self,
+			name,
+			host,
+			datastore,
+			portgroup=None,
+			power_state='poweredOn',
+			num_cpu=2,
+			memory_mb=4096,
+			disks_gb=(40,),
+			cpu_usage_mhz=0,
+			memory_usage_mb=0
+	):
+
+		with self.lock:
+			host_obj = self.objects[host._moId]
+			cluster = host_obj.Get('parent')
+			datacenter = self._Datacenter(host)
+			vm = self._Add(vim.VirtualMachine, 'vm', {
+				'name': name,
+				'parent': self._Props(datacenter)['vmFolder'],
+				'resourcePool': self._Props(cluster)['resourcePool'],
+				'datastore': [datastore],
+				'customValue': [],
+				'snapshot': None
+			})
+			obj = self.objects[vm._moId]
+			obj.data.update(cpu_usage_mhz=cpu_usage_mhz, memory_usage_mb=memory_usage_mb, port=None, snapshots={})
+			powered_on = power_state == 'poweredOn'
+			now = obj.data['created'] = self._Now()
+			datastore_name = self.objects[datastore._moId].Get('name')
+
+			obj.lazy['runtime'] = lambda: vim.vm.RuntimeInfo(
+				host=host,
+				powerState=power_state,
+				connectionState='connected',
+				bootTime=now if powered_on else None
+			)
+			obj.lazy['config'] = lambda: self._NewVMConfig(vm, name, num_cpu, memory_mb, disks_gb, datastore_name, portgroup)
+			obj.lazy['guest'] = lambda: self._GuestInfo(vm, powered_on)
+			obj.lazy['guestHeartbeatStatus'] = lambda: 'green' if powered_on else 'gray'
+			obj.dynamic['summary'] = lambda: self._VMSummary(vm)
+
+			host_obj.data['vms'].append(vm)
+			self.objects[datastore._moId].data['vms'].append(vm)
+			if portgroup is not None:
+				obj.data['port'] = self._ClaimPort(self._Props(portgroup)['dvs'], portgroup._moId, vm)
+
+		return vm
+
+	def InjectFault(self, method, fault, times=1, in_task=False):
+
+		# Makes the next `times` calls of the SOAP method `method` fail with
+		# `fault`, either synchronously or as the error of the task they start.
+		with self.lock:
+			self.faults[method].extend([(fault, in_task)] * times)
+
+	def ExpireSession(self):
+
+		# Like vCenter dropping an idle session: calls fail with NotAuthenticated
+		# and SessionManager.currentSession reads None until Connect() logs in.
+		with self.lock:
+			self.authenticated = False
+
+	def ResetCounters(self):
+
+		with self.lock:
+			self.rpc_calls = 0
+			self.rpc_calls_by_method.clear()
+
+	def Find(self, vimtype, name):
+
+		with self.lock:
+			for obj in self.by_type[vimtype].values():
+				if obj.Get('name') == name:
+					return obj.ref
+
+		return None
+
+	def GetProperty(self, ref, path):
+
+		with self.lock:
+			return self._GetPath(self._Object(ref), path)
+
+	# SOAP dispatch
+
+	def _Invoke(self, mo, info, args):
+
+		if self.rpc_latency:
+			time.sleep(self.rpc_latency)
+
+		with self.lock:
+			self.rpc_calls += 1
+			self.rpc_calls_by_method[info.wsdlName] += 1
+
+			obj = self._Object(mo)
+
+			if not self.authenticated and not self._AllowedWithoutSession(mo, info.wsdlName):
+				raise vim.fault.NotAuthenticated(object=mo, privilegeId='System.View')
+
+			if info.wsdlName == 'Fetch':
+				return self._Copy(obj.Get(args[0]))
+
+			handler = self._Handler(mo, info.wsdlName)
+			if handler is None:
+				raise vmodl.fault.MethodNotFound(receiver=mo, method=info.wsdlName)
+
+			in_task = False
+			if self.faults[info.wsdlName]:
+				fault, in_task = self.faults[info.wsdlName].pop(0)
+				if not in_task:
+					raise fault
+
+			if in_task:
+				return self._StartTask(mo, info.wsdlName, lambda: self._Raise(fault))
+
+			return handler(obj, args)
+
+	def _AllowedWithoutSession(self, mo, method):
+
+		if method == 'Fetch':
+			return isinstance(mo, (vim.ServiceInstance, vim.SessionManager))
+
+		return method in ('RetrieveServiceContent', 'CurrentTime')
+
+	def _Handler(self, mo, method):
+
+		for cls in type(mo).__mro__:
+			handler = self.handlers.get((getattr(cls, '_wsdlName', None), method))
+			if handler is not None:
+				return handler
+
+		return None
+
+	def _Raise(self, fault):
+
+		raise fault
+
+	# Inventory bookkeeping
+
+	def _CreateServiceInstance(self):
+
+		self.root_folder = self._Add(vim.Folder, 'group-d', {'name': 'Datacenters'})
+		self.property_collector = self._Add(vmodl.query.PropertyCollector, 'propertyCollector', {}, moid='propertyCollector')
+		self.view_manager = self._Add(vim.view.ViewManager, 'ViewManager', {}, moid='ViewManager')
+		self.session_manager = self._Add(vim.SessionManager, 'SessionManager', {}, moid='SessionManager')
+		self.custom_fields_manager = self._Add(vim.CustomFieldsManager, 'CustomFieldsManager', {'field': []}, moid='CustomFieldsManager')
+		self.event_manager = self._Add(vim.event.EventManager, 'EventManager', {}, moid='EventManager')
+		self.perf_manager = self._Add(vim.PerformanceManager, 'PerfMgr', {
+			'perfCounter': [
+				vim.PerformanceManager.CounterInfo(
+					key=key,
+					nameInfo=vim.ElementDescription(key=name, label=name, summary=name),
+					groupInfo=vim.ElementDescription(key=group, label=group, summary=group),
+					unitInfo=vim.ElementDescription(key=unit, label=unit, summary=unit),
+					rollupType=rollup,
+					statsType=stats_type,
+					level=1
+				)
+				for key, group, name, rollup, unit, stats_type in Simulator.PERF_COUNTERS
+			],
+			'historicalInterval': [
+				vim.HistoricalInterval(key=index + 1, samplingPeriod=period, name=f'{period}s', length=period * 288, level=1, enabled=True)
+				for index, period in enumerate(Simulator.HISTORICAL_INTERVALS)
+			]
+		}, moid='PerfMgr')
+		self.objects['SessionManager'].dynamic['currentSession'] = lambda: vim.UserSession(
+			key='simulator',
+			userName='simulator',
+			fullName='simulator',
+			loginTime=self._Now(),
+			lastActiveTime=self._Now(),
+			locale='en',
+			messageLocale='en'
+		) if self.authenticated else None
+		self.objects['EventManager'].dynamic['latestEvent'] = lambda: vim.event.GeneralEvent(
+			key=self.latest_event_key,
+			chainId=self.latest_event_key,
+			createdTime=self._Now(),
+			userName='simulator'
+		)
+
+		self.content = vim.ServiceInstanceContent(
+			rootFolder=self.root_folder,
+			propertyCollector=self.property_collector,
+			viewManager=self.view_manager,
+			sessionManager=self.session_manager,
+			customFieldsManager=self.custom_fields_manager,
+			eventManager=self.event_manager,
+			perfManager=self.perf_manager,
+			about=vim.AboutInfo(
+				name='VMware vCenter Server (simulated)',
+				fullName='VMware vCenter Server 8.0.3 (simulated)',
+				version='8.0.3',
+				apiVersion='8.0.3.0',
+				apiType='VirtualCenter',
+				instanceUuid='00000000-0000-0000-0000-000000000000'
+			)
+		)
+		self._Add(vim.ServiceInstance, 'ServiceInstance', {'content': self.content}, moid='ServiceInstance')
+
+	def _Add(self, vimtype, prefix, props, moid=None):
+
+		moid = moid or f'{prefix}-{next(self.ids[prefix]) + 1}'
+		ref = vimtype(moid, self.stub)
+		obj = _SimObject(ref, props)
+		self.objects[moid] = obj
+		self.by_type[vimtype][moid] = obj
+
+		parent = props.get('parent')
+		if parent is not None:
+			self.children[parent._moId].append(ref)
+		if issubclass(vimtype, vim.Folder) or issubclass(vimtype, vim.Datacenter):
+			obj.dynamic.setdefault('childEntity', lambda: list(self.children[moid]))
+
+		self._Changed(moid, None)
+		if isinstance(ref, vim.ManagedEntity):
+			self._LogEvent()
+
+		return ref
+
+	def _Remove(self, ref):
+
+		obj = self.objects.pop(ref._moId)
+		self.by_type[type(ref)].pop(ref._moId, None)
+		parent = obj.props.get('parent')
+		if parent is not None and ref in self.children[parent._moId]:
+			self.children[parent._moId].remove(ref)
+		self._Changed(ref._moId, None)
+		if isinstance(ref, vim.ManagedEntity):
+			self._LogEvent()
+
+	def _Rebind(self, value):
+
+		if isinstance(value, VmomiSupport.ManagedObject):
+			return type(value)(value._moId, self.stub)
+		if isinstance(value, (list, tuple)):
+			return type(value)(self._Rebind(item) for item in value)
+		if isinstance(value, dict):
+			return {key: self._Rebind(item) for key, item in value.items()}
+
+		return value
+
+	def _Object(self, ref):
+
+		obj = self.objects.get(ref._moId)
+		if obj is None:
+			raise vmodl.fault.ManagedObjectNotFound(obj=ref)
+
+		return obj
+
+	def _Props(self, ref):
+
+		return self.objects[ref._moId].props
+
+	def _Children(self, ref, vimtype, parent_key='parent'):
+
+		if parent_key == 'parent':
+			return [child for child in self.children[ref._moId] if isinstance(child, vimtype)]
+
+		return [obj.ref for obj in self.by_type[vimtype].values() if obj.props.get(parent_key) == ref]
+
+	def _Datacenter(self, ref):
+
+		while ref is not None and not isinstance(ref, vim.Datacenter):
+			ref = self.objects[ref._moId].Get('parent')
+
+		return ref
+
+	def _IsDescendant(self, ref, ancestor):
+
+		while ref is not None:
+			if ref == ancestor:
+				return True
+			ref = self.objects[ref._moId].props.get('parent')
+
+		return False
+
+	def _Changed(self, moid, prop):
+
+		self.version += 1
+		self.change_log.append((self.version, moid, prop))
+		self.changed.notify_all()
+
+	def _LogEvent(self):
+
+		self.latest_event_key += 1
+		self._Changed('EventManager', 'latestEvent')
+
+	def _Now(self):
+
+		return datetime.datetime.now(tz=datetime.timezone.utc)
+
+	def _Copy(self, value):
+
+		if isinstance(value, (vmodl.DynamicData, list)):
+			return copy.deepcopy(value, {id(self.stub): self.stub})
+
+		return value
+
+	def _TypedArray(self, value):
+
+		# Plain lists are fine for property reads, but a DynamicProperty needs the
+		# typed array vCenter would send. Empty arrays are left out of the result.
+		if not isinstance(value, list) or hasattr(type(value), 'Item'):
+			return value
+		if not value:
+			return None
+		if all(isinstance(item, VmomiSupport.ManagedObject) for item in value):
+			return VmomiSupport.ManagedObject.Array(value)
+
+		return VmomiSupport.GetVmodlType(VmomiSupport.GetVmodlName(type(value[0])) + '[]')(value)
+
+	def _GetPath(self, obj, path):
+
+		name, _, rest = path.partition('.')
+		value = obj.Get(name)
+		for attribute in rest.split('.') if rest else ():
+			if value is None:
+				return None
+			value = getattr(value, attribute, None)
+
+		return value
+
+	# Simulated clock
+
+	def _Schedule(self, delay, callback):
+
+		if delay <= 0:
+			callback()
+			return
+
+		heapq.heappush(self.events, (time.monotonic() + delay, next(self.event_sequence), callback))
+		if self.event_thread is None:
+			self.event_thread = threading.Thread(target=self._RunEvents, name='vsphere-simulator', daemon=True)
+			self.event_thread.start()
+		self.changed.notify_all()
+
+	def _RunEvents(self):
+
+		with self.lock:
+			while True:
+				if not self.events:
+					self.changed.wait()
+					continue
+
+				due, _, callback = self.events[0]
+				delay = due - time.monotonic()
+				if delay > 0:
+					self.changed.wait(delay)
+					continue
+
+				heapq.heappop(self.events)
+				callback()
+
+	def _StartTask(self, entity, description_id, effect):
+
+		task = self._Add(vim.Task, 'task', {})
+		info = vim.TaskInfo(
+			key=task._moId,
+			task=task,
+			descriptionId=description_id,
+			entity=entity,
+			state=vim.TaskInfo.State.queued,
+			queueTime=self._Now(),
+			cancelled=False,
+			cancelable=False,
+			eventChainId=next(self.ids['event'])
+		)
+		self.objects[task._moId].props['info'] = info
+
+		def Run():
+			info.state = vim.TaskInfo.State.running
+			info.startTime = self._Now()
+			self._Changed(task._moId, 'info')
+			self._Schedule(self.task_run_time, Finish)
+
+		def Finish():
+			try:
+				info.result = effect()
+				info.state = vim.TaskInfo.State.success
+			except vmodl.MethodFault as fault:
+				info.error = fault
+				info.state = vim.TaskInfo.State.error
+			info.progress = 100
+			info.completeTime = self._Now()
+			self._Changed(task._moId, 'info')
+
+		self._Schedule(self.task_queue_time, Run)
+
+		return task
+
+	# ServiceInstance, views and the property collector
+
+	def _RetrieveServiceContent(self, obj, args):
+
+		return self._Copy(self.content)
+
+	def _CreateContainerView(self, obj, args):
+
+		container, types, recursive = args
+		view = self._Add(vim.view.ContainerView, 'session[simulator]view', {'container': container, 'type': types})
+		self.objects[view._moId].dynamic['view'] = lambda: self._ViewMembers(container, types, recursive)
+
+		return view
+
+	def _ViewMembers(self, container, types, recursive):
+
+		members = []
+		for vimtype, objects in list(self.by_type.items()):
+			if not any(issubclass(vimtype, wanted) for wanted in types or [vim.ManagedEntity]):
+				continue
+			for obj in objects.values():
+				parent = obj.props.get('parent')
+				if container == self.root_folder and recursive and parent is not None:
+					members.append(obj.ref)
+				elif parent == container or (recursive and self._IsDescendant(parent, container)):
+					members.append(obj.ref)
+
+		return members
+
+	def _DestroyObject(self, obj, args):
+
+		self._Remove(obj.ref)
+
+	def _CollectObjects(self, spec):
+
+		collected = {}
+		named = {}
+
+		def Visit(ref, select_set):
+			for selection in select_set or []:
+				if isinstance(selection, vmodl.query.PropertyCollector.TraversalSpec):
+					if selection.name:
+						named[selection.name] = selection
+					traversal = selection
+				else:
+					traversal = named.get(selection.name)
+				if traversal is None or not isinstance(ref, traversal.type):
+					continue
+
+				value = self.objects[ref._moId].Get(traversal.path)
+				for child in value if isinstance(value, list) else [value]:
+					if child is None or child._moId not in self.objects:
+						continue
+					if not traversal.skip:
+						collected.setdefault(child._moId, child)
+					Visit(child, traversal.selectSet)
+
+		for object_spec in spec.objectSet:
+			if object_spec.obj._moId not in self.objects:
+				continue
+			if not object_spec.skip:
+				collected.setdefault(object_spec.obj._moId, object_spec.obj)
+			Visit(object_spec.obj, object_spec.selectSet)
+
+		return list(collected.values())
+
+	def _PathsFor(self, ref, spec):
+
+		for prop_spec in spec.propSet:
+			if isinstance(ref, prop_spec.type):
+				if prop_spec.all:
+					return self.objects[ref._moId].Names()
+				return list(prop_spec.pathSet or [])
+
+		return None
+
+	def _ObjectContent(self, ref, paths):
+
+		obj = self.objects[ref._moId]
+		prop_set = []
+		for path in paths:
+			value = self._TypedArray(self._GetPath(obj, path))
+			if value is not None:
+				prop_set.append(vmodl.DynamicProperty(name=path, val=self._Copy(value)))
+
+		return vmodl.query.PropertyCollector.ObjectContent(obj=ref, propSet=prop_set)
+
+	def _Retrieve(self, spec_set):
+
+		contents = []
+		for spec in spec_set:
+			for ref in self._CollectObjects(spec):
+				paths = self._PathsFor(ref, spec)
+				if paths is not None:
+					contents.append(self._ObjectContent(ref, paths))
+
+		return contents
+
+	def _RetrieveProperties(self, obj, args):
+
+		return self._Retrieve(args[0])
+
+	def _RetrievePropertiesEx(self, obj, args):
+
+		spec_set, options = args
+		contents = self._Retrieve(spec_set)
+
+		return self._RetrievePage(contents, options.maxObjects if options else None)
+
+	def _RetrievePage(self, contents, max_objects):
+
+		if not contents:
+			return None
+
+		token = None
+		if max_objects and len(contents) > max_objects:
+			token = f'token-{next(self.ids["token"])}'
+			self.retrievals[token] = (contents[max_objects:], max_objects)
+			contents = contents[:max_objects]
+
+		return vmodl.query.PropertyCollector.RetrieveResult(objects=contents, token=token)
+
+	def _ContinueRetrievePropertiesEx(self, obj, args):
+
+		if args[0] not in self.retrievals:
+			raise vmodl.fault.InvalidArgument(invalidProperty='token')
+
+		contents, max_objects = self.retrievals.pop(args[0])
+
+		return self._RetrievePage(contents, max_objects)
+
+	def _CancelRetrievePropertiesEx(self, obj, args):
+
+		self.retrievals.pop(args[0], None)
+
+	def _CreateFilter(self, obj, args):
+
+		spec, partial_updates = args
+		property_filter = self._Add(vmodl.query.PropertyCollector.Filter, 'session[simulator]filter', {'spec': spec})
+		self.filters[property_filter._moId] = {
+			'spec': spec,
+			'known': set(),
+			'ref': property_filter,
+			'collector': obj.ref._moId
+		}
+
+		return property_filter
+
+	def _CreatePropertyCollector(self, obj, args):
+
+		# Each collector sees only its own filters, so independent watchers in one
+		# session do not receive each other's updates.
+		return self._Add(vmodl.query.PropertyCollector, 'session[simulator]collector', {})
+
+	def _DestroyPropertyCollector(self, obj, args):
+
+		for moid in [moid for moid, item in self.filters.items() if item['collector'] == obj.ref._moId]:
+			self._Remove(self.filters.pop(moid)['ref'])
+		self._Remove(obj.ref)
+
+	def _DestroyFilter(self, obj, args):
+
+		self.filters.pop(obj.ref._moId, None)
+		self._Remove(obj.ref)
+
+	def _WaitForUpdatesEx(self, obj, args):
+
+		version, options = args
+		max_wait = options.maxWaitSeconds if options else None
+
+		return self._WaitForUpdates(obj, version, max_wait)
+
+	def _CancelWaitForUpdates(self, obj, args):
+
+		self.cancelled_waits += 1
+		self.changed.notify_all()
+
+	def _WaitForUpdates(self, obj, version, max_wait):
+
+		deadline = None if max_wait is None else time.monotonic() + max_wait
+		cancelled_waits = self.cancelled_waits
+		since = int(version) if version else None
+
+		while True:
+			update = self._CollectUpdates(obj.ref._moId, since)
+			if update is not None:
+				return update
+
+			since = self.version
+			if self.cancelled_waits != cancelled_waits:
+				raise vmodl.fault.RequestCanceled()
+
+			timeout = None if deadline is None else deadline - time.monotonic()
+			if timeout is not None and timeout <= 0:
+				return None
+			self.changed.wait(timeout)
+
+	def _CollectUpdates(self, collector, since):
+
+		changes = collections.defaultdict(set)
+		full = since is None or (self.change_log and self.change_log[0][0] > since + 1)
+		if not full:
+			for changed_version, moid, prop in reversed(self.change_log):
+				if changed_version <= since:
+					break
+				changes[moid].add(prop)
+			if not changes:
+				return None
+
+		filter_updates = []
+		for property_filter in [item for item in self.filters.values() if item['collector'] == collector]:
+			spec = property_filter['spec']
+			current = {ref._moId: ref for ref in self._CollectObjects(spec)}
+			object_updates = []
+
+			for moid in [moid for moid in property_filter['known'] if moid not in current]:
+				if full or moid in changes:
+					property_filter['known'].discard(moid)
+					object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+						kind='leave',
+						obj=self._Ref(moid, spec)
+					))
+
+			for moid, ref in current.items():
+				if not full and moid not in changes:
+					continue
+				paths = self._PathsFor(ref, spec)
+				if paths is None:
+					continue
+				entered = moid not in property_filter['known']
+				if not entered and not full:
+					changed_props = changes[moid]
+					if None not in changed_props:
+						paths = [path for path in paths if path.split('.', 1)[0] in changed_props]
+					if not paths:
+						continue
+				property_filter['known'].add(moid)
+				content = self._ObjectContent(ref, paths)
+				object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+					kind='enter' if entered else 'modify',
+					obj=ref,
+					changeSet=[
+						vmodl.query.PropertyCollector.Change(name=prop.name, op='assign', val=prop.val)
+						for prop in content.propSet
+					]
+				))
+
+			if object_updates:
+				filter_updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+					filter=property_filter['ref'],
+					objectSet=object_updates
+				))
+
+		if not filter_updates and not full:
+			return None
+
+		return vmodl.query.PropertyCollector.UpdateSet(version=str(self.version), filterSet=filter_updates)
+
+	def _Ref(self, moid, spec):
+
+		for object_spec in spec.objectSet:
+			if object_spec.obj._moId == moid:
+				return object_spec.obj
+
+		return vim.ManagedEntity(moid, self.stub)
+
+	# Performance
+
+	def _QueryPerf(self, obj, args):
+
+		# Answers CSV-format queries with values derived from the inventory.
+		# Powered-off VMs have no realtime samples and are left out, like on a
+		# real vCenter.
+		counters = {key: f'{group}.{name}' for key, group, name, _, _, _ in Simulator.PERF_COUNTERS}
+		results = []
+
+		for spec in args[0]:
+			interval = spec.intervalId or Simulator.REALTIME_INTERVAL
+			if interval != Simulator.REALTIME_INTERVAL and interval not in Simulator.HISTORICAL_INTERVALS:
+				raise vmodl.fault.InvalidArgument(invalidProperty='intervalId')
+
+			entity_obj = self._Object(spec.entity)
+			if isinstance(spec.entity, vim.VirtualMachine) and self._PowerState(entity_obj) != 'poweredOn':
+				continue
+			if not isinstance(spec.entity, (vim.VirtualMachine, vim.HostSystem)):
+				continue
+
+			end = int((spec.endTime or self._Now()).timestamp()) // interval * interval
+			if spec.startTime is not None:
+				count = max(0, (end - int(spec.startTime.timestamp())) // interval)
+			else:
+				count = spec.maxSample or 1
+			count = min(count, spec.maxSample or count)
+			times = [end - interval * (count - 1 - index) for index in range(count)]
+
+			sample_info = ','.join(
+				f'{interval},{datetime.datetime.fromtimestamp(when, tz=datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}'
+				for when in times
+			)
+			series = [
+				vim.PerformanceManager.MetricSeriesCSV(
+					id=metric_id,
+					value=','.join(str(self._PerfValue(spec.entity, counters[metric_id.counterId], when // interval)) for when in times)
+				)
+				for metric_id in spec.metricId or []
+				if metric_id.counterId in counters
+			]
+			results.append(vim.PerformanceManager.EntityMetricCSV(entity=spec.entity, sampleInfoCSV=sample_info, value=series))
+
+		return results
+
+	def _PerfValue(self, entity, counter, sample):
+
+		if isinstance(entity, vim.HostSystem):
+			host = self.objects[entity._moId].data
+			vms = [vm for vm in host['vms'] if self._PowerState(self.objects[vm._moId]) == 'poweredOn']
+			if counter == 'cpu.usage':
+				return self._PerfValue(entity, 'cpu.usagemhz', sample) * 10000 // (host['cpu_mhz'] * host['cpu_cores'])
+			if counter == 'mem.usage':
+				return self._PerfValue(entity, 'mem.consumed', sample) * 1024 * 10000 // host['memory_bytes']
+			return sum(self._PerfValue(vm, counter, sample) for vm in vms)
+
+		obj = self.objects[entity._moId]
+		number = int(entity._moId.rsplit('-', 1)[-1])
+		mhz = obj.data['cpu_usage_mhz'] + (number + sample) % 7 * 10
+		hardware = obj.Get('config').hardware
+
+		if counter == 'cpu.usagemhz':
+			return mhz
+		if counter == 'cpu.usage':
+			host = self.objects[obj.Get('runtime').host._moId].data
+			return mhz * 10000 // (hardware.numCPU * host['cpu_mhz'])
+		if counter == 'mem.consumed':
+			return obj.data['memory_usage_mb'] * 1024
+		if counter == 'mem.usage':
+			return obj.data['memory_usage_mb'] * 10000 // hardware.memoryMB
+		if counter == 'disk.usage':
+			return (number * 13 + sample * 5) % 2000
+		if counter == 'net.usage':
+			return (number * 7 + sample * 3) % 1000
+
+		return 0
+
+	# Datastore browser
+
+	def _SearchDatastoreSubFolders(self, obj, args):
+
+		datastore_path, search_spec = args
+		datastore = obj.Get('datastore')
+		datastore_obj = self._Object(datastore)
+		name = datastore_obj.Get('name')
+		root = datastore_path.split(']', 1)[-1].strip().strip('/')
+		patterns = (search_spec.matchPattern if search_spec else None) or ['*']
+
+		def Effect():
+			with self.lock:
+				folders = collections.defaultdict(list)
+				for path, (size, modified) in self._DatastoreFiles(datastore_obj, name).items():
+					folder, _, file_name = path.rpartition('/')
+					if root and folder != root and not folder.startswith(f'{root}/'):
+						continue
+					if not any(fnmatch.fnmatch(file_name, pattern) for pattern in patterns):
+						continue
+					folders[folder].append(vim.host.DatastoreBrowser.FileInfo(path=file_name, fileSize=size, modification=modified))
+
+				return vim.host.DatastoreBrowser.SearchResults.Array([
+					vim.host.DatastoreBrowser.SearchResults(
+						datastore=datastore,
+						folderPath=f'[{name}] {folder}'.rstrip(),
+						file=sorted(files, key=lambda file: file.path)
+					)
+					for folder, files in sorted(folders.items())
+				])
+
+		return self._StartTask(datastore, 'HostDatastoreBrowser.searchSubFolders', Effect)
+
+	def _Uncommitted(self, datastore_obj, name):
+
+		# VM disks are thin provisioned, so all of their capacity is uncommitted;
+		# it changes whenever a VM or disk on the datastore comes or goes.
+		prefix = f'[{name}] '
+		uncommitted = 0
+		for vm in datastore_obj.data['vms']:
+			for device in self.objects[vm._moId].Get('config').hardware.device:
+				if isinstance(device, vim.vm.device.VirtualDisk) and device.backing.fileName.startswith(prefix):
+					uncommitted += device.capacityInKB * 1024
+
+		return uncommitted
+
+	def _DatastoreFiles(self, datastore_obj, name):
+
+		# Loose files plus the .vmx and disks of every VM stored on the datastore.
+		prefix = f'[{name}] '
+		files = dict(datastore_obj.data['files'])
+		for vm in datastore_obj.data['vms']:
+			vm_obj = self.objects[vm._moId]
+			config = vm_obj.Get('config')
+			modified = vm_obj.data['created']
+			if config.files.vmPathName.startswith(prefix):
+				files[config.files.vmPathName[len(prefix):]] = (4096, modified)
+			for device in config.hardware.device:
+				if isinstance(device, vim.vm.device.VirtualDisk) and device.backing.fileName.startswith(prefix):
+					files[device.backing.fileName[len(prefix):]] = (device.capacityInKB * 1024, modified)
+
+		return files
+
+	# Custom attributes
+
+	def _SetCustomValue(self, obj, args):
+
+		key, value = args
+		fields = self.objects[self.custom_fields_manager._moId].props['field']
+		field = next((field for field in fields if field.name == key), None)
+		if field is None:
+			field = vim.CustomFieldsManager.FieldDef(key=len(fields) + 100, name=key, type=str)
+			fields.append(field)
+			self._Changed(self.custom_fields_manager._moId, 'field')
+
+		custom_values = obj.props['customValue']
+		custom_values[:] = [item for item in custom_values if item.key != field.key]
+		custom_values.append(vim.CustomFieldsManager.StringValue(key=field.key, value=value))
+		self._Changed(obj.ref._moId, 'customValue')
+
+	# Virtual machines
+
+	def _NewVMConfig(self, vm, name, num_cpu, memory_mb, disks_gb, datastore_name, portgroup):
+
+		devices = [
+			vim.vm.device.VirtualIDEController(key=200, busNumber=0, device=[3000], deviceInfo=vim.Description(label='IDE 0', summary='IDE 0')),
+			vim.vm.device.VirtualIDEController(key=201, busNumber=1, device=[], deviceInfo=vim.Description(label='IDE 1', summary='IDE 1')),
+			vim.vm.device.VirtualCdrom(
+				key=3000,
+				controllerKey=200,
+				unitNumber=0,
+				deviceInfo=vim.Description(label='CD/DVD drive 1', summary='Remote device'),
+				backing=vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo(deviceName='', exclusive=False),
+				connectable=vim.vm.device.VirtualDevice.ConnectInfo(connected=False, startConnected=False, allowGuestControl=True)
+			),
+			vim.vm.device.ParaVirtualSCSIController(
+				key=1000,
+				busNumber=0,
+				scsiCtlrUnitNumber=7,
+				sharedBus=vim.vm.device.VirtualSCSIController.Sharing.noSharing,
+				deviceInfo=vim.Description(label='SCSI controller 0', summary='VMware paravirtual SCSI')
+			)
+		]
+
+		for index, disk_gb in enumerate(disks_gb):
+			devices.append(self._NewDisk(name, datastore_name, 2000 + index, 1000, index, disk_gb * 1024 * 1024, index + 1))
+
+		if portgroup is not None:
+			port_connection = vim.dvs.PortConnection(
+				portgroupKey=portgroup._moId,
+				switchUuid=self._Props(self._Props(portgroup)['dvs'])['uuid']
+			)
+			devices.append(vim.vm.device.VirtualVmxnet3(
+				key=4000,
+				controllerKey=100,
+				unitNumber=7,
+				macAddress=self._Address(vm, '00:50:56:{:02x}:{:02x}:{:02x}'),
+				wakeOnLanEnabled=True,
+				deviceInfo=vim.Description(label='Network adapter 1', summary=portgroup._moId),
+				connectable=vim.vm.device.VirtualDevice.ConnectInfo(connected=True, startConnected=True, allowGuestControl=True),
+				backing=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(port=port_connection)
+			))
+
+		config = vim.vm.ConfigInfo(
+			name=name,
+			guestId='otherLinux64Guest',
+			guestFullName='Other Linux (64-bit)',
+			uuid=f'4200{vm._moId}',
+			instanceUuid=f'5000{vm._moId}',
+			template=False,
+			cpuHotAddEnabled=True,
+			memoryHotAddEnabled=True,
+			files=vim.vm.FileInfo(vmPathName=f'[{datastore_name}] {name}/{name}.vmx'),
+			hardware=vim.vm.VirtualHardware(numCPU=num_cpu, numCoresPerSocket=1, memoryMB=memory_mb, device=devices)
+		)
+
+		port = self.objects[vm._moId].data['port'] if vm._moId in self.objects else None
+		if port is not None:
+			devices[-1].backing.port.portKey = port
+
+		return config
+
+	def _NewDisk(self, vm_name, datastore_name, key, controller_key, unit_number, capacity_kb, index, backing=None):
+
+		if backing is None:
+			backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(diskMode='persistent', thinProvisioned=True)
+		suffix = '' if index == 1 else f'_{index - 1}'
+		backing.fileName = backing.fileName or f'[{datastore_name}] {vm_name}/{vm_name}{suffix}.vmdk'
+
+		return vim.vm.device.VirtualDisk(
+			key=key,
+			controllerKey=controller_key,
+			unitNumber=unit_number,
+			capacityInKB=capacity_kb,
+			capacityInBytes=capacity_kb * 1024,
+			deviceInfo=vim.Description(label=f'Hard disk {index}', summary=f'{capacity_kb:,} KB'),
+			backing=backing
+		)
+
+	def _GuestInfo(self, vm, tools_running):
+
+		return vim.vm.GuestInfo(
+			toolsRunningStatus=Simulator.TOOLS_RUNNING if tools_running else Simulator.TOOLS_NOT_RUNNING,
+			toolsStatus='toolsOk' if tools_running else 'toolsNotRunning',
+			guestState='running' if tools_running else 'notRunning',
+			hostName=self.objects[vm._moId].Get('name') if tools_running else None,
+			ipAddress=self._Address(vm, '10.{}.{}.{}') if tools_running else None
+		)
+
+	def _Address(self, vm, template):
+
+		number = int(vm._moId.rsplit('-', 1)[-1])
+
+		return template.format(number >> 16 & 255, number >> 8 & 255, number & 255)
+
+	def _VMSummary(self, vm):
+
+		obj = self.objects[vm._moId]
+		config = obj.Get('config')
+		runtime = obj.Get('runtime')
+		powered_on = runtime.powerState == 'poweredOn'
+
+		return vim.vm.Summary(
+			vm=vm,
+			runtime=runtime,
+			config=vim.vm.Summary.ConfigSummary(
+				name=config.name,
+				numCpu=config.hardware.numCPU,
+				memorySizeMB=config.hardware.memoryMB,
+				vmPathName=config.files.vmPathName,
+				template=False
+			),
+			quickStats=vim.vm.Summary.QuickStats(
+				overallCpuUsage=obj.data['cpu_usage_mhz'] if powered_on else 0,
+				overallCpuDemand=obj.data['cpu_usage_mhz'] if powered_on else 0,
+				guestMemoryUsage=obj.data['memory_usage_mb'] if powered_on else 0,
+				hostMemoryUsage=min(obj.data['memory_usage_mb'], config.hardware.memoryMB) if powered_on else 0
+			),
+			overallStatus='green'
+		)
+
+	def _VMs(self, host):
+
+		return self.objects[host._moId].data['vms']
+
+	def _PowerState(self, obj):
+
+		return obj.Get('runtime').powerState
+
+	def _SetGuestRunning(self, vm, running):
+
+		obj = self.objects.get(vm._moId)
+		if obj is None:
+			return
+
+		if running and self._PowerState(obj) != 'poweredOn':
+			return
+
+		obj.props['guest'] = self._GuestInfo(vm, running)
+		obj.props['guestHeartbeatStatus'] = 'green' if running else 'gray'
+		self._Changed(vm._moId, 'guest')
+		self._Changed(vm._moId, 'guestHeartbeatStatus')
+
+	def _Boot(self, vm):
+
+		obj = self.objects[vm._moId]
+		obj.Get('runtime').bootTime = self._Now()
+		self._Changed(vm._moId, 'runtime')
+		self._SetGuestRunning(vm, False)
+		obj.data['boot'] = boot = object()
+		self._Schedule(self.guest_boot_time, lambda: obj.data.get('boot') is boot and self._SetGuestRunning(vm, True))
+
+	def _SetPowerState(self, vm, power_state):
+
+		obj = self.objects[vm._moId]
+		obj.Get('runtime').powerState = power_state
+		self._Changed(vm._moId, 'runtime')
+		if power_state == 'poweredOn':
+			self._Boot(vm)
+		else:
+			obj.Get('runtime').bootTime = None
+			obj.data['boot'] = None
+			self._SetGuestRunning(vm, False)
+
+	def _RequirePowerState(self, obj, power_state):
+
+		existing = self._PowerState(obj)
+		if existing != power_state:
+			raise vim.fault.InvalidPowerState(requestedState=power_state, existingState=existing)
+
+	def _PowerOnVM(self, obj, args):
+
+		def Effect():
+			self._RequirePowerState(obj, 'poweredOff')
+			self._SetPowerState(obj.ref, 'poweredOn')
+
+		return self._StartTask(obj.ref, 'VirtualMachine.powerOn', Effect)
+
+	def _PowerOffVM(self, obj, args):
+
+		def Effect():
+			self._RequirePowerState(obj, 'poweredOn')
+			self._SetPowerState(obj.ref, 'poweredOff')
+
+		return self._StartTask(obj.ref, 'VirtualMachine.powerOff', Effect)
+
+	def _ResetVM(self, obj, args):
+
+		def Effect():
+			self._RequirePowerState(obj, 'poweredOn')
+			self._Boot(obj.ref)
+
+		return self._StartTask(obj.ref, 'VirtualMachine.reset', Effect)
+
+	def _RequireTools(self, obj):
+
+		if obj.Get('guest').toolsRunningStatus != Simulator.TOOLS_RUNNING:
+			raise vim.fault.ToolsUnavailable()
+
+	def _RebootGuest(self, obj, args):
+
+		self._RequireTools(obj)
+		self._Schedule(0, lambda: self._Boot(obj.ref))
+
+	def _ShutdownGuest(self, obj, args):
+
+		self._RequireTools(obj)
+		self._SetGuestRunning(obj.ref, False)
+		self._Schedule(self.guest_boot_time, lambda: self._SetPowerState(obj.ref, 'poweredOff'))
+
+	def _ReconfigVM(self, obj, args):
+
+		spec = args[0]
+
+		def Effect():
+			hardware = obj.Get('config').hardware
+			powered_on = self._PowerState(obj) == 'poweredOn'
+
+			if spec.numCPUs and spec.numCPUs != hardware.numCPU:
+				if powered_on and spec.numCPUs < hardware.numCPU:
+					raise vim.fault.InvalidPowerState(requestedState='poweredOff', existingState='poweredOn')
+				hardware.numCPU = spec.numCPUs
+
+			if spec.memoryMB and spec.memoryMB != hardware.memoryMB:
+				if powered_on and spec.memoryMB < hardware.memoryMB:
+					raise vim.fault.InvalidPowerState(requestedState='poweredOff', existingState='poweredOn')
+				hardware.memoryMB = spec.memoryMB
+
+			if spec.deviceChange:
+				hardware.device = self._ApplyDeviceChanges(obj, list(hardware.device), spec.deviceChange)
+
+			self._Changed(obj.ref._moId, 'config')
+
+		return self._StartTask(obj.ref, 'VirtualMachine.reconfigure', Effect)
+
+	def _ApplyDeviceChanges(self, obj, devices, device_changes):
+
+		operation = vim.vm.device.VirtualDeviceSpec.Operation
+		by_key = {device.key: device for device in devices}
+		new_keys = {}
+		next_key = itertools.count(max(by_key, default=0) + 1)
+		config = obj.Get('config')
+		datastore_name = config.files.vmPathName.split(']', 1)[0].lstrip('[')
+
+		def Invalid(device):
+			return vim.fault.InvalidDeviceSpec(deviceIndex=device_changes.index(change), property='device')
+
+		for change in device_changes:
+			device = change.device
+			if change.operation == operation.add:
+				if device.key in by_key or device.key in new_keys:
+					raise Invalid(device)
+				key = next(next_key)
+				new_keys[device.key] = key
+				device = copy.deepcopy(device, {id(self.stub): self.stub})
+				device.key = key
+				device.controllerKey = new_keys.get(device.controllerKey, device.controllerKey)
+
+				if device.controllerKey is not None and device.controllerKey not in by_key:
+					raise Invalid(device)
+				if isinstance(device, vim.vm.device.VirtualDisk):
+					controller = by_key[device.controllerKey]
+					used = {other.unitNumber for other in by_key.values() if other.controllerKey == device.controllerKey}
+					reserved = getattr(controller, 'scsiCtlrUnitNumber', None)
+					if device.unitNumber is None or device.unitNumber in used or device.unitNumber == reserved:
+						raise Invalid(device)
+					index = sum(isinstance(other, vim.vm.device.VirtualDisk) for other in by_key.values()) + 1
+					device = self._NewDisk(
+						config.name,
+						datastore_name,
+						key,
+						device.controllerKey,
+						device.unitNumber,
+						device.capacityInKB,
+						index,
+						backing=device.backing
+					)
+				if isinstance(device, vim.vm.device.VirtualCdrom):
+					index = sum(isinstance(other, vim.vm.device.VirtualCdrom) for other in by_key.values()) + 1
+					device.deviceInfo = vim.Description(label=f'CD/DVD drive {index}', summary='ISO')
+					if device.unitNumber is None:
+						device.unitNumber = len(by_key[device.controllerKey].device)
+				if isinstance(device, vim.vm.device.VirtualController):
+					device.device = []
+					label = 'SCSI controller' if isinstance(device, vim.vm.device.VirtualSCSIController) else 'Controller'
+					device.deviceInfo = vim.Description(label=f'{label} {device.busNumber}', summary=label)
+				if device.controllerKey in by_key and isinstance(by_key[device.controllerKey], vim.vm.device.VirtualController):
+					by_key[device.controllerKey].device = list(by_key[device.controllerKey].device) + [key]
+				by_key[key] = device
+
+			elif change.operation == operation.edit:
+				existing = by_key.get(device.key)
+				if existing is None:
+					raise Invalid(device)
+				for prop in ('backing', 'connectable', 'capacityInKB'):
+					value = getattr(device, prop, None)
+					if value is not None:
+						if prop == 'capacityInKB' and value < existing.capacityInKB:
+							raise vim.fault.InvalidDeviceOperation(deviceIndex=device_changes.index(change))
+						setattr(existing, prop, copy.deepcopy(value, {id(self.stub): self.stub}))
+				if isinstance(existing, vim.vm.device.VirtualDisk):
+					existing.capacityInBytes = existing.capacityInKB * 1024
+				if isinstance(existing, vim.vm.device.VirtualEthernetCard):
+					self._ConnectNic(obj, existing)
+
+			elif change.operation == operation.remove:
+				if by_key.pop(device.key, None) is None:
+					raise Invalid(device)
+				for controller in by_key.values():
+					if isinstance(controller, vim.vm.device.VirtualController) and device.key in (controller.device or []):
+						controller.device = [key for key in controller.device if key != device.key]
+
+		return list(by_key.values())
+
+	def _ConnectNic(self, obj, nic):
+
+		port = getattr(nic.backing, 'port', None)
+		if port is None:
+			return
+
+		for dvs_obj in self.by_type[vim.dvs.VmwareDistributedVirtualSwitch].values():
+			ports = dvs_obj.data['ports']
+			for key, state in ports.items():
+				if state['vm'] == obj.ref and key != port.portKey:
+					state['vm'] = None
+			if dvs_obj.props['uuid'] == port.switchUuid and port.portKey in ports:
+				ports[port.portKey]['vm'] = obj.ref
+				obj.data['port'] = port.portKey
+
+	def _ClaimPort(self, dvs, portgroup_key, vm):
+
+		# Scans from just after the last port claimed in the portgroup, so filling
+		# a portgroup VM by VM stays linear.
+		data = self.objects[dvs._moId].data
+		keys = data['portgroup_ports'][portgroup_key]
+		start = data['claim_hints'].get(portgroup_key, 0)
+		for offset in range(len(keys)):
+			index = (start + offset) % len(keys)
+			if data['ports'][keys[index]]['vm'] is None:
+				data['ports'][keys[index]]['vm'] = vm
+				data['claim_hints'][portgroup_key] = index + 1
+				return keys[index]
+
+		return None
+
+	def _SnapshotTrees(self, vm_obj):
+
+		info = vm_obj.Get('snapshot')
+		stack = list(info.rootSnapshotList) if info else []
+		while stack:
+			tree = stack.pop()
+			yield tree
+			stack.extend(tree.childSnapshotList or [])
+
+	def _CreateSnapshot(self, obj, args):
+
+		name, description, memory, quiesce = args
+
+		def Effect():
+			snapshot = self._Add(vim.vm.Snapshot, 'snapshot', {'vm': obj.ref})
+			self.objects[snapshot._moId].data['vm'] = obj.ref
+			tree = vim.vm.SnapshotTree(
+				snapshot=snapshot,
+				vm=obj.ref,
+				name=name,
+				description=description or '',
+				id=next(self.ids['snapshot-id']) + 1,
+				createTime=self._Now(),
+				state=self._PowerState(obj),
+				quiesced=bool(quiesce),
+				childSnapshotList=[]
+			)
+
+			info = obj.props.get('snapshot')
+			parent = next((item for item in self._SnapshotTrees(obj) if item.snapshot == info.currentSnapshot), None) if info else None
+			if info is None:
+				obj.props['snapshot'] = vim.vm.SnapshotInfo(rootSnapshotList=[tree], currentSnapshot=snapshot)
+			elif parent is None:
+				info.rootSnapshotList = list(info.rootSnapshotList) + [tree]
+			else:
+				parent.childSnapshotList = list(parent.childSnapshotList) + [tree]
+			obj.props['snapshot'].currentSnapshot = snapshot
+			self._Changed(obj.ref._moId, 'snapshot')
+
+			return snapshot
+
+		return self._StartTask(obj.ref, 'VirtualMachine.createSnapshot', Effect)
+
+	def _RevertToSnapshot(self, obj, args):
+
+		vm_obj = self.objects[obj.data['vm']._moId]
+
+		def Effect():
+			vm_obj.props['snapshot'].currentSnapshot = obj.ref
+			self._Changed(vm_obj.ref._moId, 'snapshot')
+
+		return self._StartTask(vm_obj.ref, 'vm.Snapshot.revert', Effect)
+
+	def _RemoveSnapshot(self, obj, args):
+
+		remove_children = args[0]
+		vm_obj = self.objects[obj.data['vm']._moId]
+
+		def Effect():
+			info = vm_obj.props['snapshot']
+
+			def Prune(trees):
+				result = []
+				for tree in trees:
+					if tree.snapshot == obj.ref:
+						if not remove_children:
+							result.extend(tree.childSnapshotList)
+						continue
+					tree.childSnapshotList = Prune(tree.childSnapshotList)
+					result.append(tree)
+				return result
+
+			remaining = Prune(info.rootSnapshotList)
+			if not remaining:
+				vm_obj.props['snapshot'] = None
+			else:
+				info.rootSnapshotList = remaining
+				if info.currentSnapshot == obj.ref:
+					info.currentSnapshot = None
+			self._Remove(obj.ref)
+			self._Changed(vm_obj.ref._moId, 'snapshot')
+
+		return self._StartTask(vm_obj.ref, 'vm.Snapshot.remove', Effect)
+
+	def _MoveVM(self, obj, host):
+
+		if host is None:
+			return
+
+		old_host = obj.Get('runtime').host
+		if old_host is not None and old_host._moId in self.objects:
+			self._VMs(old_host).remove(obj.ref)
+		self._VMs(host).append(obj.ref)
+		obj.Get('runtime').host = host
+		self._Changed(obj.ref._moId, 'runtime')
+
+	def _MigrateVM(self, obj, args):
+
+		pool, host, priority, state = args
+
+		return self._StartTask(obj.ref, 'VirtualMachine.migrate', lambda: self._MoveVM(obj, host))
+
+	def _RelocateVM(self, obj, args):
+
+		spec = args[0]
+
+		return self._StartTask(obj.ref, 'VirtualMachine.relocate', lambda: self._MoveVM(obj, spec.host))
+
+	def _DestroyEntity(self, obj, args):
+
+		def Effect():
+			if isinstance(obj.ref, vim.VirtualMachine):
+				self._RequirePowerState(obj, 'poweredOff')
+				self._VMs(obj.Get('runtime').host).remove(obj.ref)
+				for datastore in obj.props['datastore']:
+					self.objects[datastore._moId].data['vms'].remove(obj.ref)
+				for dvs_obj in self.by_type[vim.dvs.VmwareDistributedVirtualSwitch].values():
+					for state in dvs_obj.data['ports'].values():
+						if state['vm'] == obj.ref:
+							state['vm'] = None
+			self._Remove(obj.ref)
+
+		return self._StartTask(obj.ref, 'ManagedEntity.destroy', Effect)
+
+	def _RenameEntity(self, obj, args):
+
+		def Effect():
+			obj.props['name'] = args[0]
+			self._Changed(obj.ref._moId, 'name')
+			self._LogEvent()
+			if isinstance(obj.ref, vim.VirtualMachine):
+				obj.Get('config').name = args[0]
+				self._Changed(obj.ref._moId, 'config')
+
+		return self._StartTask(obj.ref, 'ManagedEntity.rename', Effect)
+
+	# Compute resources
+
+	def _HostSummary(self, host):
+
+		obj = self.objects[host._moId]
+		vm_stats = [self._VMSummary(vm).quickStats for vm in obj.data['vms']]
+
+		return vim.host.Summary(
+			host=host,
+			hardware=vim.host.Summary.HardwareSummary(
+				cpuMhz=obj.data['cpu_mhz'],
+				numCpuCores=obj.data['cpu_cores'],
+				numCpuThreads=obj.data['cpu_cores'] * 2,
+				memorySize=obj.data['memory_bytes']
+			),
+			quickStats=vim.host.Summary.QuickStats(
+				overallCpuUsage=sum(stats.overallCpuUsage for stats in vm_stats),
+				overallMemoryUsage=sum(stats.hostMemoryUsage for stats in vm_stats)
+			),
+			runtime=obj.Get('runtime'),
+			config=vim.host.Summary.ConfigSummary(name=obj.Get('name')),
+			overallStatus='green'
+		)
+
+	def _ClusterDatastores(self, cluster):
+
+		datastores = {}
+		for host in self._Children(cluster, vim.HostSystem):
+			for datastore in self.objects[host._moId].props['datastore']:
+				datastores[datastore._moId] = datastore
+
+		return list(datastores.values())
+
+	def _ClusterSummary(self, cluster):
+
+		hosts = [self._HostSummary(host) for host in self._Children(cluster, vim.HostSystem)]
+		total_cpu = sum(host.hardware.cpuMhz * host.hardware.numCpuCores for host in hosts)
+		total_memory = sum(host.hardware.memorySize for host in hosts)
+
+		return vim.ClusterComputeResource.Summary(
+			totalCpu=total_cpu,
+			totalMemory=total_memory,
+			numHosts=len(hosts),
+			numEffectiveHosts=len(hosts),
+			effectiveCpu=total_cpu,
+			effectiveMemory=total_memory // 1024 ** 2,
+			usageSummary=vim.cluster.UsageSummary(
+				totalCpuCapacityMhz=total_cpu,
+				totalMemCapacityMB=total_memory // 1024 ** 2,
+				cpuDemandMhz=sum(host.quickStats.overallCpuUsage for host in hosts),
+				memDemandMB=sum(host.quickStats.overallMemoryUsage for host in hosts),
+				cpuReservationMhz=0,
+				memReservationMB=0
+			)
+		)
+
+	# Distributed switches
+
+	def _FetchDVPorts(self, obj, args):
+
+		criteria = args[0]
+		# A bare string is sent as a one element array, not matched as a substring.
+		port_keys = [criteria.portKey] if criteria is not None and isinstance(criteria.portKey, str) else getattr(criteria, 'portKey', None)
+		portgroup_keys = [criteria.portgroupKey] if criteria is not None and isinstance(criteria.portgroupKey, str) else getattr(criteria, 'portgroupKey', None)
+		ports = []
+		for key, state in obj.data['ports'].items():
+			if criteria is not None:
+				if port_keys and key not in port_keys:
+					continue
+				if portgroup_keys and (state['portgroup'] in portgroup_keys) != (criteria.inside is not False):
+					continue
+				if criteria.connected is not None and (state['vm'] is not None) != criteria.connected:
+					continue
+			ports.append(vim.dvs.DistributedVirtualPort(
+				key=key,
+				portgroupKey=state['portgroup'],
+				dvsUuid=obj.props['uuid'],
+				connectee=vim.dvs.PortConnectee(connectedEntity=state['vm'], type='vmVnic') if state['vm'] else None
+			))
+
+		return ports
+
+	def _AddDVPortgroup(self, obj, args):
+
+		def Effect():
+			for spec in args[0]:
+				vlan_id = spec.defaultPortConfig.vlan.vlanId if spec.defaultPortConfig and spec.defaultPortConfig.vlan else 0
+				self.AddPortgroup(spec.name, obj.ref, vlan_id=vlan_id, num_ports=spec.numPorts or 8)
+
+		return self._StartTask(obj.ref, 'DistributedVirtualSwitch.addPortgroups', Effect)
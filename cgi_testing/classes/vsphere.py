@@ -1,12 +1,51 @@
-import requests
-from pyVim.task import WaitForTask
-from pyVim.connect import SmartConnect, Disconnect
+import time
+import threading
+import contextlib
+import contextvars
 
-from pyVmomi import vim
+from cgi_testing.classes.lazy import LazyImport
+from cgi_testing.classes.retry import Retry
+from cgi_testing.classes.coalesce import SingleFlight
+from cgi_testing.classes.records import Columns, ClusterCapacityRecord, DiskRecord, Rows, SnapshotRecord, VmMetaRecord
+
+# Loaded on first use: a short-lived job that only lists VMs never pays for
+# requests, and importing this module does not load pyVmomi.
+requests = LazyImport('requests', namespace=globals())
+futures = LazyImport('concurrent.futures', namespace=globals())
+WaitForTask = LazyImport('pyVim.task', 'WaitForTask', globals())
+SmartConnect = LazyImport('pyVim.connect', 'SmartConnect', globals())
+Disconnect = LazyImport('pyVim.connect', 'Disconnect', globals())
+
+vim = LazyImport('pyVmomi', 'vim', globals())
+vmodl = LazyImport('pyVmomi', 'vmodl', globals())
 
 
 class Vsphere:
 
+	SCSI_UNITS_PER_CONTROLLER = 16
+	SCSI_RESERVED_UNIT = 7
+	SCSI_MAX_CONTROLLERS = 4
+
+	RETRY_POLICY = Retry.DEFAULT_POLICY
+	PROPERTY_PAGE_SIZE = 1000
+	# Optional InventoryCache consulted by GetObject before scanning.
+	INVENTORY = None
+	# Concurrent identical lookups share one fetch. An optional NameBatcher also
+	# merges lookups of different names into one bulk property retrieval.
+	IN_FLIGHT = SingleFlight()
+	LOOKUP_BATCHER = None
+	# Optional DatastoreIndex; when set, ISOs are only mounted if they exist.
+	DATASTORES = None
+	# Seconds a free port handed out by SearchPort is kept from other callers,
+	# long enough for the reconfigure that connects it.
+	PORT_LEASE = 60.0
+
+	_port_leases = {}
+	_port_lock = threading.Lock()
+
+	_task_observer = contextvars.ContextVar('vsphere_task_observer', default=None)
+	_lookup_batcher = contextvars.ContextVar('vsphere_lookup_batcher', default=None)
+
 	def __init__(self, host, user, pwd):
 
 		self.host = host
@@ -26,11 +65,15 @@ class Vsphere:
 	def Connect(host, user, pwd):
 
 		try:
-			return SmartConnect(
-				host=host,
-				user=user,
-				pwd=pwd,
-				disableSslCertValidation=True
+			return Retry.Call(
+				lambda: SmartConnect(
+					host=host,
+					user=user,
+					pwd=pwd,
+					disableSslCertValidation=True
+				),
+				idempotent=True,
+				policy=Vsphere.RETRY_POLICY
 			)
 
 		except Exception as e:
@@ -47,24 +90,160 @@ class Vsphere:
 
 	def GetObject(si, vimtype, name=None):
 
-		try:
-			container = si.content.viewManager.CreateContainerView(
+		if name and Vsphere.INVENTORY is not None:
+			cached = Vsphere.INVENTORY.Get(si, vimtype, name)
+			if cached is not None:
+				return cached
+
+		if not name:
+			try:
+				return Vsphere._ContainerView(si, vimtype).view
+			except Exception as e:
+				return False
+
+		return Vsphere.IN_FLIGHT.Do(
+			(id(si), vimtype, name.lower()),
+			lambda: Vsphere._LookupObject(si, vimtype, name)
+		)
+
+	def _LookupObject(si, vimtype, name):
+
+		batcher = Vsphere._lookup_batcher.get() or Vsphere.LOOKUP_BATCHER
+		if batcher is not None:
+			try:
+				found = batcher.Get(
+					(id(si), vimtype),
+					name.lower(),
+					lambda names: Vsphere._FindObjectsByName(si, vimtype, names)
+				)
+			except Exception as e:
+				return False
+		else:
+			try:
+				container = Vsphere._ContainerView(si, vimtype)
+			except Exception as e:
+				return False
+			found = next((x for x in container.view if x.name.lower() == name.lower()), None)
+
+		if found is None:
+			return False
+
+		if Vsphere.INVENTORY is not None:
+			Vsphere.INVENTORY.Put(si, vimtype, name, found)
+
+		return found
+
+	def _ContainerView(si, vimtype):
+
+		return Retry.Call(
+			lambda: si.content.viewManager.CreateContainerView(
 				si.content.rootFolder,
 				[vimtype],
 				True
-			)
+			),
+			idempotent=True,
+			policy=Vsphere.RETRY_POLICY
+		)
+
+	def _FindObjectsByName(si, vimtype, names):
+
+		# One paged name retrieval for a whole batch, stopping once all are found.
+		found = {}
+		for obj, props in Vsphere.IterObjectProperties(si, vimtype, ['name']):
+			name = (props.get('name') or '').lower()
+			if name in names and name not in found:
+				found[name] = obj
+				if len(found) == len(names):
+					break
 
+		return found
+
+	def GetLatestEventKey(si):
+
+		# Key of the newest vCenter event, a cheap token for "has anything changed".
+		try:
+			latest_event = si.content.eventManager.latestEvent
 		except Exception as e:
-			return False
+			return None
 
-		if not name:
-			return container.view
+		return str(latest_event.key) if latest_event else None
+
+	def GetObjectProperties(si, vimtype, properties, objects=None):
+
+		# Fetches `properties` of every object of `vimtype` (or of just `objects`)
+		# with paged property collector calls, instead of a round trip per object
+		# and property. Returns {managed object: {property path: value}}.
+		return dict(Vsphere.IterObjectProperties(si, vimtype, properties, objects))
+
+	def IterObjectProperties(si, vimtype, properties, objects=None, page_size=None):
+
+		# Yields (managed object, {property path: value}) as each page arrives, so
+		# memory stays at one page. Stopping early cancels the remaining pages.
+		content = si.content
+		collector = content.propertyCollector
+		container = None
+		token = None
+
+		if objects is None:
+			container = content.viewManager.CreateContainerView(content.rootFolder, [vimtype], True)
+			object_specs = [
+				vmodl.query.PropertyCollector.ObjectSpec(
+					obj=container,
+					skip=True,
+					selectSet=[
+						vmodl.query.PropertyCollector.TraversalSpec(
+							name='view',
+							type=vim.view.ContainerView,
+							path='view',
+							skip=False
+						)
+					]
+				)
+			]
+		else:
+			object_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objects]
 
-		for x in container.view:
-			if x.name.lower() == name.lower():
-				return x
+		filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+			objectSet=object_specs,
+			propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=list(properties))]
+		)
+		options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size or Vsphere.PROPERTY_PAGE_SIZE)
 
-		return False
+		try:
+			result = Retry.Call(
+				lambda: collector.RetrievePropertiesEx(specSet=[filter_spec], options=options),
+				idempotent=True,
+				policy=Vsphere.RETRY_POLICY
+			)
+			while result:
+				token = result.token
+				for object_content in result.objects:
+					yield object_content.obj, {prop.name: prop.val for prop in object_content.propSet}
+				if not token:
+					break
+				result = collector.ContinueRetrievePropertiesEx(token=token)
+				token = None
+		finally:
+			if token:
+				collector.CancelRetrievePropertiesEx(token=token)
+			if container is not None:
+				container.Destroy()
+
+	def IterObjects(si, vimtype, page_size=None):
+
+		for obj, _ in Vsphere.IterObjectProperties(si, vimtype, [], page_size=page_size):
+			yield obj
+
+	def IterVMs(si, page_size=None):
+
+		for _, props in Vsphere.IterObjectProperties(si, vim.VirtualMachine, ['name'], page_size=page_size):
+			yield props['name']
+
+	def IterVmMetas(si, page_size=None):
+
+		host_names = {host: props.get('name') for host, props in Vsphere.IterObjectProperties(si, vim.HostSystem, ['name'])}
+		for _, props in Vsphere.IterObjectProperties(si, vim.VirtualMachine, VmMetaRecord.PROPERTIES, page_size=page_size):
+			yield VmMetaRecord.FromProperties(props, host_names).ToDict()
 
 	def ConvertSICookieToDict(si_cookie):
 
@@ -75,7 +254,7 @@ class Vsphere:
 
 		return {cookie_name: cookie_text}
 
-	def UploadFileToDatastore(si, cloud_url, datastore_name, file, upload_folder, upload_file):
+	def UploadFileToDatastore(si, cloud_url, datastore_name, file, upload_folder, upload_file, port=443):
 
 		datastore = Vsphere.GetObject(si, vim.Datastore, datastore_name)
 		if not datastore:
@@ -84,7 +263,7 @@ class Vsphere:
 		datacenter = datastore.parent.parent.parent
 
 		response = requests.put(
-			url=f'https://{cloud_url}:443/folder/{upload_folder}/{upload_file}',
+			url=f'https://{cloud_url}:{port}/folder/{upload_folder}/{upload_file}',
 			params={
 				'dsName': datastore.info.name,
 				'dcPath': datacenter.name
@@ -95,7 +274,11 @@ class Vsphere:
 			verify=False
 		)
 
-		return response.status_code in [200, 201]
+		uploaded = response.status_code in [200, 201]
+		if uploaded and Vsphere.DATASTORES is not None:
+			Vsphere.DATASTORES.Put(datastore_name, f'{upload_folder}/{upload_file}', len(file) if isinstance(file, bytes) else None)
+
+		return uploaded
 
 	def GetVirtualCDSpec(virtual_cdrom_device, iso_path=None):
 
@@ -123,18 +306,30 @@ class Vsphere:
 		cdrom_label = f'CD/DVD drive {cdrom_number}'
 		virtual_cdrom_device = None
 		vm_obj = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
+		if not vm_obj:
+			return False
 
 		for dev in vm_obj.config.hardware.device:
 			if isinstance(dev, vim.vm.device.VirtualCdrom) and dev.deviceInfo.label == cdrom_label:
 				virtual_cdrom_device = dev
 
-		virtual_cd_spec = Vsphere.GetVirtualCDSpec(virtual_cdrom_device, f'[{datastore_name}] {iso_path}')
+		if virtual_cdrom_device is None:
+			return False
+
+		iso_file = f'[{datastore_name}] {iso_path}'
+		if Vsphere._IsISOMounted(virtual_cdrom_device, iso_file):
+			return True
+		if not Vsphere._ISOExists(datastore_name, iso_path):
+			return False
+
+		virtual_cd_spec = Vsphere.GetVirtualCDSpec(virtual_cdrom_device, iso_file)
 
 		dev_changes = [virtual_cd_spec]
 		spec = vim.vm.ConfigSpec()
 		spec.deviceChange = dev_changes
 
-		return Vsphere._ExecuteTask(vm_obj.ReconfigVM_Task, spec=spec)
+		with Retry.Idempotent():
+			return Vsphere._ExecuteTask(vm_obj.ReconfigVM_Task, spec=spec)
 
 	def PowerOnVM(si, vm_name):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
@@ -165,18 +360,72 @@ class Vsphere:
 			if not Vsphere.PowerOffVM(si, vm_name):
 				return False
 
-		return Vsphere._ExecuteTask(vm.Destroy_Task)
+		with Retry.Idempotent(lambda: not Vsphere.GetObject(si, vim.VirtualMachine, vm_name)):
+			return Vsphere._ExecuteTask(vm.Destroy_Task)
 
 	def _ChangeVMPowerState(vm, target_state, power_method):
 		if vm.runtime.powerState == target_state:
 			return True
-		return Vsphere._ExecuteTask(power_method)
+		with Retry.Idempotent(lambda: vm.runtime.powerState == target_state):
+			return Vsphere._ExecuteTask(power_method)
 
 
 	def _ExecuteTask(task_method, *args, **kwargs):
+		# Transient rejections and failed tasks are retried in place. A submission
+		# lost on the wire is only resent inside a Retry.Idempotent() block.
+		completion_status = Retry.RunTask(
+			lambda: Vsphere._SubmitTask(task_method, *args, **kwargs),
+			WaitForTask,
+			policy=Vsphere.RETRY_POLICY
+		)
+		return completion_status is True or completion_status == 'success'
+
+	def _SubmitTask(task_method, *args, **kwargs):
+
 		task = task_method(*args, **kwargs)
-		completion_status = WaitForTask(task)
-		return completion_status == 'success'
+		observer = Vsphere._task_observer.get()
+		if observer is not None and isinstance(task, vim.Task):
+			observer(task)
+
+		return task
+
+	@contextlib.contextmanager
+	def ObserveTasks(observer):
+
+		# Calls `observer(task)` for every task submitted inside the block, as
+		# soon as it is submitted, e.g. to record its MoRef before waiting on it.
+		token = Vsphere._task_observer.set(observer)
+		try:
+			yield
+		finally:
+			Vsphere._task_observer.reset(token)
+
+	@contextlib.contextmanager
+	def BatchLookups(batcher):
+
+		# Merges the name lookups made inside the block through `batcher` instead
+		# of LOOKUP_BATCHER, so one caller can batch without affecting the rest
+		# of the process.
+		token = Vsphere._lookup_batcher.set(batcher)
+		try:
+			yield
+		finally:
+			Vsphere._lookup_batcher.reset(token)
+
+	def _FindSnapshot(vm, snapshot_name):
+		snapshot_info = vm.snapshot
+		if not snapshot_info:
+			return None
+
+		# A snapshot taken while another exists is a child of it.
+		trees = list(snapshot_info.rootSnapshotList)
+		while trees:
+			snap = trees.pop(0)
+			if snap.name == snapshot_name:
+				return snap.snapshot
+			trees.extend(snap.childSnapshotList or [])
+
+		return None
 
 
 	def SnapshotVM(si, vm_name, snapshot_name, description):
@@ -184,59 +433,58 @@ class Vsphere:
 		if not vm:
 			return False
 
-		return Vsphere._ExecuteTask(
-			vm.CreateSnapshot,
-			name=snapshot_name,
-			description=description,
-			memory=True,
-			quiesce=False
-		)
+		with Retry.Idempotent(lambda: Vsphere._FindSnapshot(vm, snapshot_name) is not None):
+			return Vsphere._ExecuteTask(
+				vm.CreateSnapshot,
+				name=snapshot_name,
+				description=description,
+				memory=True,
+				quiesce=False
+			)
 
 	def RestoreVMFromSnapshot(si, vm_name, snapshot_name):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		if not vm:
 			return False
 
-		snapshot = None
-		for snap in vm.snapshot.rootSnapshotList:
-			if snap.name == snapshot_name:
-				snapshot = snap.snapshot
-				break
-
+		snapshot = Vsphere._FindSnapshot(vm, snapshot_name)
 		if not snapshot:
 			return False
 
-		return Vsphere._ExecuteTask(snapshot.RevertToSnapshot_Task)
+		with Retry.Idempotent():
+			return Vsphere._ExecuteTask(snapshot.RevertToSnapshot_Task)
 
 	def DeleteVMSnapshot(si, vm_name, snapshot_name):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		if not vm:
 			return False
 
-		snapshot = None
-		for snap in vm.snapshot.rootSnapshotList:
-			if snap.name == snapshot_name:
-				snapshot = snap.snapshot
-				break
-
+		snapshot = Vsphere._FindSnapshot(vm, snapshot_name)
 		if not snapshot:
 			return False
 
-		return Vsphere._ExecuteTask(snapshot.RemoveSnapshot_Task, removeChildren=False)
+		with Retry.Idempotent(lambda: Vsphere._FindSnapshot(vm, snapshot_name) is None):
+			return Vsphere._ExecuteTask(snapshot.RemoveSnapshot_Task, removeChildren=False)
 
 	def ListVMSnapshots(si, vm_name):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		if not vm:
 			return False
 
-		snapshots = []
+		snapshot_info = vm.snapshot
+		if not snapshot_info:
+			return []
+
+		return [SnapshotRecord(None, snapshot.name, snapshot.createTime).ToDict() for snapshot in snapshot_info.rootSnapshotList]
 
-		if vm.snapshot:
-			for snapshot in vm.snapshot.rootSnapshotList:
-				snapshots.append({
-					"Name": snapshot.name,
-					"Date": snapshot.createTime.strftime("%Y-%m-%d %H:%M:%S")
-				})
+	def ListFleetSnapshots(si, columnar=False):
+
+		# Root snapshots of every VM from one bulk property fetch.
+		snapshots = Columns(SnapshotRecord) if columnar else Rows()
+		for _, props in Vsphere.IterObjectProperties(si, vim.VirtualMachine, ['name', 'snapshot']):
+			snapshot_info = props.get('snapshot')
+			for snapshot in snapshot_info.rootSnapshotList if snapshot_info else []:
+				snapshots.append(SnapshotRecord(props['name'], snapshot.name, snapshot.createTime))
 
 		return snapshots
 
@@ -250,22 +498,33 @@ class Vsphere:
 		if not vm:
 			return False
 
-		return Vsphere._VmMeta(si, vm)
-	
-	def GetVmMetasByName(si, vm_names):
+		return Vsphere._VmMeta(si, vm).ToDict()
+
+	def GetVmMetasByName(si, vm_names, columnar=False):
 		if not vm_names:
-			return []
+			return Columns(VmMetaRecord) if columnar else Rows()
 
-		vms = Vsphere.GetObject(si, vim.VirtualMachine)
-		vm_metas = []
+		# One bulk fetch and a name index instead of a scan of every VM per name.
+		by_name = {
+			props.get('name'): props
+			for props in Vsphere.GetObjectProperties(si, vim.VirtualMachine, VmMetaRecord.PROPERTIES).values()
+		}
+		if any(vm_name not in by_name for vm_name in vm_names): # If a VM is not found, return False
+			return False
+
+		host_names = {host: props.get('name') for host, props in Vsphere.GetObjectProperties(si, vim.HostSystem, ['name']).items()}
+		vm_metas = Columns(VmMetaRecord) if columnar else Rows()
 		for vm_name in vm_names:
-			vm = next((vm for vm in vms if vm.name == vm_name), None)
-			if not vm: # If the VM is not found, return False
-				return False
-			meta = Vsphere._VmMeta(si, vm)
-			vm_metas.append(meta)
+			vm_metas.append(VmMetaRecord.FromProperties(by_name[vm_name], host_names))
 		return vm_metas
 
+	def _VmMeta(si, vm):
+
+		props = Vsphere.GetObjectProperties(si, vim.VirtualMachine, VmMetaRecord.PROPERTIES, objects=[vm]).get(vm, {})
+		host = props.get('runtime.host')
+
+		return VmMetaRecord.FromProperties(props, {host: host.name} if host is not None else None)
+
 	def ResizeVM(si, vm_name, new_cpu_count=None, new_ram_gb=None):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		if not vm:
@@ -293,18 +552,18 @@ class Vsphere:
 					raise Exception("Failed to power off VM for downsizing")
 
 			try:
-				task = vm.Reconfigure(spec)
-				completion_status = WaitForTask(task)
+				with Retry.Idempotent():
+					completion_status = Vsphere._ExecuteTask(vm.Reconfigure, spec)
 			except vim.fault.CpuHotPlugNotSupported:
 				if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
 					if not Vsphere.PowerOffVM(si, vm_name):
 						raise Exception("Failed to power off VM for resizing")
-					task = vm.Reconfigure(spec)
-					completion_status = WaitForTask(task)
+					with Retry.Idempotent():
+						completion_status = Vsphere._ExecuteTask(vm.Reconfigure, spec)
 				else:
 					raise
 
-			if completion_status != 'success':
+			if not completion_status:
 				raise Exception("Failed to resize VM")
 
 			if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOff and original_power_state == vim.VirtualMachinePowerState.poweredOn:
@@ -321,7 +580,8 @@ class Vsphere:
 		if not vm:
 			return False
 
-		return Vsphere._ExecuteTask(vm.Rename_Task, new_vm_name.upper())
+		with Retry.Idempotent(lambda: vm.name == new_vm_name.upper()):
+			return Vsphere._ExecuteTask(vm.Rename_Task, new_vm_name.upper())
 
 
 	def SetVMCustomAttributes(
@@ -346,7 +606,11 @@ class Vsphere:
 		try:
 			for key, value in attributes.items():
 				if value is not None:
-					vm.SetCustomValue(key=key, value=value)
+					Retry.Call(
+						lambda: vm.SetCustomValue(key=key, value=value),
+						idempotent=True,
+						policy=Vsphere.RETRY_POLICY
+					)
 
 			completion_status = 'success'
 
@@ -369,27 +633,62 @@ class Vsphere:
 		if not vm:
 			return None
 
-		hard_disks = []
-		for device in vm.config.hardware.device:
+		return Vsphere._DiskRecords(None, vm.config.hardware.device, Rows())
+
+	def ListFleetHardDisks(si, columnar=False):
+
+		# Disks of every VM from one bulk property fetch.
+		hard_disks = Columns(DiskRecord) if columnar else Rows()
+		for _, props in Vsphere.IterObjectProperties(si, vim.VirtualMachine, ['name', 'config.hardware.device']):
+			Vsphere._DiskRecords(props['name'], props.get('config.hardware.device') or [], hard_disks)
+
+		return hard_disks
+
+	def _DiskRecords(vm_name, devices, hard_disks):
+
+		for device in devices:
 			if isinstance(device, vim.vm.device.VirtualDisk):
-				disk_info = {
-					'Label': device.deviceInfo.label,
-					'CapacityGB': device.capacityInKB / (1024 * 1024),
-					'UnitNumber': device.unitNumber,
-					'BusNumber': device.controllerKey
-				}
-				hard_disks.append(disk_info)
+				hard_disks.append(DiskRecord(
+					vm_name,
+					device.deviceInfo.label,
+					device.capacityInKB / (1024 * 1024),
+					device.unitNumber,
+					device.controllerKey
+				))
 
 		return hard_disks
 
-	def AddDiskToVM(si, vm_name, disk_size_gb):
+	def AddDiskToVM(si, vm_name, disk_size_gb, thin_provisioned=False, eagerly_scrub=False):
+
+		return Vsphere.AddDisksToVM(si, vm_name, [disk_size_gb], thin_provisioned, eagerly_scrub)
+
+	def AddDisksToVM(si, vm_name, disk_sizes_gb, thin_provisioned=False, eagerly_scrub=False):
+
+		# A disk cannot be both thin provisioned and eagerly scrubbed.
+		if not disk_sizes_gb or (thin_provisioned and eagerly_scrub):
+			return False
 
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		if not vm:
 			return False
 
-		disk_spec = Vsphere._CreateDiskSpec(vm, disk_size_gb)
-		spec = vim.vm.ConfigSpec(deviceChange=[disk_spec])
+		slots, controller_specs = Vsphere._AllocateDiskSlots(vm, len(disk_sizes_gb))
+		if not slots:
+			return False
+
+		disk_specs = [
+			Vsphere._CreateDiskSpec(
+				vm,
+				disk_size_gb,
+				thin_provisioned=thin_provisioned,
+				eagerly_scrub=eagerly_scrub,
+				controller_key=controller_key,
+				unit_number=unit_number,
+				key=-(index + 1)
+			)
+			for index, (disk_size_gb, (controller_key, unit_number)) in enumerate(zip(disk_sizes_gb, slots))
+		]
+		spec = vim.vm.ConfigSpec(deviceChange=controller_specs + disk_specs)
 
 		return Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=spec)
 
@@ -414,9 +713,27 @@ class Vsphere:
 
 		spec = vim.vm.ConfigSpec(deviceChange=[disk_spec])
 
-		return Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=spec)
+		with Retry.Idempotent(lambda: not Vsphere.FindVirtualDisk(vm, disk_label)):
+			return Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=spec)
+
+	def _CreateDiskSpec(
+			vm,
+			disk_size_gb,
+			thin_provisioned=False,
+			eagerly_scrub=False,
+			controller_key=None,
+			unit_number=None,
+			key=-1
+	):
+
+		if thin_provisioned and eagerly_scrub:
+			raise ValueError('A disk cannot be both thin provisioned and eagerly scrubbed')
 
-	def _CreateDiskSpec(vm, disk_size_gb):
+		if controller_key is None:
+			slots, controller_specs = Vsphere._AllocateDiskSlots(vm, 1)
+			if not slots or controller_specs:
+				raise ValueError(f'No free SCSI unit left on the existing controllers of VM "{vm.name}"')
+			controller_key, unit_number = slots[0]
 
 		disk_spec = vim.vm.device.VirtualDeviceSpec()
 		disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
@@ -424,19 +741,74 @@ class Vsphere:
 
 		disk_backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
 		disk_backing.diskMode = 'persistent'
-		disk_backing.thinProvisioned = False
+		disk_backing.thinProvisioned = thin_provisioned
+		disk_backing.eagerlyScrub = eagerly_scrub
 
 		new_disk = vim.vm.device.VirtualDisk()
 		new_disk.backing = disk_backing
 		new_disk.capacityInKB = disk_size_gb * 1024 * 1024
-		new_disk.key = -1
-		new_disk.unitNumber = len([dev for dev in vm.config.hardware.device if isinstance(dev, vim.vm.device.VirtualDisk)]) + 1
-		new_disk.controllerKey = next(dev.key for dev in vm.config.hardware.device if isinstance(dev, vim.vm.device.VirtualSCSIController))
+		new_disk.key = key
+		new_disk.unitNumber = unit_number
+		new_disk.controllerKey = controller_key
 
 		disk_spec.device = new_disk
 
 		return disk_spec
 
+	def _AllocateDiskSlots(vm, count):
+
+		# Returns `count` free (controller key, unit number) pairs plus the specs of any
+		# paravirtual controllers that have to be added to host the overflow.
+		devices = vm.config.hardware.device
+		controllers = sorted(
+			(dev for dev in devices if isinstance(dev, vim.vm.device.VirtualSCSIController)),
+			key=lambda controller: controller.busNumber
+		)
+
+		used_units = {controller.key: set() for controller in controllers}
+		for dev in devices:
+			if dev.controllerKey in used_units and dev.unitNumber is not None:
+				used_units[dev.controllerKey].add(dev.unitNumber)
+
+		slots = []
+		for controller in controllers:
+			reserved_unit = controller.scsiCtlrUnitNumber if controller.scsiCtlrUnitNumber is not None else Vsphere.SCSI_RESERVED_UNIT
+			for unit_number in range(Vsphere.SCSI_UNITS_PER_CONTROLLER):
+				if len(slots) == count:
+					return slots, []
+				if unit_number != reserved_unit and unit_number not in used_units[controller.key]:
+					slots.append((controller.key, unit_number))
+
+		controller_specs = []
+		free_buses = sorted(set(range(Vsphere.SCSI_MAX_CONTROLLERS)) - {controller.busNumber for controller in controllers})
+		for bus_number in free_buses:
+			if len(slots) == count:
+				break
+			controller_spec = Vsphere._CreateSCSIControllerSpec(-(100 + bus_number), bus_number)
+			controller_specs.append(controller_spec)
+			for unit_number in range(Vsphere.SCSI_UNITS_PER_CONTROLLER):
+				if len(slots) == count:
+					break
+				if unit_number != Vsphere.SCSI_RESERVED_UNIT:
+					slots.append((controller_spec.device.key, unit_number))
+
+		if len(slots) < count:
+			return [], []
+
+		return slots, controller_specs
+
+	def _CreateSCSIControllerSpec(key, bus_number):
+
+		controller = vim.vm.device.ParaVirtualSCSIController()
+		controller.key = key
+		controller.busNumber = bus_number
+		controller.sharedBus = vim.vm.device.VirtualSCSIController.Sharing.noSharing
+
+		return vim.vm.device.VirtualDeviceSpec(
+			operation=vim.vm.device.VirtualDeviceSpec.Operation.add,
+			device=controller
+		)
+
 	def ExtendVMHardDisk(si, vm_name, disk_name, disk_size_gb):
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
 		vdisk = Vsphere.FindVirtualDisk(vm, disk_name)
@@ -447,7 +819,8 @@ class Vsphere:
 		vdisk.capacityInKB = disk_size_gb * 1024 * 1024
 		spec = Vsphere.CreateVirtualDiskConfigSpec(vdisk)
 
-		return Vsphere._ExecuteTask(vm.Reconfigure, spec)
+		with Retry.Idempotent():
+			return Vsphere._ExecuteTask(vm.Reconfigure, spec)
 
 	def FindVirtualDisk(vm, disk_name):
 		for device in vm.config.hardware.device:
@@ -474,14 +847,33 @@ class Vsphere:
 	def GetClusterInfo(si, name):
 		cluster = Vsphere.GetObject(si, vim.ClusterComputeResource, name)
 
-		return {
-			"TotalClusterCPU": cluster.summary.usageSummary.totalCpuCapacityMhz,
-			"TotalClusterMemory": cluster.summary.usageSummary.totalMemCapacityMB,
-			"CPUInUse": cluster.summary.usageSummary.cpuDemandMhz,
-			"MemoryInUse": cluster.summary.usageSummary.memDemandMB,
-			"CPUReserved": cluster.summary.usageSummary.cpuReservationMhz,
-			"MemoryReserved": cluster.summary.usageSummary.memReservationMB,
-		}
+		# One summary round trip; the legacy form carries no name.
+		info = Vsphere._ClusterCapacity(name, cluster.summary).ToDict()
+		del info['Name']
+
+		return info
+
+	def GetClustersInfo(si, columnar=False):
+
+		clusters = Columns(ClusterCapacityRecord) if columnar else Rows()
+		for props in Vsphere.GetObjectProperties(si, vim.ClusterComputeResource, ['name', 'summary']).values():
+			clusters.append(Vsphere._ClusterCapacity(props['name'], props['summary']))
+
+		return clusters
+
+	def _ClusterCapacity(name, summary):
+
+		usage = summary.usageSummary
+
+		return ClusterCapacityRecord(
+			name,
+			usage.totalCpuCapacityMhz,
+			usage.totalMemCapacityMB,
+			usage.cpuDemandMhz,
+			usage.memDemandMB,
+			usage.cpuReservationMhz,
+			usage.memReservationMB
+		)
 
 	def CreatePortGroup(si, name, dvs_name, vlan_id, num_ports=8):
 
@@ -505,33 +897,39 @@ class Vsphere:
 
 	def SearchPort(dvs, portgroup_key):
 
+		port = Vsphere._ClaimFreePort(dvs, portgroup_key)
+
+		return port.key if port else None
+
+	def _ClaimFreePort(dvs, portgroup_key):
+
+		# A free port stays free until a VM connects to it, so every caller would
+		# see the same first one; each caller is leased a different port instead.
 		criteria = vim.dvs.PortCriteria(connected=False, inside=True, portgroupKey=portgroup_key)
 		ports = dvs.FetchDVPorts(criteria=criteria)
 
-		return ports[0].key if ports else None
+		with Vsphere._port_lock:
+			now = time.monotonic()
+			for lease, expiry in list(Vsphere._port_leases.items()):
+				if expiry <= now:
+					del Vsphere._port_leases[lease]
+			for port in ports:
+				if (port.dvsUuid, port.key) not in Vsphere._port_leases:
+					Vsphere._port_leases[(port.dvsUuid, port.key)] = now + Vsphere.PORT_LEASE
+					return port
+
+		return None
 
 	def GetPortByPortgroup(si, dv_pg_name):
 
 		portgroup = Vsphere.GetObject(si, vim.dvs.DistributedVirtualPortgroup, dv_pg_name)
 		dvs = portgroup.config.distributedVirtualSwitch
-		port_key = Vsphere.SearchPort(dvs, portgroup.key)
-		criteria = vim.dvs.PortCriteria(portKey=port_key)
-		ports = dvs.FetchDVPorts(criteria=criteria)
 
-		return ports[0] if ports else None
+		return Vsphere._ClaimFreePort(dvs, portgroup.key)
 
-	def AttachPortgroupToVM(si, vm_name, dv_pg_name, vm_port):
-
-		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
-		port = Vsphere.GetPortByPortgroup(si, dv_pg_name)
-		nic_label = f'Network adapter {vm_port}'
-		virtual_nic_device = None
+	def GetVirtualNicSpec(virtual_nic_device, port):
 
-		for dev in vm.config.hardware.device:
-			if isinstance(dev, vim.vm.device.VirtualEthernetCard) and dev.deviceInfo.label == nic_label:
-				virtual_nic_device = dev
-
-		virtual_nic_spec = vim.vm.device.VirtualDeviceSpec(
+		return vim.vm.device.VirtualDeviceSpec(
 			operation=vim.vm.device.VirtualDeviceSpec.Operation.edit,
 			device=type(virtual_nic_device)(
 				key=virtual_nic_device.key,
@@ -548,6 +946,19 @@ class Vsphere:
 			)
 		)
 
+	def AttachPortgroupToVM(si, vm_name, dv_pg_name, vm_port):
+
+		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
+		port = Vsphere.GetPortByPortgroup(si, dv_pg_name)
+		nic_label = f'Network adapter {vm_port}'
+		virtual_nic_device = None
+
+		for dev in vm.config.hardware.device:
+			if isinstance(dev, vim.vm.device.VirtualEthernetCard) and dev.deviceInfo.label == nic_label:
+				virtual_nic_device = dev
+
+		virtual_nic_spec = Vsphere.GetVirtualNicSpec(virtual_nic_device, port)
+
 		dev_changes = [virtual_nic_spec]
 		spec = vim.vm.ConfigSpec()
 		spec.deviceChange = dev_changes
@@ -578,23 +989,135 @@ class Vsphere:
 		return cdrom
 
 	def AttachCDRomToVM(si, vm_name, datastore, iso_path):
+
+		# Mounts on a drive that has no ISO if there is one, and only adds a drive
+		# when every existing one is in use.
 		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
-		ide_controller = Vsphere.FindFreeIDEController(vm)
-		cdrom_operation = vim.vm.device.VirtualDeviceSpec.Operation
-		device_spec = vim.vm.device.VirtualDeviceSpec()
+		if not vm or not Vsphere._ISOExists(datastore, iso_path):
+			return False
 
-		backing = vim.vm.device.VirtualCdrom.IsoBackingInfo(fileName=f'[{datastore}] {iso_path}')
-		cdrom = Vsphere.GetNewCDRomSpec(ide_controller.key, backing)
+		return Vsphere._MountISO(vm, vm.config.hardware.device, f'[{datastore}] {iso_path}')
 
-		cdrom.connectable.connected = True
-		cdrom.connectable.startConnected = True
+	def MountISO(si, vm_names, datastore_name, iso_path, scheduler=None, max_workers=16):
 
-		device_spec.operation = cdrom_operation.add
-		device_spec.device = cdrom
-		config_spec = vim.vm.ConfigSpec(deviceChange=[device_spec])
-		WaitForTask(vm.Reconfigure(config_spec))
+		# Bulk form of AttachCDRomToVM. VMs that already have the ISO mounted are
+		# left alone. Returns {vm name: bool}.
+		iso_file = f'[{datastore_name}] {iso_path}'
+		if not Vsphere._ISOExists(datastore_name, iso_path):
+			return {vm_name: False for vm_name in vm_names}
 
-		return True
+		return Vsphere._BulkReconfigure(
+			si,
+			vm_names,
+			lambda vm, devices: Vsphere._MountISO(vm, devices, iso_file),
+			scheduler,
+			max_workers
+		)
+
+	def UnmountISO(si, vm_names, datastore_name=None, iso_path=None, scheduler=None, max_workers=16):
+
+		# Disconnects the given ISO, or any ISO when none is given, from every
+		# drive of the VMs. Returns {vm name: bool}.
+		iso_file = f'[{datastore_name}] {iso_path}' if iso_path else None
+
+		return Vsphere._BulkReconfigure(
+			si,
+			vm_names,
+			lambda vm, devices: Vsphere._UnmountISO(vm, devices, iso_file),
+			scheduler,
+			max_workers
+		)
+
+	def _BulkReconfigure(si, vm_names, apply, scheduler, max_workers):
+
+		# Finds the VMs and their devices with two bulk property calls, then runs
+		# `apply(vm, devices)` for each VM concurrently, or through `scheduler`.
+		wanted = set(vm_names)
+		refs = {
+			props['name']: vm
+			for vm, props in Vsphere.IterObjectProperties(si, vim.VirtualMachine, ['name'])
+			if props['name'] in wanted
+		}
+		devices = Vsphere.GetObjectProperties(si, vim.VirtualMachine, ['config.hardware.device'], list(refs.values())) if refs else {}
+
+		def Apply(si, vm_name):
+			vm = refs.get(vm_name)
+			if vm is None:
+				return False
+			try:
+				return apply(vm, devices.get(vm, {}).get('config.hardware.device') or [])
+			except Exception as e:
+				return False
+
+		if scheduler is not None:
+			return scheduler.Map(Apply, list(vm_names))
+
+		with futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vsphere-bulk') as executor:
+			return dict(zip(vm_names, executor.map(lambda vm_name: Apply(si, vm_name), vm_names)))
+
+	def _MountISO(vm, devices, iso_file):
+
+		device_spec = Vsphere._ISODeviceSpec(devices, iso_file)
+		if device_spec is None:
+			return True
+		if device_spec is False:
+			return False
+
+		# Checking the result first makes a resend safe for the add as well.
+		with Retry.Idempotent(lambda: Vsphere._ISODeviceSpec(vm.config.hardware.device, iso_file) is None):
+			return Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=vim.vm.ConfigSpec(deviceChange=[device_spec]))
+
+	def _UnmountISO(vm, devices, iso_file):
+
+		device_specs = [
+			Vsphere.GetVirtualCDSpec(device)
+			for device in devices
+			if isinstance(device, vim.vm.device.VirtualCdrom)
+			and isinstance(device.backing, vim.vm.device.VirtualCdrom.IsoBackingInfo)
+			and device.backing.fileName
+			and (iso_file is None or device.backing.fileName == iso_file)
+		]
+		if not device_specs:
+			return True
+
+		with Retry.Idempotent():
+			return Vsphere._ExecuteTask(vm.ReconfigVM_Task, spec=vim.vm.ConfigSpec(deviceChange=device_specs))
+
+	def _ISOExists(datastore_name, iso_path):
+
+		return Vsphere.DATASTORES is None or Vsphere.DATASTORES.Exists(datastore_name, iso_path)
+
+	def _ISODeviceSpec(devices, iso_file):
+
+		# None when the ISO is already mounted, an edit of a drive without an ISO,
+		# an add on a free IDE slot, or False when there is no room for a drive.
+		cdroms = [device for device in devices if isinstance(device, vim.vm.device.VirtualCdrom)]
+		if any(Vsphere._IsISOMounted(cdrom, iso_file) for cdrom in cdroms):
+			return None
+
+		for cdrom in cdroms:
+			if not isinstance(cdrom.backing, vim.vm.device.VirtualCdrom.IsoBackingInfo) or not cdrom.backing.fileName:
+				return Vsphere.GetVirtualCDSpec(cdrom, iso_file)
+
+		for device in devices:
+			if isinstance(device, vim.vm.device.VirtualIDEController) and len(device.device or []) < 2:
+				return vim.vm.device.VirtualDeviceSpec(
+					operation=vim.vm.device.VirtualDeviceSpec.Operation.add,
+					device=Vsphere.GetNewCDRomSpec(device.key, vim.vm.device.VirtualCdrom.IsoBackingInfo(fileName=iso_file))
+				)
+
+		return False
+
+	def _IsISOMounted(cdrom, iso_file):
+
+		backing = getattr(cdrom, 'backing', None)
+		connectable = getattr(cdrom, 'connectable', None)
+
+		return (
+			isinstance(backing, vim.vm.device.VirtualCdrom.IsoBackingInfo)
+			and backing.fileName == iso_file
+			and bool(connectable and connectable.startConnected)
+		)
 
 
 
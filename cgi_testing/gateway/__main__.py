@@ -0,0 +1,66 @@
+import os
+import sys
+import signal
+import argparse
+
+from cgi_testing.classes.inventory import InventoryCache
+from cgi_testing.classes.vsphere import Vsphere
+from cgi_testing.gateway.server import Gateway, GatewayServer
+
+
+def Main(argv=None):
+
+	parser = argparse.ArgumentParser(prog='python -m cgi_testing.gateway')
+	parser.add_argument('--vcenter', required=True, help='vCenter host')
+	parser.add_argument('--user', required=True, help='vCenter user')
+	parser.add_argument('--listen', default='127.0.0.1:8080', help='host:port to serve on')
+	parser.add_argument('--window', type=float, default=0.005, help='seconds over which requests are merged')
+	parser.add_argument('--max-workers', type=int, default=32, help='calls run against vCenter at once')
+	parser.add_argument('--max-pending', type=int, default=1024, help='admitted calls before new ones get 503')
+	parser.add_argument('--inventory', help='SQLite file for the name -> MoRef cache')
+	parser.add_argument('--keepalive', type=float, default=300, help='seconds between session checks, 0 to disable')
+	args = parser.parse_args(argv)
+
+	# Kept out of the command line, where other users could read them. Any
+	# local user can reach a loopback port, so the token is always required.
+	password = os.environ.get('CGI_TESTING_VCENTER_PASSWORD', '')
+	token = os.environ.get('CGI_TESTING_GATEWAY_TOKEN')
+	if not token:
+		print('Set CGI_TESTING_GATEWAY_TOKEN to the bearer token clients must send', file=sys.stderr)
+		return 1
+
+	connect = lambda: Vsphere.Connect(args.vcenter, args.user, password)
+	si = connect()
+	if not si:
+		print(f'Could not connect to {args.vcenter}', file=sys.stderr)
+		return 1
+
+	if args.inventory:
+		Vsphere.INVENTORY = InventoryCache(args.inventory, args.vcenter)
+		Vsphere.INVENTORY.Load()
+		Vsphere.INVENTORY.Reconcile(si)
+
+	host, _, port = args.listen.rpartition(':')
+	gateway = Gateway(si, args.window, args.max_workers, args.max_pending, connect=connect, keepalive=args.keepalive)
+	server = GatewayServer(gateway, (host, int(port)), token)
+	signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+	print(f'Serving on http://{host}:{server.server_address[1]}')
+
+	server.gateway.Start()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		server.gateway.Stop()
+		if Vsphere.INVENTORY is not None:
+			Vsphere.INVENTORY.Save()
+		# The session in use, a new login if the first one expired.
+		Vsphere.Disconnect(gateway.si)
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(Main())
@@ -0,0 +1,400 @@
+import hmac
+import json
+import math
+import time
+import datetime
+import ipaddress
+import threading
+import collections
+import http.server
+
+from pyVmomi import vim, vmodl, VmomiSupport
+
+from cgi_testing.classes.coalesce import NameBatcher
+from cgi_testing.classes.records import Record, Rows, VmMetaRecord
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class Overloaded(Exception):
+
+	pass
+
+
+class GatewayStats:
+
+	# Per-method request counts, errors and latency percentiles over the last
+	# `window` requests of each method, plus throughput since start.
+
+	def __init__(self, window=1024, clock=time.monotonic):
+
+		self.clock = clock
+		self.started = clock()
+		self.lock = threading.Lock()
+		self.counts = collections.Counter()
+		self.errors = collections.Counter()
+		self.rejected = 0
+		self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+
+	def Record(self, method, latency, error=False):
+
+		with self.lock:
+			self.counts[method] += 1
+			self.latencies[method].append(latency)
+			if error:
+				self.errors[method] += 1
+
+	def Reject(self):
+
+		with self.lock:
+			self.rejected += 1
+
+	def Snapshot(self):
+
+		with self.lock:
+			uptime = self.clock() - self.started
+			requests = sum(self.counts.values())
+
+			return {
+				'uptime': uptime,
+				'requests': requests,
+				'rejected': self.rejected,
+				'throughput': requests / uptime if uptime > 0 else 0.0,
+				'methods': {
+					method: dict(
+						count=count,
+						errors=self.errors[method],
+						**GatewayStats._Percentiles(self.latencies[method])
+					)
+					for method, count in sorted(self.counts.items())
+				}
+			}
+
+	def _Percentiles(latencies):
+
+		ordered = sorted(latencies)
+		if not ordered:
+			return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+
+		def Rank(percent):
+			return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * percent / 100) - 1)]
+
+		return {'p50': Rank(50), 'p95': Rank(95), 'p99': Rank(99), 'max': ordered[-1]}
+
+
+class Gateway:
+
+	# One long-lived vCenter session shared by every client. Single-VM lookups
+	# arriving within `window` seconds are merged into one bulk name retrieval,
+	# and the read methods in BULK_METHODS into one property fetch of just the
+	# looked up VMs per window. At most `max_workers` calls run at once; beyond
+	# `max_pending` admitted calls new ones are rejected so callers back off.
+	# With `connect`, a factory returning a new session, an expired session is
+	# replaced; every `keepalive` seconds the session is checked, which also
+	# keeps vCenter from dropping it as idle.
+
+	# Vsphere methods taking (si, vm_name, ...) that clients may call.
+	METHODS = (
+		'PowerOnVM',
+		'PowerOffVM',
+		'RebootVM',
+		'SnapshotVM',
+		'RestoreVMFromSnapshot',
+		'DeleteVMSnapshot',
+		'ListVMSnapshots',
+		'GetVmMeta',
+		'ResizeVM',
+		'RenameVM',
+		'SetVMCustomAttributes',
+		'GetVMCustomAttributes',
+		'ListVMHardDisks',
+		'AttachISOToVirtualMachine',
+		'AttachCDRomToVM',
+		'AttachPortgroupToVM'
+	)
+
+	def __init__(self, si, window=0.005, max_workers=32, max_pending=1024, stats=None, connect=None, keepalive=300):
+
+		self.si = si
+		self.window = window
+		self.max_pending = max_pending
+		self.workers = threading.BoundedSemaphore(max_workers)
+		self.batcher = NameBatcher(window=window)
+		self.stats = stats or GatewayStats()
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.connect = connect
+		self.keepalive = keepalive
+		self.renew_lock = threading.Lock()
+		self.renewals = 0
+		self.stopped = threading.Event()
+		self.keepalive_thread = None
+
+	def Start(self):
+
+		if self.keepalive:
+			self.stopped.clear()
+			self.keepalive_thread = threading.Thread(target=self._KeepAlive, name='vsphere-gateway-keepalive', daemon=True)
+			self.keepalive_thread.start()
+
+		return self
+
+	def Stop(self):
+
+		self.stopped.set()
+		if self.keepalive_thread is not None:
+			self.keepalive_thread.join()
+			self.keepalive_thread = None
+
+	def Call(self, method, vm_name, *args, **kwargs):
+
+		if method not in Gateway.METHODS:
+			raise ValueError(f'Unknown method "{method}"')
+
+		with self.lock:
+			if self.pending >= self.max_pending:
+				self.stats.Reject()
+				raise Overloaded(f'{self.pending} calls pending')
+			self.pending += 1
+
+		started = time.monotonic()
+		failed = True
+		try:
+			# Lookups are merged through this gateway's batcher only, other
+			# Vsphere callers in the process are left alone.
+			with self.workers, Vsphere.BatchLookups(self.batcher):
+				si = self.si
+				result = self._Dispatch(si, method, vm_name, args, kwargs)
+				# The Vsphere methods answer False on NotAuthenticated too, so a
+				# failure on a session that is gone is repeated once on a new one.
+				if result is False and not Gateway._SessionAlive(si) and self._Renew(si):
+					result = self._Dispatch(self.si, method, vm_name, args, kwargs)
+			failed = result is False
+			return result
+		finally:
+			with self.lock:
+				self.pending -= 1
+			self.stats.Record(method, time.monotonic() - started, failed)
+
+	def _Dispatch(self, si, method, vm_name, args, kwargs):
+
+		bulk = Gateway.BULK_METHODS.get(method)
+		if bulk is None or args or kwargs:
+			return getattr(Vsphere, method)(si, vm_name, *args, **kwargs)
+
+		# Same name resolution as every other method, then one fetch for the
+		# VMs of the whole window, grouped per session.
+		vm = Vsphere.GetObject(si, vim.VirtualMachine, vm_name)
+		if not vm:
+			return False
+		try:
+			result = self.batcher.Get((id(si), method), vm._moId, lambda moids: bulk(si, moids))
+		except vim.fault.NotAuthenticated as e:
+			return False
+
+		return False if result is None else result
+
+	def _KeepAlive(self):
+
+		while not self.stopped.wait(self.keepalive):
+			si = self.si
+			if not Gateway._SessionAlive(si):
+				self._Renew(si)
+
+	def _SessionAlive(si):
+
+		try:
+			return si.content.sessionManager.currentSession is not None
+		except Exception as e:
+			return False
+
+	def _Renew(self, expired_si):
+
+		# Concurrent callers that saw the same session fail log in only once.
+		with self.renew_lock:
+			if self.si is not expired_si:
+				return True
+			if self.connect is None:
+				return False
+			si = self.connect()
+			if not si:
+				return False
+			if Vsphere.INVENTORY is not None and Vsphere.INVENTORY.Serves(expired_si):
+				Vsphere.INVENTORY.Attach(si)
+			self.si = si
+			self.renewals += 1
+
+		return True
+
+	def _VmProperties(si, moids, properties):
+
+		# Properties of just these VMs. A VM deleted since its lookup fails the
+		# whole retrieval, so it is dropped and the rest fetched again.
+		vms = [vim.VirtualMachine(moid, si._stub) for moid in moids]
+		while vms:
+			try:
+				return {vm._moId: props for vm, props in Vsphere.GetObjectProperties(si, vim.VirtualMachine, properties, vms).items()}
+			except vmodl.fault.ManagedObjectNotFound as e:
+				remaining = [vm for vm in vms if vm._moId != getattr(e.obj, '_moId', None)]
+				if len(remaining) == len(vms):
+					raise
+				vms = remaining
+
+		return {}
+
+	def _GetVmMetas(si, moids):
+
+		metas = Gateway._VmProperties(si, moids, VmMetaRecord.PROPERTIES)
+		hosts = list({props['runtime.host'] for props in metas.values() if props.get('runtime.host') is not None})
+		host_names = {}
+		if hosts:
+			host_names = {host: props.get('name') for host, props in Vsphere.GetObjectProperties(si, vim.HostSystem, ['name'], hosts).items()}
+
+		return {moid: VmMetaRecord.FromProperties(props, host_names).ToDict() for moid, props in metas.items()}
+
+	def _ListVMHardDisks(si, moids):
+
+		return {
+			moid: Vsphere._DiskRecords(None, props.get('config.hardware.device') or [], Rows())
+			for moid, props in Gateway._VmProperties(si, moids, ['config.hardware.device']).items()
+		}
+
+	def _GetVMCustomAttributes(si, moids):
+
+		field_map = {field.key: field.name for field in si.content.customFieldsManager.field}
+
+		return {
+			moid: {field_map[value.key]: value.value for value in props.get('customValue') or []}
+			for moid, props in Gateway._VmProperties(si, moids, ['customValue']).items()
+		}
+
+	# Read methods answered for a whole window of VMs at once:
+	# {method: bulk(si, MoRef ids) -> {MoRef id: result}}. Writes are not merged,
+	# only their lookups: each is its own vCenter task with its own outcome.
+	BULK_METHODS = {
+		'GetVmMeta': _GetVmMetas,
+		'ListVMHardDisks': _ListVMHardDisks,
+		'GetVMCustomAttributes': _GetVMCustomAttributes
+	}
+
+
+def ToJson(value):
+
+	if isinstance(value, Record):
+		return value.ToDict()
+	if isinstance(value, (datetime.datetime, datetime.date)):
+		return value.isoformat()
+	if isinstance(value, VmomiSupport.ManagedObject):
+		return value._moId
+
+	raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class GatewayHandler(http.server.BaseHTTPRequestHandler):
+
+	# POST /v1/<Method> with {"vm_name": ..., "args": [...], "kwargs": {...}}
+	# answers {"result": ...}; GET /stats answers GatewayStats.Snapshot(). With
+	# a server token every request needs "Authorization: Bearer <token>".
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+
+		if not self._Authorized():
+			return
+		if self.path != '/stats':
+			return self._Reply(404, {'error': f'Unknown path {self.path}'})
+
+		stats = self.server.gateway.stats.Snapshot()
+		stats['pending'] = self.server.gateway.pending
+
+		self._Reply(200, stats)
+
+	def do_POST(self):
+
+		if not self._Authorized():
+			return
+		method = self.path[len('/v1/'):] if self.path.startswith('/v1/') else None
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+			result = self.server.gateway.Call(method, request['vm_name'], *request.get('args', []), **request.get('kwargs', {}))
+		except Overloaded as e:
+			return self._Reply(503, {'error': str(e)}, {'Retry-After': '1'})
+		except ValueError as e:
+			return self._Reply(404 if method not in Gateway.METHODS else 400, {'error': str(e)})
+		except (KeyError, TypeError) as e:
+			return self._Reply(400, {'error': f'Bad request: {e!r}'})
+		except Exception as e:
+			return self._Reply(500, {'error': repr(e)})
+
+		self._Reply(200, {'result': result})
+
+	def log_message(self, format, *args):
+
+		pass
+
+	def _Authorized(self):
+
+		token = self.server.token
+		if token is None:
+			return True
+
+		scheme, _, credentials = (self.headers.get('Authorization') or '').partition(' ')
+		if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode()):
+			return True
+
+		# The body is not read, so the connection cannot be reused.
+		self.close_connection = True
+		self._Reply(401, {'error': 'Missing or invalid bearer token'}, {'WWW-Authenticate': 'Bearer'})
+
+		return False
+
+	def _Reply(self, status, body, headers=None):
+
+		payload = json.dumps(body, default=ToJson).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(payload)
+
+
+class GatewayServer(http.server.ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, gateway, address=('127.0.0.1', 8080), token=None):
+
+		# Every call runs with the gateway's vCenter credentials, so without a
+		# token only this host may connect.
+		if token is None and not GatewayServer._Loopback(address[0]):
+			raise ValueError(f'Refusing to serve on {address[0]} without a token')
+
+		self.gateway = gateway
+		self.token = token
+		http.server.ThreadingHTTPServer.__init__(self, address, GatewayHandler)
+
+	def _Loopback(host):
+
+		if host == 'localhost':
+			return True
+		try:
+			return ipaddress.ip_address(host).is_loopback
+		except ValueError as e:
+			return False
+
+	def Start(self):
+
+		# Serves in a background thread; returns the bound (host, port).
+		self.gateway.Start()
+		self.thread = threading.Thread(target=self.serve_forever, name='vsphere-gateway', daemon=True)
+		self.thread.start()
+
+		return self.server_address
+
+	def Stop(self):
+
+		self.shutdown()
+		self.server_close()
+		self.gateway.Stop()
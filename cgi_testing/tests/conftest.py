@@ -0,0 +1,69 @@
+import pytest
+from unittest.mock import patch, MagicMock
+
+from cgi_testing.classes.retry import RetryPolicy
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+from cgi_testing.tests.fakes import FakeWaitForTask
+
+
+# Simulators share switch UUIDs and port keys, so leases must not outlive a test.
+@pytest.fixture(scope="function", autouse=True)
+def port_leases():
+    yield
+    Vsphere._port_leases.clear()
+
+
+@pytest.fixture(scope="function")
+def mock_si():
+    mock = MagicMock()
+    mock.content = MagicMock()
+    mock.content.viewManager = MagicMock()
+    mock.content.rootFolder = MagicMock()
+
+    return mock
+
+
+@pytest.fixture(scope="function")
+def mock_vm():
+    return MagicMock()
+
+
+# Each inventory shape is generated once per process; tests get their own
+# clone, so they can change it freely without paying for generation each time.
+# inventories(settings, **generate) takes Simulator(**settings) and
+# Generate(**generate) arguments; test modules override `simulator` with it.
+@pytest.fixture(scope="session")
+def inventories():
+    templates = {}
+
+    def Inventory(settings=None, **generate):
+        key = (tuple(sorted((settings or {}).items())), tuple(sorted(generate.items())))
+        if key not in templates:
+            templates[key] = Simulator(**(settings or {})).Generate(**generate)
+        return templates[key].Clone()
+
+    return Inventory
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories(vms=20, clusters=2, hosts_per_cluster=2, powered_on_ratio=1)
+
+
+@pytest.fixture(scope="function")
+def si(simulator):
+    return simulator.Connect()
+
+
+@pytest.fixture(scope="function")
+def no_retry_sleep(monkeypatch):
+    policy = RetryPolicy(sleep=lambda delay: None)
+    monkeypatch.setattr(Vsphere, "RETRY_POLICY", policy)
+    return policy
+
+
+@pytest.fixture(scope="function")
+def fake_wait_for_task():
+    with patch("cgi_testing.classes.vsphere.WaitForTask", side_effect=FakeWaitForTask) as wait_for_task:
+        yield wait_for_task
@@ -0,0 +1,56 @@
+from pyVmomi import vim
+
+
+# Task stand-in whose info.state steps through a scripted list of states, one
+# state per Step(); the last state sticks. A script ending in "error" makes
+# FakeWaitForTask raise `error`, the way pyVim's WaitForTask raises the fault.
+class FakeTask:
+    def __init__(self, states=("queued", "running", "success"), result=None, error=None):
+        self.states = list(states)
+        self.index = 0
+        self.info = vim.TaskInfo(
+            key="task-fake",
+            state=self.states[0],
+            result=result,
+            error=error,
+            cancelled=False,
+            cancelable=False,
+        )
+        self.seen = [self.states[0]]
+
+    def Step(self):
+        if self.index + 1 < len(self.states):
+            self.index += 1
+            self.info.state = self.states[self.index]
+            self.seen.append(self.info.state)
+        return self.info.state
+
+    def Done(self):
+        return self.info.state in ("success", "error")
+
+
+def FakeWaitForTask(task, *args, **kwargs):
+    while not task.Done():
+        if task.index + 1 == len(task.states):
+            raise AssertionError(f"task script {task.states} never finishes")
+        task.Step()
+
+    if task.info.state == "error":
+        raise task.info.error
+
+    return task.info.state
+
+
+# Side effect for a mocked task method (vm.ReconfigVM_Task, vm.PowerOn, ...):
+# each call returns the next scripted task, a tuple of states or a FakeTask.
+# Once the scripts run out the last one is used again.
+class TaskScript:
+    def __init__(self, *scripts):
+        self.scripts = list(scripts) or [("queued", "running", "success")]
+        self.tasks = []
+
+    def __call__(self, *args, **kwargs):
+        script = self.scripts[min(len(self.tasks), len(self.scripts) - 1)]
+        task = script if isinstance(script, FakeTask) else FakeTask(script)
+        self.tasks.append(task)
+        return task
@@ -0,0 +1,84 @@
+import warnings
+
+import pytest
+
+from cgi_testing.benchmarks import runner
+from cgi_testing.benchmarks.runner import Benchmark, Compare, FileSink, Percentile, Runner
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class TestBenchmarkRunner:
+    def test_percentile(self):
+        values = [0.4, 0.1, 0.3, 0.2]
+
+        assert Percentile(values, 50) == pytest.approx(0.25)
+        assert Percentile(values, 100) == 0.4
+        assert Percentile([], 90) == 0.0
+
+    def test_compare_flags_rpc_regressions_only_above_threshold(self):
+        baseline = {"GetVMs[100]": {"p50": 0.01, "rpc_calls": 100, "peak_memory_kb": 100}}
+
+        within = {"GetVMs[100]": {"p50": 0.01, "rpc_calls": 109, "peak_memory_kb": 100}}
+        above = {"GetVMs[100]": {"p50": 0.01, "rpc_calls": 111, "peak_memory_kb": 100}}
+
+        assert Compare(within, baseline, 0.1) == []
+        assert Compare(above, baseline, 0.1) == [
+            "GetVMs[100] rpc_calls: 111 > 110 (baseline 100)"
+        ]
+
+    def test_compare_uses_latency_threshold_for_percentiles(self):
+        baseline = {"GetVMs[100]": {"p50": 0.01}}
+        results = {"GetVMs[100]": {"p50": 0.015}}
+
+        assert Compare(results, baseline, 0.1, latency_threshold=1.0) == []
+        assert len(Compare(results, baseline, 0.1, latency_threshold=0.1)) == 1
+
+    def test_run_counts_rpc_calls_per_operation(self):
+        benchmark = Benchmark("GetVMs", lambda context: lambda: Vsphere.GetVMs(context.si), iterations=3)
+
+        results = Runner(sizes=(10,)).Run([benchmark])
+
+        assert results["GetVMs[10]"]["iterations"] == 3
+        assert results["GetVMs[10]"]["rpc_calls"] == 14
+
+    def test_baseline_round_trip(self, tmp_path):
+        path = str(tmp_path / "baseline.json")
+
+        runner.SaveBaseline({"GetVMs[10]": {"rpc_calls": 14}}, path)
+
+        assert runner.LoadBaseline(path) == {"GetVMs[10]": {"rpc_calls": 14}}
+        assert runner.LoadBaseline(str(tmp_path / "missing.json")) == {}
+
+
+class TestFileSink:
+    def test_upload_file_to_datastore(self):
+        si = Simulator().Generate(vms=1).Connect()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with FileSink() as sink:
+                result = Vsphere.UploadFileToDatastore(
+                    si, "127.0.0.1", "datastore-0000", b"payload", "iso", "test.iso", port=sink.port
+                )
+
+        assert result is True
+        assert sink.requests == 1
+        assert sink.bytes_received == len(b"payload")
+
+
+class TestImportBudget:
+    def test_vsphere_cold_import_is_within_budget(self):
+        results = {
+            "import[cgi_testing.classes.vsphere]": runner.MeasureImportTime("cgi_testing.classes.vsphere", repeats=3)
+        }
+
+        assert results["import[cgi_testing.classes.vsphere]"]["iterations"] == 3
+        assert runner.CheckImportBudgets(results) == []
+
+    def test_budget_violations_are_reported(self):
+        results = {"import[cgi_testing.classes.vsphere]": {"import_time": 0.5}}
+
+        assert runner.CheckImportBudgets(results) == [
+            "import[cgi_testing.classes.vsphere] import_time: 0.5 > budget 0.025"
+        ]
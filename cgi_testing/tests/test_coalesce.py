@@ -0,0 +1,134 @@
+import time
+import threading
+import concurrent.futures
+
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.coalesce import NameBatcher, SingleFlight
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def slow_simulator(inventories):
+    return inventories({"rpc_latency": 0.02}, vms=20, clusters=1, hosts_per_cluster=2)
+
+
+@pytest.fixture(scope="function")
+def batcher():
+    Vsphere.LOOKUP_BATCHER = NameBatcher(window=0.05)
+    yield Vsphere.LOOKUP_BATCHER
+    Vsphere.LOOKUP_BATCHER = None
+
+
+def RunConcurrently(function, arguments):
+    barrier = threading.Barrier(len(arguments))
+
+    def Call(argument):
+        barrier.wait()
+        return function(argument)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(arguments)) as executor:
+        return list(executor.map(Call, arguments))
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_fetch(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def Fetch():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = [executor.submit(flights.Do, "key", Fetch) for _ in range(4)]
+            while flights.shared < 3:
+                time.sleep(0.001)
+            release.set()
+
+        assert [result.result() for result in results] == ["result"] * 4
+        assert len(calls) == 1
+        assert flights.flights == {}
+
+    def test_errors_reach_every_caller(self):
+        flights = SingleFlight()
+
+        def Fetch():
+            raise vim.fault.NotFound()
+
+        with pytest.raises(vim.fault.NotFound):
+            flights.Do("key", Fetch)
+        assert flights.flights == {}
+
+    def test_later_calls_fetch_again(self):
+        flights = SingleFlight()
+
+        assert flights.Do("key", lambda: 1) == 1
+        assert flights.Do("key", lambda: 2) == 2
+
+
+class TestNameBatcher:
+    def test_names_within_the_window_are_fetched_together(self):
+        batcher = NameBatcher(window=0.05)
+        requested = []
+
+        def FetchMany(names):
+            requested.append(set(names))
+            return {name: name.upper() for name in names}
+
+        results = RunConcurrently(lambda name: batcher.Get("group", name, FetchMany), ["a", "B", "c"])
+
+        assert results == ["A", "B", "C"]
+        assert requested == [{"a", "B", "c"}]
+
+    def test_missing_names_resolve_to_none(self):
+        batcher = NameBatcher(window=0)
+
+        assert batcher.Get("group", "x", lambda names: {}) is None
+
+
+class TestLookupCoalescing:
+    def test_identical_lookups_share_one_scan(self, slow_simulator):
+        si = slow_simulator.Connect()
+        slow_simulator.ResetCounters()
+
+        vms = RunConcurrently(lambda _: Vsphere.GetObject(si, vim.VirtualMachine, "vm-00007"), range(8))
+
+        assert {vm._moId for vm in vms} == {slow_simulator.Find(vim.VirtualMachine, "vm-00007")._moId}
+        assert slow_simulator.rpc_calls_by_method["CreateContainerView"] == 1
+
+    def test_different_names_are_batched(self, slow_simulator, batcher):
+        si = slow_simulator.Connect()
+        slow_simulator.ResetCounters()
+        names = [f"vm-{index:05d}" for index in range(8)] + ["missing"]
+
+        vms = RunConcurrently(lambda name: Vsphere.GetObject(si, vim.VirtualMachine, name), names)
+
+        assert [vm.name for vm in vms[:-1]] == names[:-1]
+        assert vms[-1] is False
+        assert batcher.fetches == 1
+        assert slow_simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
+
+    def test_batch_lookups_applies_to_the_block_only(self, slow_simulator):
+        si = slow_simulator.Connect()
+        batcher = NameBatcher(window=0.05)
+
+        def Lookup(name):
+            with Vsphere.BatchLookups(batcher):
+                return Vsphere.GetObject(si, vim.VirtualMachine, name)
+
+        vms = RunConcurrently(Lookup, [f"vm-{index:05d}" for index in range(4)])
+
+        assert all(vms)
+        assert batcher.fetches == 1
+        assert Vsphere.LOOKUP_BATCHER is None
+
+    def test_concurrent_port_requests_get_distinct_ports(self, slow_simulator):
+        si = slow_simulator.Connect()
+
+        ports = RunConcurrently(lambda _: Vsphere.GetPortByPortgroup(si, "pg-0001"), range(4))
+
+        assert len({port.key for port in ports}) == 4
@@ -0,0 +1,94 @@
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.datastores import DatastoreIndex
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def index(simulator, si):
+    datastore = simulator.Find(vim.Datastore, "datastore-0000")
+    simulator.AddDatastoreFile(datastore, "iso/ubuntu-24.04.iso", 2 * 1024**3)
+    simulator.AddDatastoreFile(datastore, "old-vm/old-vm.vmdk", 1024)
+    simulator.AddDatastoreFile(datastore, "old-vm/old-vm-flat.vmdk", 40 * 1024**3)
+    index = DatastoreIndex(si)
+    index.Refresh()
+    return index
+
+
+@pytest.fixture(scope="function")
+def datastores(index):
+    Vsphere.DATASTORES = index
+    yield index
+    Vsphere.DATASTORES = None
+
+
+class TestDatastoreIndex:
+    def test_searches_every_datastore(self, simulator, si):
+        simulator.ResetCounters()
+
+        index = DatastoreIndex(si)
+
+        assert sorted(index.Refresh()) == ["datastore-0000", "datastore-0001"]
+        assert simulator.rpc_calls_by_method["SearchDatastoreSubFolders_Task"] == 2
+        assert len(index) == 20 * 2
+        assert index.Exists("datastore-0000", "vm-00000/vm-00000.vmdk", refresh=False)
+
+    def test_records_size_folder_and_modification_time(self, index):
+        (record,) = index.Find("UBUNTU-24.04.iso")
+
+        assert record.datastore == "datastore-0000"
+        assert record.folder == "iso"
+        assert record.size == 2 * 1024**3
+        assert record.modified is not None
+        assert record.path == "[datastore-0000] iso/ubuntu-24.04.iso"
+
+    def test_refresh_only_searches_changed_datastores(self, simulator, index):
+        simulator.AddDatastoreFile(simulator.Find(vim.Datastore, "datastore-0001"), "iso/debian.iso", 1024)
+        simulator.ResetCounters()
+
+        assert index.Refresh() == ["datastore-0001"]
+        assert index.Refresh() == []
+        assert simulator.rpc_calls_by_method["SearchDatastoreSubFolders_Task"] == 1
+        assert [record.datastore for record in index.Find("debian.iso")] == ["datastore-0001"]
+
+    def test_search(self, index):
+        assert [record.name for record in index.Search("iso/*")] == ["ubuntu-24.04.iso"]
+        assert index.Search("*.iso", datastore="datastore-0001") == []
+
+    def test_orphaned_vmdks(self, index):
+        assert [record.path for record in index.OrphanedVMDKs()] == ["[datastore-0000] old-vm/old-vm.vmdk"]
+
+    def test_deleted_vm_leaves_no_orphans_behind(self, simulator, si, index):
+        Vsphere.DeleteVm(si, "vm-00002")
+
+        assert "vm-00002.vmdk" not in [record.name for record in index.OrphanedVMDKs()]
+        index.Refresh(force=True)
+        assert index.Find("vm-00002.vmdk") == []
+
+    def test_miss_searches_the_datastore_again(self, simulator, index):
+        simulator.AddDatastoreFile(simulator.Find(vim.Datastore, "datastore-0000"), "iso/new.iso", 0)
+
+        assert index.Exists("datastore-0000", "/iso/new.iso")
+        assert not index.Exists("datastore-0000", "iso/missing.iso")
+
+    def test_repeated_misses_are_rate_limited(self, simulator, index):
+        simulator.ResetCounters()
+
+        for _ in range(3):
+            assert not index.Exists("datastore-0000", "iso/missing.iso")
+
+        assert simulator.rpc_calls_by_method["SearchDatastoreSubFolders_Task"] == 1
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
+
+
+class TestISOChecks:
+    def test_missing_iso_is_not_mounted(self, simulator, si, datastores):
+        assert Vsphere.AttachCDRomToVM(si, "vm-00001", "datastore-0000", "iso/missing.iso") is False
+        assert Vsphere.MountISO(si, ["vm-00001", "vm-00002"], "datastore-0000", "iso/missing.iso") == {
+            "vm-00001": False,
+            "vm-00002": False,
+        }
+
+    def test_indexed_iso_is_mounted(self, si, datastores):
+        assert Vsphere.AttachCDRomToVM(si, "vm-00001", "datastore-0000", "iso/ubuntu-24.04.iso") is True
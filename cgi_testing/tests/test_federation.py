@@ -0,0 +1,133 @@
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.federation import Federation
+
+
+@pytest.fixture(scope="function")
+def simulators(inventories):
+    return {
+        name: inventories({"seed": index}, vms=4, clusters=1, hosts_per_cluster=1, powered_on_ratio=0, prefix=name)
+        for index, name in enumerate(["vc1", "vc2", "vc3"])
+    }
+
+
+@pytest.fixture(scope="function")
+def federation(simulators):
+    federation = Federation({name: simulator.Connect() for name, simulator in simulators.items()})
+    yield federation
+    federation.Disconnect()
+
+
+def Placement(simulator):
+    return simulator.Find(vim.HostSystem, "esx-000-00.local"), simulator.Find(vim.Datastore, "datastore-0000")
+
+
+class TestFederation:
+    def test_get_vms_merges_every_vcenter(self, federation):
+        vms = federation.GetVMs()
+
+        assert len(vms) == 12
+        assert federation.Locate("vc2-00001") == "vc2"
+
+    def test_get_vms_keeps_the_case_of_names(self, simulators, federation):
+        simulators["vc1"].AddVM("WEB-01", *Placement(simulators["vc1"]))
+
+        vms = federation.GetVMs()
+
+        assert "WEB-01" in vms and "web-01" not in vms
+        assert federation.Locate("web-01") == "vc1"
+        assert federation.RenameVM("WEB-01", "Web-02")
+        assert federation.names["vc1"]["web-02"] == "WEB-02"
+        assert "WEB-02" in federation.GetVMs()
+
+    def test_routed_call_reaches_only_the_owning_vcenter(self, simulators, federation):
+        federation.RefreshIndex()
+        for simulator in simulators.values():
+            simulator.ResetCounters()
+
+        assert federation.PowerOnVM("vc3-00002")
+
+        vm = simulators["vc3"].Find(vim.VirtualMachine, "vc3-00002")
+        assert simulators["vc3"].GetProperty(vm, "runtime.powerState") == "poweredOn"
+        assert simulators["vc1"].rpc_calls == 0
+        assert simulators["vc2"].rpc_calls == 0
+
+    def test_index_miss_refreshes_once(self, simulators, federation):
+        federation.RefreshIndex()
+        simulators["vc1"].AddVM("late-vm", *Placement(simulators["vc1"]))
+
+        assert federation.Locate("late-vm") == "vc1"
+        assert federation.Locate("missing") is None
+        assert federation.PowerOnVM("missing") is False
+
+    def test_rename_and_delete_update_the_index(self, federation):
+        assert federation.RenameVM("vc1-00000", "renamed")
+        assert federation.index["renamed"] == "vc1"
+        assert "vc1-00000" not in federation.index
+
+        assert federation.DeleteVm("vc2-00003")
+        assert "vc2-00003" not in federation.index
+
+    def test_rename_by_keyword_updates_the_index(self, federation):
+        assert federation.RenameVM("vc1-00001", new_vm_name="renamed")
+        assert federation.index["renamed"] == "vc1"
+        assert "vc1-00001" not in federation.index
+
+    def test_vm_metas_by_name_keep_order_across_vcenters(self, federation):
+        metas = federation.GetVmMetasByName(["vc3-00001", "vc1-00002", "vc3-00000"])
+
+        assert [meta["Name"] for meta in metas] == ["vc3-00001", "vc1-00002", "vc3-00000"]
+        assert federation.GetVmMetasByName(["vc1-00000", "missing"]) is False
+
+    def test_fan_out_reports_failures_per_vcenter(self, federation):
+        def Failing(si):
+            if si is federation.sessions["vc2"]:
+                raise RuntimeError("unreachable")
+            return True
+
+        results = federation.FanOut(Failing)
+
+        assert results["vc1"] is True
+        assert isinstance(results["vc2"], RuntimeError)
+
+    def test_duplicate_names_are_reported(self, simulators, federation):
+        simulators["vc2"].AddVM("vc1-00000", *Placement(simulators["vc2"]))
+
+        federation.RefreshIndex()
+
+        assert federation.duplicates == {"vc1-00000": ["vc1", "vc2"]}
+        assert federation.Locate("vc1-00000") == "vc1"
+
+    def test_failed_vcenter_keeps_its_last_known_vms(self, simulators, federation):
+        federation.RefreshIndex()
+        simulators["vc2"].InjectFault("CreateContainerView", vim.fault.NotAuthenticated(), times=100)
+
+        federation.RefreshIndex()
+
+        assert federation.Locate("vc2-00001", refresh=False) == "vc2"
+        assert "vc2" in federation.errors
+
+    def test_recovered_vcenter_is_no_longer_reported(self, simulators, federation):
+        simulators["vc2"].InjectFault("CreateContainerView", vim.fault.NotAuthenticated())
+        federation.RefreshIndex()
+        assert "vc2" in federation.errors
+
+        federation.RefreshIndex()
+
+        assert federation.errors == {}
+        assert federation.Locate("vc2-00001", refresh=False) == "vc2"
+
+    def test_misses_are_cached(self, simulators, federation):
+        federation.RefreshIndex()
+        for simulator in simulators.values():
+            simulator.ResetCounters()
+
+        assert federation.Locate("missing") is None
+        assert federation.Locate("missing") is None
+
+        assert all(simulator.rpc_calls_by_method["CreateContainerView"] == 1 for simulator in simulators.values())
+
+    def test_unknown_attribute_raises(self, federation):
+        with pytest.raises(AttributeError):
+            federation.NotAMethod
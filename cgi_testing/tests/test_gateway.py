@@ -0,0 +1,210 @@
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.vsphere import Vsphere
+from cgi_testing.gateway.server import Gateway, GatewayServer, Overloaded
+
+
+@pytest.fixture(scope="function")
+def gateway(si):
+    gateway = Gateway(si, window=0.05).Start()
+    yield gateway
+    gateway.Stop()
+
+
+@pytest.fixture(scope="function")
+def server(si):
+    server = GatewayServer(Gateway(si, window=0.05), ("127.0.0.1", 0))
+    host, port = server.Start()
+    yield f"http://{host}:{port}"
+    server.Stop()
+
+
+def Post(url, body, headers=None):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json", **(headers or {})})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response), response.headers
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e), e.headers
+
+
+def Concurrently(function, arguments):
+    results = [None] * len(arguments)
+    barrier = threading.Barrier(len(arguments))
+
+    def Run(index):
+        barrier.wait()
+        results[index] = function(arguments[index])
+
+    threads = [threading.Thread(target=Run, args=(index,)) for index in range(len(arguments))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestGateway:
+    def test_concurrent_reads_share_one_fetch(self, simulator, gateway):
+        names = [f"vm-{index:05d}" for index in range(10)]
+        simulator.ResetCounters()
+
+        metas = Concurrently(lambda name: gateway.Call("GetVmMeta", name), names)
+
+        assert [meta["Name"] for meta in metas] == names
+        assert gateway.batcher.fetches == 2  # one name lookup, one property fetch
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] <= 3
+
+    def test_missing_vm_is_false(self, gateway):
+        assert gateway.Call("GetVmMeta", "no-such-vm") is False
+        assert gateway.stats.Snapshot()["methods"]["GetVmMeta"]["errors"] == 1
+
+    def test_other_methods_call_vsphere(self, si, gateway):
+        assert gateway.Call("PowerOffVM", "vm-00001")
+        assert Vsphere.GetVmMeta(si, "vm-00001")["PowerState"] == "poweredOff"
+
+    def test_unknown_method_is_refused(self, gateway):
+        with pytest.raises(ValueError):
+            gateway.Call("Disconnect", "vm-00001")
+
+    def test_overload_is_rejected(self, si):
+        gateway = Gateway(si, max_pending=0)
+
+        with pytest.raises(Overloaded):
+            gateway.Call("GetVmMeta", "vm-00001")
+        assert gateway.stats.Snapshot()["rejected"] == 1
+
+    def test_process_wide_batcher_is_untouched(self, gateway):
+        assert gateway.Call("GetVmMeta", "vm-00001")
+        assert Vsphere.LOOKUP_BATCHER is None
+
+    def test_reads_fetch_only_the_looked_up_vms(self, simulator, gateway, monkeypatch):
+        fetched = []
+        original = Vsphere.GetObjectProperties
+
+        def Spy(si, vimtype, properties, objects=None):
+            fetched.append((vimtype, tuple(properties), objects))
+            return original(si, vimtype, properties, objects)
+
+        monkeypatch.setattr(Vsphere, "GetObjectProperties", Spy)
+        names = ["vm-00001", "vm-00002"]
+
+        disks = Concurrently(lambda name: gateway.Call("ListVMHardDisks", name), names)
+
+        assert [[disk["Label"] for disk in vm_disks] for vm_disks in disks] == [["Hard disk 1"]] * 2
+        assert [(vimtype, properties) for vimtype, properties, _ in fetched] == [(vim.VirtualMachine, ("config.hardware.device",))]
+        assert {vm._moId for vm in fetched[0][2]} == {simulator.Find(vim.VirtualMachine, name)._moId for name in names}
+
+    def test_names_resolve_like_get_object(self, simulator, si, gateway):
+        host = simulator.Find(vim.HostSystem, "esx-000-00.local")
+        datastore = simulator.Find(vim.Datastore, "datastore-0000")
+        simulator.AddVM("Web", host, datastore, num_cpu=1)
+        simulator.AddVM("web", host, datastore, num_cpu=4)
+        names = ["Web", "web", "WEB"]
+
+        metas = Concurrently(lambda name: gateway.Call("GetVmMeta", name), names)
+
+        assert metas == [Vsphere.GetVmMeta(si, name) for name in names]
+
+    def test_batches_are_kept_per_session(self, simulator, gateway):
+        other = simulator.Clone()
+        other_gateway = Gateway(other.Connect(), window=0.05)
+        other_gateway.batcher = gateway.batcher
+        assert Vsphere.PowerOffVM(other_gateway.si, "vm-00001")
+
+        metas = Concurrently(lambda target: target.Call("GetVmMeta", "vm-00001"), [gateway, other_gateway])
+
+        assert [meta["PowerState"] for meta in metas] == ["poweredOn", "poweredOff"]
+
+    def test_expired_session_is_renewed(self, simulator, si):
+        gateway = Gateway(si, connect=simulator.Connect, keepalive=0).Start()
+        simulator.ExpireSession()
+
+        assert gateway.Call("GetVmMeta", "vm-00001")["Name"] == "vm-00001"
+        assert gateway.Call("PowerOffVM", "vm-00002")
+        assert gateway.renewals == 1
+        assert gateway.si is not si
+
+    def test_expired_session_without_connect_fails(self, simulator, si):
+        gateway = Gateway(si, keepalive=0).Start()
+        simulator.ExpireSession()
+
+        assert gateway.Call("GetVmMeta", "vm-00001") is False
+
+    def test_keepalive_renews_an_idle_session(self, simulator, si):
+        gateway = Gateway(si, connect=simulator.Connect, keepalive=0.01).Start()
+        try:
+            simulator.ExpireSession()
+            deadline = time.monotonic() + 5
+            while gateway.renewals == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            gateway.Stop()
+
+        assert gateway.renewals == 1
+        assert gateway.Call("GetVmMeta", "vm-00001")
+
+
+class TestGatewayServer:
+    def test_call(self, server):
+        status, body, _ = Post(f"{server}/v1/GetVmMeta", {"vm_name": "vm-00002"})
+
+        assert status == 200
+        assert body["result"]["Name"] == "vm-00002"
+
+    def test_call_with_arguments(self, server):
+        status, body, _ = Post(f"{server}/v1/SnapshotVM", {"vm_name": "vm-00003", "args": ["before", "test"]})
+
+        assert (status, body["result"]) == (200, True)
+
+    def test_errors(self, server):
+        assert Post(f"{server}/v1/Disconnect", {"vm_name": "vm-00001"})[0] == 404
+        assert Post(f"{server}/v1/GetVmMeta", {})[0] == 400
+        assert Post(f"{server}/v1/ResizeVM", {"vm_name": "vm-00001", "kwargs": {"cores": 2}})[0] == 400
+
+    def test_overload_asks_to_retry(self, si):
+        server = GatewayServer(Gateway(si, max_pending=0), ("127.0.0.1", 0))
+        host, port = server.Start()
+        try:
+            status, _, headers = Post(f"http://{host}:{port}/v1/GetVmMeta", {"vm_name": "vm-00001"})
+        finally:
+            server.Stop()
+
+        assert status == 503
+        assert headers["Retry-After"] == "1"
+
+    def test_token_is_required(self, si):
+        server = GatewayServer(Gateway(si), ("127.0.0.1", 0), token="secret")
+        host, port = server.Start()
+        url = f"http://{host}:{port}/v1/PowerOffVM"
+        try:
+            refused = [Post(url, {"vm_name": "vm-00001"}, headers)[0] for headers in ({}, {"Authorization": "Bearer wrong"})]
+            status, body, _ = Post(url, {"vm_name": "vm-00001"}, {"Authorization": "Bearer secret"})
+        finally:
+            server.Stop()
+
+        assert refused == [401, 401]
+        assert (status, body["result"]) == (200, True)
+
+    def test_remote_bind_needs_a_token(self, si):
+        with pytest.raises(ValueError):
+            GatewayServer(Gateway(si), ("0.0.0.0", 0))
+
+    def test_stats(self, server):
+        for name in ("vm-00001", "vm-00002", "no-such-vm"):
+            Post(f"{server}/v1/GetVmMeta", {"vm_name": name})
+
+        with urllib.request.urlopen(f"{server}/stats") as response:
+            stats = json.load(response)
+
+        methods = stats["methods"]["GetVmMeta"]
+        assert stats["requests"] == 3
+        assert (methods["count"], methods["errors"]) == (3, 1)
+        assert 0 < methods["p50"] <= methods["p99"] <= methods["max"]
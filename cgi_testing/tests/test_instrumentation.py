@@ -0,0 +1,163 @@
+import datetime
+import json
+import logging
+
+import pytest
+from unittest.mock import patch, MagicMock
+from pyVmomi import vim
+
+from cgi_testing.classes import vsphere
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+from cgi_testing.classes.instrumentation import (
+    Instrumentation,
+    JsonLogSink,
+    MemorySink,
+    PrometheusSink,
+)
+
+
+class FakeStub:
+    def __init__(self):
+        self.calls = []
+
+    def InvokeMethod(self, mo, info, args):
+        self.calls.append(info)
+        return "result"
+
+
+@pytest.fixture(scope="function")
+def sink():
+    sink = PrometheusSink()
+    Instrumentation.Enable(sink)
+    yield sink
+    Instrumentation.Disable()
+
+
+class TestInstrumentation:
+    def test_disabled_leaves_methods_untouched(self):
+        original = vars(Vsphere)["GetVMs"]
+
+        Instrumentation.Enable(MemorySink())
+        assert vars(Vsphere)["GetVMs"] is not original
+        Instrumentation.Disable()
+
+        assert vars(Vsphere)["GetVMs"] is original
+        assert Instrumentation.IsEnabled() is False
+
+    def test_records_wall_time_and_nested_rpc_calls(self, sink):
+        si = MagicMock()
+        si._stub = FakeStub()
+
+        def get_object(si, vimtype, name=None):
+            si._stub.InvokeMethod(None, "CreateContainerView", ())
+            si._stub.InvokeMethod(None, "Fetch", ())
+            return [MagicMock()]
+
+        with patch.object(
+            vsphere.Vsphere, "GetObject", Instrumentation._WrapMethod("GetObject", get_object)
+        ):
+            Vsphere.GetVMs(si)
+
+        stats = sink.Snapshot()
+        assert stats["GetObject"]["count"] == 1
+        assert stats["GetObject"]["rpc_calls"] == 2
+        assert stats["GetVMs"]["rpc_calls"] == 2
+        assert stats["GetVMs"]["wall_time"] >= stats["GetObject"]["wall_time"]
+
+    def test_generators_are_charged_only_while_running(self, sink):
+        simulator = Simulator().Generate(vms=20)
+        si = simulator.Connect()
+        simulator.ResetCounters()
+
+        for name in Vsphere.IterVMs(si, page_size=8):
+            Vsphere.GetObject(si, vim.VirtualMachine, name)
+
+        stats = sink.Snapshot()
+        assert stats["IterVMs"]["count"] == 1
+        assert stats["GetObject"]["count"] == 20
+        assert stats["IterVMs"]["rpc_calls"] == simulator.rpc_calls - stats["GetObject"]["rpc_calls"]
+        assert stats["IterObjectProperties"]["rpc_calls"] == stats["IterVMs"]["rpc_calls"]
+
+    def test_records_errors(self, sink):
+        with pytest.raises(AttributeError):
+            Vsphere.ConvertSICookieToDict(None)
+
+        assert sink.Snapshot()["ConvertSICookieToDict"]["errors"] == 1
+
+    def test_records_task_queue_and_run_time(self, sink):
+        queued = datetime.datetime(2024, 1, 1, 0, 0, 0)
+        task = MagicMock()
+        task.info.queueTime = queued
+        task.info.startTime = queued + datetime.timedelta(seconds=2)
+        task.info.completeTime = queued + datetime.timedelta(seconds=5)
+        task_method = MagicMock(return_value=task)
+
+        vm = MagicMock()
+        vm.CreateSnapshot = task_method
+
+        with patch("cgi_testing.classes.vsphere.Vsphere.GetObject", return_value=vm), patch(
+            "cgi_testing.classes.vsphere.WaitForTask",
+            Instrumentation._WrapWaitForTask(MagicMock(return_value="success")),
+        ):
+            assert Vsphere.SnapshotVM(MagicMock(), "vm", "snap", "desc") is True
+
+        stats = sink.Snapshot()["SnapshotVM"]
+        assert stats["tasks"] == 1
+        assert stats["task_queue_time"] == 2.0
+        assert stats["task_run_time"] == 3.0
+
+    def test_prometheus_exposition(self, sink):
+        Vsphere.ConvertSICookieToDict("a=b; Path=/sdk")
+
+        text = sink.Exposition()
+
+        assert '# TYPE vsphere_call_duration_seconds histogram' in text
+        assert 'vsphere_call_duration_seconds_bucket{method="ConvertSICookieToDict",le="+Inf"} 1' in text
+        assert 'vsphere_calls_total{method="ConvertSICookieToDict"} 1' in text
+
+    def test_instrument_stub_counts_bytes(self):
+        response = MagicMock()
+        response.read.return_value = b"<xml/>"
+        connection = MagicMock()
+        connection.getresponse.return_value = response
+
+        stub = FakeStub()
+        stub.GetConnection = MagicMock(return_value=connection)
+        return_connection = stub.ReturnConnection = MagicMock()
+
+        def invoke_method(mo, info, args):
+            conn = stub.GetConnection()
+            conn.request("POST", "/sdk", b"<request/>", {})
+            conn.getresponse().read()
+            stub.ReturnConnection(conn)
+
+        stub.InvokeMethod = invoke_method
+        si = MagicMock(_stub=stub)
+        sink = MemorySink()
+        Instrumentation.Enable(sink)
+        try:
+            Instrumentation.InstrumentStub(si)
+            Instrumentation._WrapMethod("Probe", lambda si: si._stub.InvokeMethod(None, None, ()))(si)
+        finally:
+            Instrumentation.Disable()
+
+        stats = sink.Snapshot()["Probe"]
+        assert stats["rpc_calls"] == 1
+        assert stats["bytes_sent"] == len(b"<request/>")
+        assert stats["bytes_received"] == len(b"<xml/>")
+        return_connection.assert_called_once_with(connection)
+
+
+class TestJsonLogSink:
+    def test_logs_one_json_line_per_call(self, caplog):
+        Instrumentation.Enable(JsonLogSink())
+        try:
+            with caplog.at_level(logging.INFO, logger="cgi_testing.vsphere"):
+                Vsphere.ConvertSICookieToDict("a=b; Path=/sdk")
+        finally:
+            Instrumentation.Disable()
+
+        record = json.loads(caplog.records[0].getMessage())
+        assert record["method"] == "ConvertSICookieToDict"
+        assert record["rpc_calls"] == 0
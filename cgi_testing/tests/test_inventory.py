@@ -0,0 +1,98 @@
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.inventory import InventoryCache
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def path(tmp_path):
+    return str(tmp_path / "inventory.sqlite")
+
+
+@pytest.fixture(scope="function")
+def inventory():
+    yield
+    Vsphere.INVENTORY = None
+
+
+class TestInventoryCache:
+    def test_warm_start_answers_lookups_without_calls(self, simulator, si, path):
+        InventoryCache(path, "vc1").Reconcile(si)
+        simulator.ResetCounters()
+
+        cache = InventoryCache(path, "vc1")
+
+        assert cache.Load()
+        assert simulator.rpc_calls == 0
+        assert cache.MoId(vim.VirtualMachine, "VM-00007") == simulator.Find(vim.VirtualMachine, "vm-00007")._moId
+        assert cache.MoId(vim.ClusterComputeResource, "cluster-001") is not None
+        assert cache.MoId(vim.dvs.DistributedVirtualPortgroup, "pg-0001") is not None
+
+    def test_unchanged_inventory_reconciles_with_one_call(self, simulator, si, path):
+        InventoryCache(path, "vc1").Reconcile(si)
+        cache = InventoryCache(path, "vc1")
+        cache.Load()
+        simulator.ResetCounters()
+
+        assert cache.Reconcile(si) is False
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 0
+        assert simulator.rpc_calls <= 2
+
+    def test_changed_inventory_is_rescanned(self, simulator, si, path):
+        InventoryCache(path, "vc1").Reconcile(si)
+        Vsphere.RenameVM(si, "vm-00003", "renamed")
+        cache = InventoryCache(path, "vc1")
+        cache.Load()
+
+        assert cache.Reconcile(si) is True
+        assert cache.MoId(vim.VirtualMachine, "renamed") is not None
+        assert cache.MoId(vim.VirtualMachine, "vm-00003") is None
+
+        reloaded = InventoryCache(path, "vc1")
+        reloaded.Load()
+        assert reloaded.version == cache.version
+        assert len(reloaded) == len(cache)
+
+    def test_stale_entry_is_verified_and_dropped(self, simulator, si, path):
+        cache = InventoryCache(path, "vc1")
+        cache.Reconcile(si)
+        Vsphere.RenameVM(si, "vm-00004", "moved")
+
+        assert cache.Get(si, vim.VirtualMachine, "vm-00004") is None
+        assert cache.MoId(vim.VirtualMachine, "vm-00004") is None
+        assert cache.Get(si, vim.VirtualMachine, "vm-00005").name == "vm-00005"
+
+    def test_vcenters_share_a_file_without_mixing(self, si, path):
+        InventoryCache(path, "vc1").Reconcile(si)
+
+        assert InventoryCache(path, "vc2").Load() is False
+
+    def test_get_object_uses_the_cache(self, simulator, si, path, inventory):
+        cache = InventoryCache(path, "vc1")
+        cache.Reconcile(si)
+        Vsphere.INVENTORY = cache
+        simulator.ResetCounters()
+
+        vm = Vsphere.GetObject(si, vim.VirtualMachine, "vm-00011")
+
+        assert vm.name == "vm-00011"
+        assert simulator.rpc_calls_by_method["CreateContainerView"] == 0
+
+    def test_get_object_fills_the_cache(self, si, path, inventory):
+        Vsphere.INVENTORY = InventoryCache(path, "vc1").Attach(si)
+
+        vm = Vsphere.GetObject(si, vim.VirtualMachine, "vm-00002")
+
+        assert Vsphere.INVENTORY.MoId(vim.VirtualMachine, "vm-00002") == vm._moId
+
+    def test_other_sessions_are_not_served(self, si, path, inventory):
+        other = Simulator().Generate(vms=12, clusters=1, hosts_per_cluster=1).Connect()
+        Vsphere.INVENTORY = InventoryCache(path, "vc1")
+        Vsphere.INVENTORY.Reconcile(si)
+        Vsphere.INVENTORY.Discard(vim.VirtualMachine, "vm-00003")
+
+        assert Vsphere.INVENTORY.Get(other, vim.VirtualMachine, "vm-00001") is None
+        Vsphere.GetObject(other, vim.VirtualMachine, "vm-00003")
+        assert Vsphere.INVENTORY.MoId(vim.VirtualMachine, "vm-00003") is None
@@ -0,0 +1,130 @@
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.journal import Journal, Step, Workflow
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+STEPS = [
+    Step("SnapshotVM", "pre-resize", "before resizing"),
+    Step("ResizeVM", new_cpu_count=4),
+    Step("RebootVM"),
+    Step("DeleteVMSnapshot", "pre-resize"),
+]
+
+
+@pytest.fixture(scope="function")
+def journal(tmp_path):
+    with Journal(str(tmp_path / "journal.sqlite")) as journal:
+        yield journal
+
+
+def TaskCalls(simulator):
+    return sum(count for method, count in simulator.rpc_calls_by_method.items() if method.endswith("_Task"))
+
+
+class TestJournal:
+    def test_group_commit(self, journal):
+        with journal.lock:
+            for index in range(50):
+                journal.Append("wf", f"vm-{index:05d}", 0, Journal.INTENT, wait=False)
+        journal.Flush()
+
+        assert journal.commits == 1
+        assert len(journal.Entries("wf")) == 50
+
+    def test_entries_survive_a_restart(self, tmp_path):
+        path = str(tmp_path / "journal.sqlite")
+        with Journal(path) as journal:
+            journal.Append("wf", "vm-00000", 0, Journal.SUBMITTED, task="task-7", detail={"power_state": "poweredOn"})
+
+        with Journal(path) as journal:
+            (entry,) = journal.Entries("wf")
+
+        assert (entry.state, entry.task, entry.detail) == (Journal.SUBMITTED, "task-7", {"power_state": "poweredOn"})
+
+    def test_progress_keeps_the_latest_attempt(self, journal):
+        journal.Append("wf", "vm-00000", 0, Journal.INTENT)
+        journal.Append("wf", "vm-00000", 0, Journal.FAILED)
+        journal.Append("wf", "vm-00000", 0, Journal.INTENT)
+        journal.Append("wf", "vm-00000", 0, Journal.SUBMITTED, task="task-1")
+
+        (step,) = journal.Progress("wf")["vm-00000"].values()
+
+        assert [entry.state for entry in step] == [Journal.INTENT, Journal.SUBMITTED]
+
+
+class TestWorkflow:
+    def test_runs_every_step(self, simulator, si, journal):
+        results = Workflow(si, journal, "resize", STEPS).Run(["vm-00001", "vm-00002"])
+
+        assert results == {"vm-00001": Workflow.DONE, "vm-00002": Workflow.DONE}
+        assert Vsphere.GetVmMeta(si, "vm-00001")["NumCPU"] == 4
+        assert Vsphere.ListVMSnapshots(si, "vm-00001") == []
+        submitted = [entry for entry in journal.Entries("resize") if entry.state == Journal.SUBMITTED]
+        assert all(entry.task.startswith("task-") for entry in submitted)
+
+    def test_finished_workflow_is_not_repeated(self, simulator, si, journal):
+        Workflow(si, journal, "resize", STEPS).Run(["vm-00001"])
+        simulator.ResetCounters()
+
+        assert Workflow(si, journal, "resize", STEPS).Run(["vm-00001"]) == {"vm-00001": Workflow.DONE}
+        assert TaskCalls(simulator) == 0
+
+    def test_running_task_is_reattached(self, journal):
+        simulator = Simulator(task_run_time=0.2).Generate(vms=2, clusters=1, hosts_per_cluster=1, powered_on_ratio=1)
+        si = simulator.Connect()
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+        # A previous worker journaled the snapshot task and died while it ran.
+        journal.Append("resize", "vm-00000", 0, Journal.INTENT)
+        task = vm.CreateSnapshot_Task(name="pre-resize", description="", memory=False, quiesce=False)
+        journal.Append("resize", "vm-00000", 0, Journal.SUBMITTED, task=task._moId)
+        simulator.ResetCounters()
+
+        assert Workflow(si, journal, "resize", STEPS).Run(["vm-00000"]) == {"vm-00000": Workflow.DONE}
+        assert simulator.rpc_calls_by_method["CreateSnapshot_Task"] == 0
+        assert journal.Progress("resize")["vm-00000"][0][-1].detail == {"resumed": True}
+
+    def test_resumes_from_the_first_incomplete_step(self, simulator, si, journal):
+        Vsphere.SnapshotVM(si, "vm-00003", "pre-resize", "")
+        journal.Append("resize", "vm-00003", 0, Journal.INTENT)
+        journal.Append("resize", "vm-00003", 0, Journal.DONE)
+        # Died between the intent and the submission of the resize.
+        journal.Append("resize", "vm-00003", 1, Journal.INTENT, detail={"power_state": "poweredOn"})
+        simulator.ResetCounters()
+
+        assert Workflow(si, journal, "resize", STEPS).Run(["vm-00003"]) == {"vm-00003": Workflow.DONE}
+        assert simulator.rpc_calls_by_method["CreateSnapshot_Task"] == 0
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 1
+        assert simulator.rpc_calls_by_method["RemoveSnapshot_Task"] == 1
+
+    def test_interrupted_resize_restores_the_power_state(self, simulator, si, journal):
+        Vsphere.PowerOffVM(si, "vm-00004")
+        Vsphere.ResizeVM(si, "vm-00004", new_cpu_count=4)
+        journal.Append("resize", "vm-00004", 0, Journal.DONE)
+        journal.Append("resize", "vm-00004", 1, Journal.INTENT, detail={"power_state": "poweredOn"})
+
+        Workflow(si, journal, "resize", STEPS[:2]).Run(["vm-00004"])
+
+        assert Vsphere.GetVmMeta(si, "vm-00004")["PowerState"] == "poweredOn"
+
+    def test_failed_step_stops_the_vm(self, simulator, si, journal):
+        results = Workflow(si, journal, "cleanup", [Step("DeleteVMSnapshot", "missing"), Step("RebootVM")]).Run(["vm-00005"])
+
+        assert results == {"vm-00005": Workflow.FAILED}
+        assert [entry.state for entry in journal.Entries("cleanup")] == [Journal.INTENT, Journal.FAILED]
+
+    def test_missing_vm_fails_alone(self, si, journal):
+        results = Workflow(si, journal, "resize", [Step("ResizeVM", new_cpu_count=2)]).Run(["vm-00000", "missing-vm"])
+
+        assert results == {"vm-00000": Workflow.DONE, "missing-vm": Workflow.FAILED}
+        assert [entry.state for entry in journal.Entries("resize") if entry.vm_name == "missing-vm"] == [Journal.INTENT, Journal.FAILED]
+
+    def test_failed_capture_fails_the_step(self, si, journal, monkeypatch):
+        monkeypatch.setitem(Workflow.CAPTURES, "ResizeVM", lambda si, vm_name: 1 / 0)
+
+        results = Workflow(si, journal, "resize", [Step("ResizeVM", new_cpu_count=2)]).Run(["vm-00000"])
+
+        assert results == {"vm-00000": Workflow.FAILED}
+        assert "ZeroDivisionError" in journal.Entries("resize")[-1].detail["error"]
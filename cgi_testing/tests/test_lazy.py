@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+from unittest.mock import patch
+
+from cgi_testing.classes.lazy import LazyImport
+
+
+class TestLazyImport:
+    def test_resolves_on_first_use_and_rebinds(self):
+        namespace = {}
+        namespace["dumps"] = LazyImport("json", "dumps", namespace)
+
+        assert namespace["dumps"]([1]) == "[1]"
+        assert namespace["dumps"] is __import__("json").dumps
+
+    def test_patching_through_the_stand_in(self):
+        json_module = LazyImport("json")
+
+        with patch.object(json_module, "dumps", return_value="patched"):
+            assert __import__("json").dumps(1) == "patched"
+        assert __import__("json").dumps(1) == "1"
+
+    def test_vsphere_import_loads_no_heavy_dependency(self):
+        code = (
+            "import sys, cgi_testing.classes.vsphere; "
+            "print(sorted(m for m in ('requests', 'pyVmomi', 'pyVim', 'http.client') if m in sys.modules))"
+        )
+        completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+        assert completed.stdout.strip() == "[]"
+
+    def test_listing_does_not_load_requests(self):
+        code = (
+            "import sys\n"
+            "from cgi_testing.classes.simulator import Simulator\n"
+            "from cgi_testing.classes.vsphere import Vsphere\n"
+            "si = Simulator().Generate(vms=3).Connect()\n"
+            "assert len(Vsphere.GetVMs(si)) == 3\n"
+            "print('requests' in sys.modules)\n"
+        )
+        completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+        assert completed.stdout.strip() == "False"
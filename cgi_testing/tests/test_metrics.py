@@ -0,0 +1,94 @@
+import math
+
+import pytest
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.metrics import PerformanceMetrics
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class TestPerformanceMetrics:
+    def test_one_query_covers_every_vm(self, simulator, si):
+        simulator.ResetCounters()
+
+        result = PerformanceMetrics(si).QueryVMs(["cpu.usagemhz", "mem.usage"], max_samples=3)
+
+        assert result.shape == (20, 2, 3)
+        assert len(result.values) == 20 * 2 * 3
+        assert result.units == ["megaHertz", "percent"]
+        assert simulator.rpc_calls_by_method["QueryPerf"] == 1
+        assert not any(math.isnan(value) for value in result.values)
+
+    def test_counters_are_resolved_once(self, simulator, si):
+        metrics = PerformanceMetrics(si)
+        metrics.QueryVMs(["cpu.usage"])
+        simulator.ResetCounters()
+
+        metrics.QueryVMs(["cpu.usage.average", "net.usage"])
+
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
+
+    def test_unknown_counter(self, si):
+        with pytest.raises(ValueError):
+            PerformanceMetrics(si).CounterId("cpu.ready")
+
+    def test_batches_are_bounded(self, simulator, si):
+        vms = [simulator.Find(vim.VirtualMachine, f"vm-{index:05d}") for index in range(20)]
+        simulator.ResetCounters()
+
+        PerformanceMetrics(si, batch_size=8).Query(vms, ["cpu.usage"])
+
+        assert simulator.rpc_calls_by_method["QueryPerf"] == 3
+
+    def test_historical_queries_respect_max_query_metrics(self, simulator, si):
+        simulator.ResetCounters()
+
+        result = PerformanceMetrics(si, max_query_metrics=8).QueryVMs(
+            ["cpu.usage", "mem.usage", "disk.usage", "net.usage"], interval=300, max_samples=2
+        )
+
+        assert simulator.rpc_calls_by_method["QueryPerf"] == 10
+        assert result.shape == (20, 4, 2)
+        assert result.timestamps[1] - result.timestamps[0] == 300
+
+    def test_powered_off_vm_has_no_samples(self, si):
+        Vsphere.PowerOffVM(si, "vm-00004")
+
+        result = PerformanceMetrics(si).QueryVMs(["cpu.usagemhz"], max_samples=2)
+
+        assert all(math.isnan(value) for value in result.Series("vm-00004", "cpu.usagemhz"))
+        latest = result.Latest("cpu.usagemhz")
+        assert latest["vm-00004"] is None
+        assert latest["vm-00005"] > 0
+
+    def test_series_of_explicit_entities_by_moid(self, simulator, si):
+        vm = simulator.Find(vim.VirtualMachine, "vm-00003")
+
+        result = PerformanceMetrics(si).Query([vm], ["cpu.usagemhz"], max_samples=2)
+
+        assert list(result.Series(vm._moId, "cpu.usagemhz")) == list(result.Series(0, "cpu.usagemhz"))
+        assert result.Latest("cpu.usagemhz")[vm._moId] > 0
+        with pytest.raises(ValueError):
+            result.Series("vm-00003", "cpu.usagemhz")
+
+    def test_host_values_aggregate_their_vms(self, simulator, si):
+        metrics = PerformanceMetrics(si)
+        hosts = metrics.QueryHosts(["cpu.usagemhz"]).Latest("cpu.usagemhz")
+        vms = metrics.QueryVMs(["cpu.usagemhz"]).Latest("cpu.usagemhz")
+
+        host = simulator.Find(vim.HostSystem, "esx-000-00.local")
+        vm_names = [vm.name for vm in simulator.GetProperty(host, "vm")]
+        assert hosts["esx-000-00.local"] == sum(vms[vm_name] for vm_name in vm_names)
+
+    def test_bad_interval(self, si):
+        with pytest.raises(vmodl.fault.InvalidArgument):
+            PerformanceMetrics(si).QueryVMs(["cpu.usage"], interval=60)
+
+    def test_to_numpy(self, si):
+        numpy = pytest.importorskip("numpy")
+
+        result = PerformanceMetrics(si).QueryVMs(["cpu.usage", "mem.usage"], max_samples=4)
+        matrix = result.ToNumpy()
+
+        assert matrix.shape == (20, 2, 4)
+        assert numpy.array_equal(matrix[3, 1], numpy.array(result.Series(3, "mem.usage")))
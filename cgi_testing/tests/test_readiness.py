@@ -0,0 +1,128 @@
+import time
+
+import pytest
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.readiness import GuestWatcher, Readiness, RollingRestart
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories({"guest_boot_time": 0.1}, vms=8, clusters=1, hosts_per_cluster=2, powered_on_ratio=1)
+
+
+def WaitForGuests(simulator, si):
+    vms = [simulator.Find(vim.VirtualMachine, vm_name) for vm_name in Vsphere.GetVMs(si)]
+    with GuestWatcher(si, vms) as watcher:
+        assert all(watcher.Wait(timeout=5).values())
+
+
+def Unavailable(simulator, vm_names):
+    return sum(
+        simulator.GetProperty(simulator.Find(vim.VirtualMachine, vm_name), "guest.toolsRunningStatus")
+        != Simulator.TOOLS_RUNNING
+        for vm_name in vm_names
+    )
+
+
+class TestReadiness:
+    def test_conditions(self):
+        props = {
+            "runtime.powerState": "poweredOn",
+            "guest.toolsRunningStatus": "guestToolsRunning",
+            "guestHeartbeatStatus": "green",
+            "guest.ipAddress": "10.0.0.1",
+        }
+
+        assert Readiness().IsReady(props)
+        assert not Readiness().IsReady(dict(props, **{"guest.ipAddress": None}))
+        assert Readiness(ip_address=False).IsReady(dict(props, **{"guest.ipAddress": None}))
+        assert not Readiness(tools_running=False).IsReady(dict(props, guestHeartbeatStatus="gray"))
+
+
+class TestGuestWatcher:
+    def test_waits_for_many_vms_on_one_stream(self, simulator, si):
+        vm_names = Vsphere.GetVMs(si)
+        vms = [simulator.Find(vim.VirtualMachine, vm_name) for vm_name in vm_names]
+        simulator.ResetCounters()
+
+        with GuestWatcher(si, vms) as watcher:
+            ready = watcher.Wait(timeout=5)
+
+        assert ready == {vm_name: True for vm_name in vm_names}
+        assert simulator.rpc_calls_by_method["CreateFilter"] == 1
+        assert simulator.rpc_calls_by_method["RetrieveProperties"] == 0
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 0
+
+    def test_times_out(self, simulator, si):
+        Vsphere.PowerOffVM(si, "vm-00000")
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+
+        with GuestWatcher(si, [vm], poll_interval=0.1) as watcher:
+            assert watcher.Wait(timeout=0.2) == {"vm-00000": False}
+
+    def test_private_collector_is_destroyed(self, simulator, si):
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+
+        with GuestWatcher(si, [vm]):
+            assert len(simulator.filters) == 1
+
+        assert simulator.filters == {}
+
+
+class TestRollingRestart:
+    def test_restarts_within_max_unavailable(self, simulator, si, monkeypatch):
+        WaitForGuests(simulator, si)
+        vm_names = Vsphere.GetVMs(si)
+        restart = RollingRestart._Restart
+        peaks = []
+
+        def Restart(vm, power_state):
+            peaks.append(Unavailable(simulator, vm_names))
+            return restart(vm, power_state)
+
+        monkeypatch.setattr(RollingRestart, "_Restart", Restart)
+
+        results = RollingRestart(si, max_unavailable=3, timeout=5).Run(vm_names)
+
+        assert results == {vm_name: RollingRestart.READY for vm_name in vm_names}
+        assert len(peaks) == 8
+        assert max(peaks) < 3
+        assert Unavailable(simulator, vm_names) == 0
+
+    def test_waits_for_the_guest_to_come_back(self, simulator, si):
+        WaitForGuests(simulator, si)
+        started = time.monotonic()
+
+        assert RollingRestart(si, timeout=5).Run(["vm-00001"]) == {"vm-00001": RollingRestart.READY}
+        assert time.monotonic() - started >= simulator.guest_boot_time
+
+    def test_powered_off_vm_is_powered_on(self, simulator, si):
+        Vsphere.PowerOffVM(si, "vm-00002")
+
+        assert RollingRestart(si, timeout=5).Run(["vm-00002"]) == {"vm-00002": RollingRestart.READY}
+        assert Vsphere.GetVmMeta(si, "vm-00002")["PowerState"] == "poweredOn"
+
+    def test_failure_stops_the_rollout(self, simulator, si):
+        WaitForGuests(simulator, si)
+        simulator.InjectFault("RebootGuest", vim.fault.ToolsUnavailable())
+        simulator.InjectFault("ResetVM_Task", vmodl.fault.NotSupported(), in_task=True)
+
+        results = RollingRestart(si, timeout=5).Run(["vm-00003", "vm-00004"])
+
+        assert results == {"vm-00003": RollingRestart.FAILED, "vm-00004": RollingRestart.SKIPPED}
+
+    def test_missing_vm_counts_as_a_failure(self, si):
+        results = RollingRestart(si, max_failures=1, timeout=5).Run(["missing", "vm-00005"])
+
+        assert results == {"missing": RollingRestart.FAILED, "vm-00005": RollingRestart.READY}
+
+    def test_guest_booting_before_the_restart_is_not_counted(self, simulator, si, monkeypatch):
+        Vsphere.PowerOffVM(si, "vm-00006")
+        Vsphere.PowerOnVM(si, "vm-00006")
+        # The guest finishes booting during the rollout, but nothing restarted it.
+        monkeypatch.setattr(RollingRestart, "_Restart", lambda vm, power_state: True)
+
+        assert RollingRestart(si, timeout=0.5, poll_interval=0.05).Run(["vm-00006"]) == {"vm-00006": RollingRestart.TIMEOUT}
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.rebalance import Rebalancer
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+# Hosts of 4 x 1000 MHz and 16 GB. esx-00 carries ten 350 MHz VMs (87.5% CPU),
+# esx-01 two, esx-02 none. Built once per module, each test gets a clone.
+@pytest.fixture(scope="module")
+def rebalance_template():
+    simulator = Simulator()
+    datacenter = simulator.AddDatacenter("dc-01")
+    datastore = simulator.AddDatastore("datastore-0000", datacenter)
+    cluster = simulator.AddCluster("cluster-000", datacenter)
+    hosts = [
+        simulator.AddHost(f"esx-{index:02d}.local", cluster, [datastore], cpu_mhz=1000, cpu_cores=4, memory_gb=16)
+        for index in range(3)
+    ]
+    for index in range(12):
+        simulator.AddVM(
+            f"vm-{index:05d}",
+            host=hosts[0] if index < 10 else hosts[1],
+            datastore=datastore,
+            cpu_usage_mhz=350,
+            memory_usage_mb=1024,
+        )
+    return simulator
+
+
+@pytest.fixture(scope="function")
+def simulator(rebalance_template):
+    return rebalance_template.Clone()
+
+
+def Hosts(si):
+    return {vm_meta["Name"]: vm_meta["Host"] for vm_meta in Vsphere.IterVmMetas(si)}
+
+
+class TestRebalancer:
+    def test_plan_brings_every_host_under_the_target(self, si):
+        plan = Rebalancer(si, target_utilization=0.6).Plan()
+
+        assert plan.unresolved == []
+        assert all(utilization <= 0.6 for utilization in plan.After().values())
+        assert plan.before["esx-00.local"] == pytest.approx(0.875)
+        # 3500 MHz has to drop to 2400, so four VMs of 350 MHz must go.
+        assert len(plan.migrations) == 4
+        assert {migration.source.name for migration in plan.migrations} == {"esx-00.local"}
+
+    def test_balanced_cluster_needs_no_migrations(self, si):
+        assert Rebalancer(si, target_utilization=0.9).Plan().migrations == []
+
+    def test_dry_run_changes_nothing(self, simulator, si):
+        before = Hosts(si)
+        simulator.ResetCounters()
+
+        plan, results = Rebalancer(si, target_utilization=0.6).Run(dry_run=True)
+
+        assert plan.migrations and results == {}
+        assert simulator.rpc_calls_by_method["MigrateVM_Task"] == 0
+        assert Hosts(si) == before
+
+    def test_run_migrates_the_planned_vms(self, simulator, si):
+        plan, results = Rebalancer(si, target_utilization=0.6).Run()
+
+        assert results == {migration.vm_name: True for migration in plan.migrations}
+        hosts = Hosts(si)
+        assert all(hosts[migration.vm_name] == migration.target.name for migration in plan.migrations)
+        replanned = Rebalancer(si, target_utilization=0.6).Plan()
+        assert replanned.migrations == []
+
+    def test_impossible_target_is_reported(self, si):
+        plan = Rebalancer(si, target_utilization=0.2).Plan()
+
+        assert [host.name for host in plan.unresolved] == ["esx-00.local"]
+
+    def test_maintenance_hosts_take_no_vms(self, simulator, si):
+        simulator.GetProperty(simulator.Find(vim.HostSystem, "esx-02.local"), "runtime").inMaintenanceMode = True
+
+        plan = Rebalancer(si, target_utilization=0.6).Plan()
+
+        assert {migration.target.name for migration in plan.migrations} == {"esx-01.local"}
+
+    def test_per_host_concurrency_limit(self, si, monkeypatch):
+        plan = Rebalancer(si, target_utilization=0.5).Plan()
+        lock = threading.Lock()
+        running = {}
+        peak = []
+
+        def Migrate(migration):
+            with lock:
+                for host in (migration.source.name, migration.target.name):
+                    running[host] = running.get(host, 0) + 1
+                peak.append(max(running.values()))
+            threading.Event().wait(0.01)
+            with lock:
+                for host in (migration.source.name, migration.target.name):
+                    running[host] -= 1
+            return True
+
+        monkeypatch.setattr(Rebalancer, "_Migrate", Migrate)
+
+        results = Rebalancer(si, max_per_host=2, max_total=8).Execute(plan.migrations)
+
+        assert len(results) == len(plan.migrations) > 2
+        assert max(peak) <= 2
+
+    @pytest.mark.parametrize("limits", [{"max_per_host": 0}, {"max_total": 0}])
+    def test_limits_below_one_are_rejected(self, si, limits):
+        with pytest.raises(ValueError):
+            Rebalancer(si, **limits)
@@ -0,0 +1,126 @@
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.reconciler import DesiredVM, Reconciler
+from cgi_testing.classes.scheduler import Scheduler
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories(vms=6, clusters=1, hosts_per_cluster=2, portgroups=2, powered_on_ratio=1)
+
+
+def Unchanged(name):
+    return DesiredVM(name, cpu=2, ram_gb=4, disks={"Hard disk 1": 40}, isos={1: ""})
+
+
+class TestReconciler:
+    def test_unchanged_fleet_issues_no_tasks(self, simulator, si):
+        reconciler = Reconciler(si)
+        plan = reconciler.Plan([Unchanged(name) for name in Vsphere.GetVMs(si)])
+        simulator.ResetCounters()
+
+        assert plan.Changed() == []
+        assert reconciler.Apply(plan) == {}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 0
+
+    def test_plan_is_built_from_bulk_properties(self, simulator, si):
+        desired = [Unchanged(name) for name in Vsphere.GetVMs(si)]
+        simulator.ResetCounters()
+
+        Reconciler(si).Plan(desired)
+
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
+        assert simulator.rpc_calls_by_method["Fetch"] <= 2
+
+    def test_changes_are_applied_in_one_reconfigure(self, simulator, si):
+        desired = DesiredVM(
+            "vm-00000",
+            cpu=4,
+            ram_gb=8,
+            disks={"Hard disk 1": 60, "Hard disk 2": 10},
+            nics={1: "pg-0001"},
+            isos={1: "[datastore-0000] iso/tools.iso"},
+            attributes={"CDM": "team-a"},
+        )
+        reconciler = Reconciler(si)
+        plan = reconciler.Plan([desired, Unchanged("vm-00001")])
+        simulator.ResetCounters()
+
+        assert [vm_plan.name for vm_plan in plan.Changed()] == ["vm-00000"]
+        assert reconciler.Apply(plan) == {"vm-00000": True}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 1
+        assert simulator.rpc_calls_by_method["setCustomValue"] == 1
+
+        assert Reconciler(si).Plan([desired]).Changed() == []
+        disks = {disk["Label"]: disk["CapacityGB"] for disk in Vsphere.ListVMHardDisks(si, "vm-00000")}
+        assert disks == {"Hard disk 1": 60, "Hard disk 2": 10}
+        assert Vsphere.GetVMCustomAttributes(si, "vm-00000") == {"CDM": "team-a"}
+
+    def test_dry_run_only_reports(self, simulator, si):
+        reconciler = Reconciler(si)
+        plan = reconciler.Plan([DesiredVM("vm-00000", cpu=1), Unchanged("vm-00001")])
+        simulator.ResetCounters()
+
+        assert reconciler.Apply(plan, dry_run=True) == {"vm-00000": True}
+        assert simulator.rpc_calls == 0
+        assert plan.Format().splitlines() == [
+            "vm-00000 (power off required)",
+            "  cpu numCPU: 2 -> 1",
+            "1 to change, 1 unchanged",
+        ]
+        assert plan.ToDict()["vm-00000"]["power_off"] is True
+
+    def test_downsizing_powers_the_vm_off_and_on(self, simulator, si):
+        assert Reconciler(si).Apply([DesiredVM("vm-00000", cpu=1)]) == {"vm-00000": True}
+
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+        assert simulator.GetProperty(vm, "config.hardware.numCPU") == 1
+        assert simulator.GetProperty(vm, "runtime.powerState") == "poweredOn"
+
+    def test_impossible_changes_are_reported(self, si):
+        plan = Reconciler(si).Plan([
+            DesiredVM("vm-00000", disks={"Hard disk 1": 10}, nics={2: "pg-0000"}),
+            DesiredVM("missing", cpu=2),
+        ])
+
+        assert plan.ToDict()["vm-00000"]["errors"] == [
+            "Hard disk 1 cannot shrink from 40.0 GB to 10 GB",
+            "Network adapter 2 not found",
+        ]
+        assert plan.ToDict()["missing"]["errors"] == ["VM not found"]
+        assert plan.Changed() == []
+
+    def test_apply_through_scheduler(self, simulator, si):
+        names = Vsphere.GetVMs(si)
+        simulator.ResetCounters()
+
+        with Scheduler(si, max_per_host=1) as scheduler:
+            results = Reconciler(si).Apply([DesiredVM(name, cpu=4) for name in names], scheduler=scheduler)
+
+        assert results == {name: True for name in names}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == len(names)
+
+    def test_failed_vm_does_not_stop_the_fleet(self, simulator, si):
+        simulator.InjectFault("ReconfigVM_Task", vim.fault.InvalidDeviceSpec())
+
+        results = Reconciler(si).Apply([DesiredVM("vm-00000", cpu=1), DesiredVM("vm-00001", cpu=4)])
+
+        assert results == {"vm-00000": False, "vm-00001": True}
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+        assert simulator.GetProperty(vm, "runtime.powerState") == "poweredOn"
+        assert simulator.GetProperty(simulator.Find(vim.VirtualMachine, "vm-00001"), "config.hardware.numCPU") == 4
+
+    def test_added_disks_converge(self, simulator, si):
+        reconciler = Reconciler(si)
+
+        plan = reconciler.Plan([DesiredVM("vm-00000", disks={"Hard disk 3": 5})])
+        assert plan.ToDict()["vm-00000"]["errors"] == ["Hard disk 3 cannot be added, the next new disk is Hard disk 2"]
+        assert plan.Changed() == []
+
+        desired = [DesiredVM("vm-00000", disks={"Hard disk 2": 5, "Hard disk 3": 5})]
+        assert reconciler.Apply(desired) == {"vm-00000": True}
+        assert reconciler.Plan(desired).Changed() == []
+        disks = [disk["Label"] for disk in Vsphere.ListVMHardDisks(si, "vm-00000")]
+        assert disks == ["Hard disk 1", "Hard disk 2", "Hard disk 3"]
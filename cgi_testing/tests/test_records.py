@@ -0,0 +1,103 @@
+import json
+import datetime
+
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.records import Columns, ClusterCapacityRecord, DiskRecord, SnapshotRecord, VmMetaRecord
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories(vms=6, clusters=2, hosts_per_cluster=1, powered_on_ratio=1)
+
+
+class TestRecords:
+    def test_records_are_slotted(self):
+        disk = DiskRecord(None, "Hard disk 1", 40.0, 0, 1000)
+
+        assert not hasattr(disk, "__dict__")
+        with pytest.raises(AttributeError):
+            disk.extra = 1
+
+    def test_dict_compatibility(self):
+        disk = DiskRecord(None, "Hard disk 1", 40.0, 0, 1000)
+
+        assert disk["Label"] == "Hard disk 1"
+        assert disk.get("Missing") is None
+        assert disk == {"Label": "Hard disk 1", "CapacityGB": 40.0, "UnitNumber": 0, "BusNumber": 1000}
+        assert dict(disk) == disk.ToDict()
+
+    def test_snapshot_date_keeps_legacy_format(self):
+        snapshot = SnapshotRecord(None, "before", datetime.datetime(2024, 5, 1, 12, 30))
+
+        assert snapshot.ToDict() == {"Name": "before", "Date": "2024-05-01 12:30:00"}
+
+    def test_columns_use_typed_arrays_and_demote_on_none(self):
+        columns = Columns(DiskRecord, [
+            DiskRecord("vm-1", "Hard disk 1", 40.0, 0, 1000),
+            DiskRecord("vm-1", "Hard disk 2", 10.0, None, 1000),
+        ])
+
+        assert columns.Column("capacity_gb").typecode == "d"
+        assert columns.Column("unit_number") == [0, None]
+        assert columns[1] == DiskRecord("vm-1", "Hard disk 2", 10.0, None, 1000)
+        assert columns.Column("label")[0] is columns.Column("label")[0]
+        assert len(columns) == 2
+        assert columns.ToDicts()[0]["VM"] == "vm-1"
+
+    def test_equal_records_hash_alike(self):
+        disk = DiskRecord("vm-1", "Hard disk 1", 40.0, 0, 1000)
+
+        assert {disk, DiskRecord("vm-1", "Hard disk 1", 40.0, 0, 1000)} == {disk}
+
+    def test_unexpected_field_is_rejected(self):
+        with pytest.raises(TypeError):
+            ClusterCapacityRecord("cluster", colour="red")
+
+
+class TestVsphereRecords:
+    def test_vm_metas_by_name(self, simulator, si):
+        simulator.ResetCounters()
+
+        metas = Vsphere.GetVmMetasByName(si, ["vm-00003", "vm-00001"])
+
+        assert [meta["Name"] for meta in metas] == ["vm-00003", "vm-00001"]
+        assert all(isinstance(meta, dict) for meta in metas)
+        assert json.loads(json.dumps(metas)) == metas
+        assert metas[0]["Host"].startswith("esx-")
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 2
+        assert all(isinstance(meta, VmMetaRecord) for meta in Vsphere.GetVmMetasByName(si, ["vm-00001"], columnar=True))
+        assert Vsphere.GetVmMetasByName(si, ["vm-00001", "missing"]) is False
+
+    def test_vm_meta_matches_bulk_form(self, si):
+        assert Vsphere.GetVmMeta(si, "vm-00002") == Vsphere.GetVmMetasByName(si, ["vm-00002"])[0]
+
+    def test_cluster_info_keeps_legacy_keys(self, simulator, si):
+        simulator.ResetCounters()
+        Vsphere.GetObject(si, vim.ClusterComputeResource, "cluster-000")
+        lookup_calls = simulator.rpc_calls
+        simulator.ResetCounters()
+
+        info = Vsphere.GetClusterInfo(si, "cluster-000")
+
+        # The lookup, then only the summary.
+        assert simulator.rpc_calls == lookup_calls + 1
+
+        assert set(info) == {
+            "TotalClusterCPU", "TotalClusterMemory", "CPUInUse", "MemoryInUse", "CPUReserved", "MemoryReserved"
+        }
+        assert Vsphere.GetClustersInfo(si, columnar=True).Column("name") == ["cluster-000", "cluster-001"]
+
+    def test_fleet_reports(self, simulator, si):
+        Vsphere.SnapshotVM(si, "vm-00004", "nightly", "")
+        simulator.ResetCounters()
+
+        disks = Vsphere.ListFleetHardDisks(si, columnar=True)
+        snapshots = Vsphere.ListFleetSnapshots(si)
+
+        assert len(disks) == 6
+        assert list(disks.Column("capacity_gb")) == [40.0] * 6
+        assert [(snapshot["VM"], snapshot["Name"]) for snapshot in snapshots] == [("vm-00004", "nightly")]
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 2
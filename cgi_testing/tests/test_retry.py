@@ -0,0 +1,150 @@
+import http.client
+
+import pytest
+from unittest.mock import patch, MagicMock
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.retry import Retry, RetryBudget, RetryPolicy
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories(vms=2, clusters=1, hosts_per_cluster=1, powered_on_ratio=1)
+
+
+def DropConnectionAfter(simulator, method):
+    # The call reaches vCenter and is applied, then the response is lost.
+    invoke = simulator._Invoke
+    dropped = []
+
+    def Invoke(mo, info, args):
+        result = invoke(mo, info, args)
+        if info.wsdlName == method and not dropped:
+            dropped.append(info.wsdlName)
+            raise ConnectionResetError("connection reset by peer")
+        return result
+
+    simulator._Invoke = Invoke
+
+
+class TestRetryClassification:
+    @pytest.mark.parametrize("error, kind", [
+        (vim.fault.TaskInProgress(task=vim.Task("task-1")), Retry.TRANSIENT),
+        (vim.fault.InvalidState(), Retry.TRANSIENT),
+        (vim.fault.InvalidPowerState(), Retry.PERMANENT),
+        (vim.fault.InvalidHostState(), Retry.PERMANENT),
+        (vim.fault.InvalidVmState(), Retry.PERMANENT),
+        (vim.fault.QuestionPending(), Retry.PERMANENT),
+        (http.client.HTTPException("503 Service Unavailable"), Retry.TRANSIENT),
+        (http.client.HTTPException("500 Internal Server Error"), Retry.PERMANENT),
+        (ConnectionResetError(), Retry.AMBIGUOUS),
+        (vmodl.fault.NotSupported(), Retry.PERMANENT),
+        (ValueError(), Retry.PERMANENT),
+    ])
+    def test_classify(self, error, kind):
+        assert Retry.Classify(error) == kind
+
+    def test_delay_is_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4, jitter=lambda: 0.5)
+
+        assert [policy.Delay(attempt) for attempt in range(5)] == [0.5, 1, 2, 2, 2]
+
+    def test_budget_limits_retries(self):
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+
+        assert budget.TryRetry() is True
+        assert budget.TryRetry() is False
+        budget.RecordRequest()
+        budget.RecordRequest()
+        assert budget.TryRetry() is True
+
+
+class TestRetryCall:
+    def test_transient_fault_is_retried(self, no_retry_sleep):
+        operation = MagicMock(side_effect=[vim.fault.InvalidState(), "ok"])
+
+        assert Retry.Call(operation, policy=no_retry_sleep) == "ok"
+        assert operation.call_count == 2
+
+    def test_gives_up_after_max_attempts(self, no_retry_sleep):
+        operation = MagicMock(side_effect=vim.fault.InvalidState())
+
+        with pytest.raises(vim.fault.InvalidState):
+            Retry.Call(operation, policy=no_retry_sleep)
+        assert operation.call_count == no_retry_sleep.max_attempts
+
+    def test_exhausted_budget_stops_retrying(self):
+        policy = RetryPolicy(sleep=lambda delay: None, budget=RetryBudget(ratio=0, min_retries=0))
+        operation = MagicMock(side_effect=vim.fault.InvalidState())
+
+        with pytest.raises(vim.fault.InvalidState):
+            Retry.Call(operation, policy=policy)
+        assert operation.call_count == 1
+
+    def test_ambiguous_failure_is_not_resent_by_default(self, no_retry_sleep):
+        operation = MagicMock(side_effect=[ConnectionResetError(), "ok"])
+
+        with pytest.raises(ConnectionResetError):
+            Retry.Call(operation, policy=no_retry_sleep)
+
+    def test_ambiguous_failure_checks_idempotency(self, no_retry_sleep):
+        operation = MagicMock(side_effect=ConnectionResetError())
+
+        assert Retry.Call(operation, is_done=lambda: True, policy=no_retry_sleep) is True
+        assert operation.call_count == 1
+
+    @patch("cgi_testing.classes.vsphere.WaitForTask")
+    def test_lost_wait_reattaches_to_task(self, mock_wait_for_task, no_retry_sleep):
+        task_method = MagicMock(return_value="task")
+        mock_wait_for_task.side_effect = [ConnectionResetError(), "success"]
+
+        assert Vsphere._ExecuteTask(task_method) is True
+        task_method.assert_called_once_with()
+        assert mock_wait_for_task.call_count == 2
+
+
+class TestRetryWithSimulator:
+    def test_failed_task_is_resubmitted_in_place(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        simulator.InjectFault("PowerOffVM_Task", vim.fault.TaskInProgress(task=vim.Task("task-1")), in_task=True)
+
+        assert Vsphere.PowerOffVM(si, "vm-00000") is True
+        assert simulator.rpc_calls_by_method["PowerOffVM_Task"] == 2
+
+    def test_rejected_lookup_is_retried(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        simulator.InjectFault("CreateContainerView", vim.fault.InvalidState())
+
+        assert Vsphere.GetObject(si, vim.VirtualMachine, "vm-00000")
+
+    def test_applied_snapshot_is_not_created_twice(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        DropConnectionAfter(simulator, "CreateSnapshot_Task")
+
+        assert Vsphere.SnapshotVM(si, "vm-00000", "before-patch", "") is True
+        assert [snapshot["Name"] for snapshot in Vsphere.ListVMSnapshots(si, "vm-00000")] == ["before-patch"]
+
+    def test_applied_second_snapshot_is_not_created_twice(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        assert Vsphere.SnapshotVM(si, "vm-00000", "first", "") is True
+        DropConnectionAfter(simulator, "CreateSnapshot_Task")
+
+        assert Vsphere.SnapshotVM(si, "vm-00000", "second", "") is True
+        assert simulator.rpc_calls_by_method["CreateSnapshot_Task"] == 2
+
+    def test_applied_power_on_is_not_resent(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        Vsphere.PowerOffVM(si, "vm-00000")
+        DropConnectionAfter(simulator, "PowerOnVM_Task")
+
+        assert Vsphere.PowerOnVM(si, "vm-00000") is True
+        assert simulator.rpc_calls_by_method["PowerOnVM_Task"] == 1
+
+    def test_non_idempotent_step_is_not_resent(self, simulator, no_retry_sleep):
+        si = simulator.Connect()
+        DropConnectionAfter(simulator, "ReconfigVM_Task")
+
+        with pytest.raises(ConnectionResetError):
+            Vsphere.AddDiskToVM(si, "vm-00000", 1)
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 1
@@ -0,0 +1,149 @@
+import time
+import threading
+import collections
+
+import pytest
+from pyVmomi import vim
+
+from cgi_testing.classes.scheduler import Scheduler
+from cgi_testing.classes.vsphere import Vsphere
+
+
+@pytest.fixture(scope="function")
+def simulator(inventories):
+    return inventories(vms=12, clusters=1, hosts_per_cluster=3, datastores=2, powered_on_ratio=1)
+
+
+class ConcurrencyProbe:
+    def __init__(self, simulator, duration=0.02):
+        self.simulator = simulator
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.running = collections.Counter()
+        self.peak = collections.Counter()
+        self.started = []
+
+    def Keys(self, vm_name):
+        vm = self.simulator.Find(vim.VirtualMachine, vm_name)
+        host = self.simulator.GetProperty(vm, "runtime.host")._moId
+        datastores = [datastore._moId for datastore in self.simulator.GetProperty(vm, "datastore")]
+        return [("host", host), ("total", None)] + [("datastore", datastore) for datastore in datastores]
+
+    def __call__(self, si, vm_name):
+        keys = self.Keys(vm_name)
+        with self.lock:
+            self.started.append(vm_name)
+            for key in keys:
+                self.running[key] += 1
+                self.peak[key] = max(self.peak[key], self.running[key])
+        time.sleep(self.duration)
+        with self.lock:
+            for key in keys:
+                self.running[key] -= 1
+        return vm_name
+
+    def Peak(self, kind):
+        return max(count for (key_kind, _), count in self.peak.items() if key_kind == kind)
+
+
+class TestScheduler:
+    def test_caps_are_enforced(self, simulator, si):
+        probe = ConcurrencyProbe(simulator)
+        names = Vsphere.GetVMs(si)
+
+        with Scheduler(si, max_per_host=2, max_per_datastore=3, max_total=5) as scheduler:
+            results = scheduler.Map(probe, names)
+
+        assert results == {name: name for name in names}
+        assert probe.Peak("host") == 2
+        assert probe.Peak("datastore") <= 3
+        assert probe.Peak("total") <= 5
+
+    def test_busy_host_does_not_block_others(self, simulator, si):
+        probe = ConcurrencyProbe(simulator)
+        names = Vsphere.GetVMs(si)
+        hot_host = probe.Keys(names[0])[0]
+        hot = [name for name in names if probe.Keys(name)[0] == hot_host]
+        other = next(name for name in names if probe.Keys(name)[0] != hot_host)
+
+        with Scheduler(si, max_per_host=1, max_per_datastore=10, max_total=10) as scheduler:
+            scheduler.Map(probe, hot + [other])
+
+        assert probe.started.index(other) < len(hot)
+
+    def test_metrics(self, simulator, si):
+        probe = ConcurrencyProbe(simulator, duration=0.05)
+        names = Vsphere.GetVMs(si)
+
+        with Scheduler(si, max_per_host=1, max_per_datastore=10, max_total=10) as scheduler:
+            futures = [scheduler.Submit(probe, name) for name in names]
+            metrics = scheduler.Metrics()
+            assert metrics["running"] == 3
+            assert metrics["queue_depth"] == len(names) - 3
+            for future in futures:
+                future.result()
+
+        metrics = scheduler.Metrics()
+        assert metrics["completed"] == len(names)
+        assert metrics["queue_depth"] == 0
+        assert metrics["wait_time_max"] >= 0.05
+
+    def test_submits_vsphere_methods_by_name(self, simulator, si):
+        names = Vsphere.GetVMs(si)[:4]
+        simulator.ResetCounters()
+
+        with Scheduler(si) as scheduler:
+            assert scheduler.Map("PowerOffVM", names) == {name: True for name in names}
+
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
+        assert simulator.rpc_calls_by_method["PowerOffVM_Task"] == 4
+
+    def test_errors_are_returned_on_the_future(self, si):
+        def Fail(si, vm_name):
+            raise ValueError(vm_name)
+
+        with Scheduler(si) as scheduler:
+            future = scheduler.Submit(Fail, "vm-00000")
+            with pytest.raises(ValueError):
+                future.result()
+
+        assert scheduler.Metrics()["failed"] == 1
+
+    def test_exit_runs_queued_operations(self, si):
+        same_host = ["vm-00000", "vm-00003", "vm-00006", "vm-00009"]
+
+        with Scheduler(si, max_per_host=1) as scheduler:
+            futures = [scheduler.Submit(lambda si, vm_name: time.sleep(0.01) or vm_name, name) for name in same_host]
+
+        assert [future.result(timeout=5) for future in futures] == same_host
+
+    def test_shutdown_without_wait_cancels_queued_operations(self, si):
+        release = threading.Event()
+        scheduler = Scheduler(si, max_per_host=1)
+        futures = [scheduler.Submit(lambda si, vm_name: release.wait(5), name) for name in ["vm-00000", "vm-00003", "vm-00006"]]
+
+        scheduler.Shutdown(wait=False)
+        release.set()
+
+        assert futures[0].result(timeout=5) is True
+        assert all(future.cancelled() for future in futures[1:])
+        with pytest.raises(RuntimeError):
+            scheduler.Submit("PowerOnVM", "vm-00001")
+
+    def test_unknown_vm_is_still_scheduled(self, si):
+        with Scheduler(si) as scheduler:
+            assert scheduler.Submit("PowerOnVM", "missing").result() is False
+
+    def test_concurrent_submits_share_one_inventory_refresh(self, simulator, si):
+        names = Vsphere.GetVMs(si)
+        simulator.rpc_latency = 0.02
+        simulator.ResetCounters()
+
+        with Scheduler(si) as scheduler:
+            threads = [threading.Thread(target=scheduler.Submit, args=(lambda si, vm_name: vm_name, name)) for name in names]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 1
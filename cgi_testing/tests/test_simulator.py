@@ -0,0 +1,274 @@
+import pytest
+from pyVim.task import WaitForTask
+from pyVmomi import vim, vmodl
+
+from cgi_testing.classes.simulator import Simulator
+from cgi_testing.classes.vsphere import Vsphere
+
+
+class TestSimulatorInventory:
+    def test_generate(self, si):
+        assert len(Vsphere.GetVMs(si)) == 20
+        assert Vsphere.GetClusters(si) == ["cluster-000", "cluster-001"]
+
+    def test_cluster_info_is_derived_from_hosts(self, si):
+        info = Vsphere.GetClusterInfo(si, "cluster-000")
+
+        assert info["TotalClusterCPU"] == 2 * 2400 * 32
+        assert info["CPUInUse"] > 0
+
+    def test_clone_is_independent(self, simulator, si):
+        clone = simulator.Clone()
+        clone_si = clone.Connect()
+
+        Vsphere.PowerOffVM(clone_si, "vm-00000")
+
+        assert Vsphere.GetVMs(clone_si) == Vsphere.GetVMs(si)
+        assert Vsphere.GetVmMeta(clone_si, "vm-00000")["PowerState"] == "poweredOff"
+        assert Vsphere.GetVmMeta(si, "vm-00000")["PowerState"] == "poweredOn"
+
+    def test_datastore_layout_matches_upload_navigation(self, si):
+        datastore = Vsphere.GetObject(si, vim.Datastore, "datastore-0000")
+
+        assert isinstance(datastore.parent.parent.parent, vim.Datacenter)
+
+    def test_rpc_calls_are_counted(self, simulator, si):
+        simulator.ResetCounters()
+
+        Vsphere.GetVMs(si)
+
+        # Two content fetches, the container view and its member list, then one
+        # name fetch per VM.
+        assert simulator.rpc_calls == 24
+        assert simulator.rpc_calls_by_method["Fetch"] == 23
+
+
+class TestSimulatorOperations:
+    def test_power_cycle(self, si):
+        assert Vsphere.PowerOffVM(si, "vm-00000") is True
+        assert Vsphere.GetObject(si, vim.VirtualMachine, "vm-00000").runtime.powerState == "poweredOff"
+        assert Vsphere.PowerOnVM(si, "vm-00000") is True
+
+    def test_snapshot_lifecycle(self, si):
+        assert Vsphere.SnapshotVM(si, "vm-00001", "before", "test") is True
+        assert [snap["Name"] for snap in Vsphere.ListVMSnapshots(si, "vm-00001")] == ["before"]
+
+        assert Vsphere.DeleteVMSnapshot(si, "vm-00001", "before") is True
+        assert Vsphere.ListVMSnapshots(si, "vm-00001") == []
+
+    def test_nested_snapshots_are_found(self, si):
+        assert Vsphere.SnapshotVM(si, "vm-00001", "first", "test") is True
+        assert Vsphere.SnapshotVM(si, "vm-00001", "second", "test") is True
+
+        assert Vsphere.RestoreVMFromSnapshot(si, "vm-00001", "second") is True
+        assert Vsphere.DeleteVMSnapshot(si, "vm-00001", "second") is True
+        assert Vsphere.DeleteVMSnapshot(si, "vm-00001", "second") is False
+
+    def test_add_disks_and_reject_used_unit(self, si):
+        assert Vsphere.AddDisksToVM(si, "vm-00002", [1, 2]) is True
+        assert [disk["UnitNumber"] for disk in Vsphere.ListVMHardDisks(si, "vm-00002")] == [0, 1, 2]
+
+        vm = Vsphere.GetObject(si, vim.VirtualMachine, "vm-00002")
+        spec = Vsphere._CreateDiskSpec(vm, 1, controller_key=1000, unit_number=1)
+        with pytest.raises(vim.fault.InvalidDeviceSpec):
+            WaitForTask(vm.ReconfigVM_Task(spec=vim.vm.ConfigSpec(deviceChange=[spec])))
+
+    def test_returned_data_objects_are_copies(self, si):
+        vm = Vsphere.GetObject(si, vim.VirtualMachine, "vm-00003")
+        disk = Vsphere.FindVirtualDisk(vm, "Hard disk 1")
+        disk.capacityInKB = 1
+
+        assert Vsphere.FindVirtualDisk(vm, "Hard disk 1").capacityInKB == 40 * 1024 * 1024
+
+    def test_attach_portgroup_connects_port(self, simulator, si):
+        assert Vsphere.AttachPortgroupToVM(si, "vm-00004", "pg-0001", 1) is True
+
+        vm = Vsphere.GetObject(si, vim.VirtualMachine, "vm-00004")
+        nic = next(dev for dev in vm.config.hardware.device if isinstance(dev, vim.vm.device.VirtualEthernetCard))
+        dvs = Vsphere.GetObject(si, vim.DistributedVirtualSwitch, "dvs-01")
+        port = dvs.FetchDVPorts(vim.dvs.PortCriteria(portKey=[nic.backing.port.portKey]))[0]
+        assert port.connectee.connectedEntity == vm
+
+    def test_injected_task_fault(self, simulator, si):
+        simulator.InjectFault("PowerOffVM_Task", vmodl.fault.NotSupported(), in_task=True)
+
+        with pytest.raises(vmodl.fault.NotSupported):
+            Vsphere.PowerOffVM(si, "vm-00000")
+
+        assert Vsphere.PowerOffVM(si, "vm-00000") is True
+
+    def test_injected_synchronous_fault(self, simulator, si):
+        simulator.InjectFault("CreateContainerView", vmodl.fault.SystemError(reason="busy"))
+
+        assert Vsphere.GetObject(si, vim.VirtualMachine, "vm-00000") is False
+
+
+class TestSimulatorTasks:
+    def test_task_moves_through_states_on_the_clock(self):
+        simulator = Simulator(task_queue_time=0.02, task_run_time=0.02).Generate(vms=1)
+        vm = simulator.Find(vim.VirtualMachine, "vm-00000")
+
+        task = vm.Rename_Task("renamed")
+        assert task.info.state == "queued"
+
+        assert WaitForTask(task) == "success"
+        info = task.info
+        assert info.startTime >= info.queueTime
+        assert info.completeTime > info.startTime
+        assert vm.name == "renamed"
+
+
+class TestSimulatorPropertyCollector:
+    def retrieve_spec(self, si):
+        content = si.RetrieveContent()
+        view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        return content.propertyCollector, vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=view,
+                    skip=True,
+                    selectSet=[
+                        vmodl.query.PropertyCollector.TraversalSpec(
+                            name="view", type=vim.view.ContainerView, path="view", skip=False
+                        )
+                    ],
+                )
+            ],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=["name", "runtime.powerState"]
+                )
+            ],
+        )
+
+    def test_retrieve_properties_ex_pages(self, si):
+        collector, spec = self.retrieve_spec(si)
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=8)
+
+        result = collector.RetrievePropertiesEx([spec], options)
+        pages = [result.objects]
+        while result.token:
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+            pages.append(result.objects)
+
+        assert [len(page) for page in pages] == [8, 8, 4]
+        assert {prop.name for prop in pages[0][0].propSet} == {"name", "runtime.powerState"}
+
+    def test_get_object_properties_follows_pages(self, monkeypatch, simulator, si):
+        monkeypatch.setattr(Vsphere, "PROPERTY_PAGE_SIZE", 8)
+        simulator.ResetCounters()
+
+        properties = Vsphere.GetObjectProperties(si, vim.VirtualMachine, ["name", "runtime.host", "datastore"])
+
+        assert sorted(props["name"] for props in properties.values()) == Vsphere.GetVMs(si)
+        assert all(isinstance(props["runtime.host"], vim.HostSystem) for props in properties.values())
+        assert all(len(props["datastore"]) == 1 for props in properties.values())
+        assert simulator.rpc_calls_by_method["ContinueRetrievePropertiesEx"] == 2
+        assert simulator.rpc_calls_by_method["DestroyView"] == 1
+
+    def test_iter_vms_streams_pages(self, simulator, si):
+        simulator.ResetCounters()
+        names = Vsphere.IterVMs(si, page_size=8)
+
+        assert next(names) == "vm-00000"
+        assert simulator.rpc_calls_by_method["ContinueRetrievePropertiesEx"] == 0
+        assert list(names) == Vsphere.GetVMs(si)[1:]
+
+    def test_iter_stops_early_and_releases_the_server_side_result(self, simulator, si):
+        simulator.ResetCounters()
+
+        for index, vm in enumerate(Vsphere.IterObjects(si, vim.VirtualMachine, page_size=8)):
+            assert isinstance(vm, vim.VirtualMachine)
+            if index == 2:
+                break
+
+        assert simulator.rpc_calls_by_method["ContinueRetrievePropertiesEx"] == 0
+        assert simulator.rpc_calls_by_method["CancelRetrievePropertiesEx"] == 1
+        assert simulator.rpc_calls_by_method["DestroyView"] == 1
+        assert simulator.retrievals == {}
+
+    def test_iter_vm_metas(self, si):
+        metas = list(Vsphere.IterVmMetas(si, page_size=7))
+
+        assert [meta["Name"] for meta in metas] == Vsphere.GetVMs(si)
+        assert metas[0] == Vsphere.GetVmMeta(si, "vm-00000")
+
+    def test_wait_for_updates_ex_reports_changes(self, si):
+        collector, spec = self.retrieve_spec(si)
+        property_filter = collector.CreateFilter(spec, True)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+
+        initial = collector.WaitForUpdatesEx("", options)
+        assert len(initial.filterSet[0].objectSet) == 20
+        assert collector.WaitForUpdatesEx(initial.version, options) is None
+
+        Vsphere.PowerOffVM(si, "vm-00000")
+        update = collector.WaitForUpdatesEx(initial.version, options)
+
+        changes = [
+            (object_update.obj.name, change.name, change.val)
+            for object_update in update.filterSet[0].objectSet
+            for change in object_update.changeSet
+        ]
+        assert changes == [("vm-00000", "runtime.powerState", "poweredOff")]
+        property_filter.Destroy()
+
+
+class TestSimulatorISO:
+    def drives(self, simulator, vm_name):
+        vm = simulator.Find(vim.VirtualMachine, vm_name)
+        return [
+            device
+            for device in simulator.GetProperty(vm, "config.hardware.device")
+            if isinstance(device, vim.vm.device.VirtualCdrom)
+        ]
+
+    def iso(self, drive):
+        return getattr(drive.backing, "fileName", None)
+
+    def test_mount_reuses_the_free_drive(self, simulator, si):
+        vm_names = ["vm-00000", "vm-00001", "vm-00002"]
+        simulator.ResetCounters()
+
+        results = Vsphere.MountISO(si, vm_names, "datastore-0000", "os/rollout.iso")
+
+        assert results == {vm_name: True for vm_name in vm_names}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 3
+        assert simulator.rpc_calls_by_method["RetrievePropertiesEx"] == 2
+        for vm_name in vm_names:
+            assert [self.iso(drive) for drive in self.drives(simulator, vm_name)] == ["[datastore-0000] os/rollout.iso"]
+
+    def test_mount_skips_vms_that_have_the_iso(self, simulator, si):
+        Vsphere.MountISO(si, ["vm-00003"], "datastore-0000", "os/rollout.iso")
+        simulator.ResetCounters()
+
+        assert Vsphere.MountISO(si, ["vm-00003"], "datastore-0000", "os/rollout.iso") == {"vm-00003": True}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 0
+
+    def test_mount_adds_a_drive_when_all_are_in_use(self, simulator, si):
+        Vsphere.MountISO(si, ["vm-00004"], "datastore-0000", "tools.iso")
+
+        assert Vsphere.MountISO(si, ["vm-00004"], "datastore-0000", "os/rollout.iso") == {"vm-00004": True}
+        assert [self.iso(drive) for drive in self.drives(simulator, "vm-00004")] == [
+            "[datastore-0000] tools.iso",
+            "[datastore-0000] os/rollout.iso",
+        ]
+
+    def test_attach_cdrom_reuses_the_free_drive(self, simulator, si):
+        assert Vsphere.AttachCDRomToVM(si, "vm-00005", "datastore-0000", "os/rollout.iso")
+
+        assert len(self.drives(simulator, "vm-00005")) == 1
+
+    def test_unmount(self, simulator, si):
+        Vsphere.MountISO(si, ["vm-00006", "vm-00007"], "datastore-0000", "os/rollout.iso")
+        simulator.ResetCounters()
+
+        results = Vsphere.UnmountISO(si, ["vm-00006", "vm-00007", "vm-00008"], "datastore-0000", "os/rollout.iso")
+
+        assert results == {"vm-00006": True, "vm-00007": True, "vm-00008": True}
+        assert simulator.rpc_calls_by_method["ReconfigVM_Task"] == 2
+        assert self.iso(self.drives(simulator, "vm-00006")[0]) is None
+
+    def test_missing_vm_and_drive_fail_without_raising(self, si):
+        assert Vsphere.MountISO(si, ["missing"], "datastore-0000", "os/rollout.iso") == {"missing": False}
+        assert Vsphere.AttachISOToVirtualMachine(si, "vm-00009", 2, "datastore-0000", "os/rollout.iso") is False
@@ -3,21 +3,7 @@ from unittest.mock import patch, MagicMock, call
 from pyVmomi import vim
 
 from cgi_testing.classes.vsphere import Vsphere
-
-
-@pytest.fixture(scope="function")
-def mock_si():
-    mock = MagicMock()
-    mock.content = MagicMock()
-    mock.content.viewManager = MagicMock()
-    mock.content.rootFolder = MagicMock()
-
-    return mock
-
-
-@pytest.fixture(scope="function")
-def mock_vm():
-    return MagicMock()
+from cgi_testing.tests.fakes import FakeTask, TaskScript
 
 
 @pytest.fixture(scope="function")
@@ -486,6 +472,40 @@ class TestVsphereExecuteTask:
         mock_wait_task.assert_called_once_with(mock_task)
 
 
+@pytest.mark.usefixtures("no_retry_sleep")
+class TestVsphereScriptedTasks:
+    def test_task_walks_through_its_states(self, fake_wait_for_task):
+        script = TaskScript(("queued", "running", "running", "success"))
+
+        assert Vsphere._ExecuteTask(script) is True
+        assert script.tasks[0].seen == ["queued", "running", "running", "success"]
+
+    def test_failed_task_is_submitted_again(self, fake_wait_for_task):
+        script = TaskScript(
+            FakeTask(("running", "error"), error=vim.fault.TaskInProgress()),
+            ("queued", "success"),
+        )
+
+        assert Vsphere._ExecuteTask(script) is True
+        assert len(script.tasks) == 2
+
+    def test_permanent_task_error_is_raised(self, fake_wait_for_task):
+        script = TaskScript(FakeTask(("running", "error"), error=vim.fault.InvalidPowerState()))
+
+        with pytest.raises(vim.fault.InvalidPowerState):
+            Vsphere._ExecuteTask(script)
+        assert len(script.tasks) == 1
+
+    @patch("cgi_testing.classes.vsphere.Vsphere.GetObject")
+    def test_power_on_through_a_scripted_task(self, mock_get_object, mock_si, mock_vm, fake_wait_for_task):
+        mock_vm.runtime.powerState = vim.VirtualMachinePowerState.poweredOff
+        mock_vm.PowerOn = TaskScript()
+        mock_get_object.return_value = mock_vm
+
+        assert Vsphere.PowerOnVM(mock_si, "test-vm") is True
+        fake_wait_for_task.assert_called_once_with(mock_vm.PowerOn.tasks[0])
+
+
 class TestVsphereSnapshots:
     @patch("cgi_testing.classes.vsphere.Vsphere.GetObject")
     @patch("cgi_testing.classes.vsphere.Vsphere._ExecuteTask")
@@ -565,3 +585,111 @@ class TestVsphereSnapshots:
 
         assert result is True
         mock_get_object.assert_called_once()
+
+
+class TestVsphereDisks:
+    @staticmethod
+    def make_vm(controller_units):
+        devices = []
+        for bus_number, units in enumerate(controller_units):
+            controller = vim.vm.device.ParaVirtualSCSIController(
+                key=1000 + bus_number, busNumber=bus_number, scsiCtlrUnitNumber=7
+            )
+            devices.append(controller)
+            for unit_number in units:
+                devices.append(
+                    vim.vm.device.VirtualDisk(
+                        key=2000 + len(devices),
+                        controllerKey=controller.key,
+                        unitNumber=unit_number,
+                    )
+                )
+
+        vm = MagicMock()
+        vm.config.hardware.device = devices
+        return vm
+
+    def test_allocate_disk_slots_fills_gaps_and_skips_reserved_unit(self):
+        vm = self.make_vm([[0, 1, 3, 4, 5, 6]])
+
+        slots, controller_specs = Vsphere._AllocateDiskSlots(vm, 3)
+
+        assert slots == [(1000, 2), (1000, 8), (1000, 9)]
+        assert controller_specs == []
+
+    def test_allocate_disk_slots_spills_to_next_controller(self):
+        full = [unit for unit in range(16) if unit != 7]
+        vm = self.make_vm([full, [0]])
+
+        slots, controller_specs = Vsphere._AllocateDiskSlots(vm, 2)
+
+        assert slots == [(1001, 1), (1001, 2)]
+        assert controller_specs == []
+
+    def test_allocate_disk_slots_adds_paravirtual_controller(self):
+        full = [unit for unit in range(16) if unit != 7]
+        vm = self.make_vm([full])
+
+        slots, controller_specs = Vsphere._AllocateDiskSlots(vm, 9)
+
+        assert len(controller_specs) == 1
+        controller = controller_specs[0].device
+        assert isinstance(controller, vim.vm.device.ParaVirtualSCSIController)
+        assert controller.busNumber == 1
+        assert controller.key < 0
+        assert [unit for _, unit in slots] == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+        assert {key for key, _ in slots} == {controller.key}
+
+    def test_allocate_disk_slots_exhausted(self):
+        full = [unit for unit in range(16) if unit != 7]
+        vm = self.make_vm([full] * 4)
+
+        assert Vsphere._AllocateDiskSlots(vm, 1) == ([], [])
+
+    def test_create_disk_spec_provisioning(self):
+        vm = self.make_vm([[0]])
+
+        result = Vsphere._CreateDiskSpec(vm, 10, thin_provisioned=True)
+
+        assert result.device.controllerKey == 1000
+        assert result.device.unitNumber == 1
+        assert result.device.capacityInKB == 10 * 1024 * 1024
+        assert result.device.backing.thinProvisioned is True
+        assert result.device.backing.eagerlyScrub is False
+
+    def test_create_disk_spec_invalid_provisioning(self):
+        vm = self.make_vm([[0]])
+
+        with pytest.raises(ValueError):
+            Vsphere._CreateDiskSpec(vm, 10, thin_provisioned=True, eagerly_scrub=True)
+
+    @patch("cgi_testing.classes.vsphere.Vsphere.GetObject")
+    @patch("cgi_testing.classes.vsphere.Vsphere._ExecuteTask")
+    def test_add_disks_to_vm_invalid_provisioning(
+        self, mock_execute_task, mock_get_object, mock_si
+    ):
+        mock_get_object.return_value = self.make_vm([[0]])
+
+        result = Vsphere.AddDisksToVM(mock_si, "test-vm", [10], thin_provisioned=True, eagerly_scrub=True)
+
+        assert result is False
+        mock_execute_task.assert_not_called()
+
+    @patch("cgi_testing.classes.vsphere.Vsphere.GetObject")
+    @patch("cgi_testing.classes.vsphere.Vsphere._ExecuteTask")
+    def test_add_disks_to_vm_single_reconfigure(
+        self, mock_execute_task, mock_get_object, mock_si
+    ):
+        vm = self.make_vm([[0]])
+        mock_get_object.return_value = vm
+        mock_execute_task.return_value = True
+
+        result = Vsphere.AddDisksToVM(mock_si, "test-vm", [10, 20], eagerly_scrub=True)
+
+        assert result is True
+        mock_execute_task.assert_called_once()
+        spec = mock_execute_task.call_args.kwargs["spec"]
+        disks = [change.device for change in spec.deviceChange]
+        assert [disk.unitNumber for disk in disks] == [1, 2]
+        assert [disk.key for disk in disks] == [-1, -2]
+        assert all(disk.backing.eagerlyScrub for disk in disks)
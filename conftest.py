@@ -0,0 +1,39 @@
+import os
+import time
+
+import pytest
+
+# Wall-clock budget for the whole run, in seconds. Going over it fails the
+# run even when every test passed, so a slow test cannot creep in unnoticed.
+RUNTIME_BUDGET = float(os.environ.get("CGI_TESTING_RUNTIME_BUDGET", "60"))
+
+_started = pytest.StashKey()
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--runtime-budget",
+        type=float,
+        default=RUNTIME_BUDGET,
+        help="fail the run if it takes longer than this many seconds (0 disables)",
+    )
+
+
+def pytest_sessionstart(session):
+    session.config.stash[_started] = time.monotonic()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # With pytest-xdist only the controller judges the budget; workers each
+    # run a share of the tests.
+    if hasattr(session.config, "workerinput"):
+        return
+
+    budget = session.config.getoption("--runtime-budget")
+    elapsed = time.monotonic() - session.config.stash[_started]
+    if budget and elapsed > budget and session.exitstatus == pytest.ExitCode.OK:
+        reporter = session.config.pluginmanager.get_plugin("terminalreporter")
+        if reporter is not None:
+            reporter.ensure_newline()
+            reporter.write_line(f"runtime budget exceeded: {elapsed:.1f}s > {budget:.1f}s", red=True)
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED